@@ -1,37 +1,205 @@
+import os
 import sys
-from flask import Flask, render_template, request, jsonify
+import uuid
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context, g
 from src.predict import Predict
 from src.get_reddit_data import YfData
-from src.logger import logging
+from src.result_cache import ResultCache
+from src.orchestrator import AnalysisOrchestrator
+from src.job_queue import JobQueue, QueueFullError, JOB_WORKERS
+from src.result_store import ResultStore
+from src.scheduler import RefreshScheduler, load_watchlist
+from src.metrics import REGISTRY
+from src.sentiment_analysis import SENTIMENT_BACKEND, available_backends
+from src.analysis_result import encode_json, etag_of, gzip_body
+from src.logger import logging, REQUEST_ID, setup_logging
 from src.exception import CustomException
 
+setup_logging()
 app = Flask(__name__)
 
+FLASK_DEBUG = os.getenv("FLASK_DEBUG", "0") == "1"
+# score posts in a process pool sized to the cores instead of in the request worker threads
+NLP_PROCESS_POOL = os.getenv("NLP_PROCESS_POOL", "1") == "1"
+# /analyze waits this long for its job before answering 202 with the job to poll
+ANALYZE_WAIT_TIMEOUT = float(os.getenv("ANALYZE_WAIT_TIMEOUT", 30))
+MAX_BATCH_SYMBOLS = int(os.getenv("MAX_BATCH_SYMBOLS", 500))
+# refresh the watchlist in this process; alternatively run `python -m src.scheduler` next to the app
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "0") == "1"
+
 # Initialize analyzers
-sentiment_result = Predict()
-stock_data = YfData()
+predictor = Predict()
+if NLP_PROCESS_POOL:
+    predictor.warm_nlp_pool()
+yf_data = YfData()
+sentiment_cache = ResultCache(name='sentiment')
+stock_data_cache = ResultCache(name='stock_data')
+result_store = ResultStore()
+# every job runs its sentiment and price fetch side by side, so the orchestrator needs two threads per job worker
+orchestrator = AnalysisOrchestrator(predictor, yf_data, sentiment_cache, stock_data_cache,
+                                    max_workers=2 * JOB_WORKERS, use_process_pool=NLP_PROCESS_POOL,
+                                    result_store=result_store)
+jobs = JobQueue(orchestrator.analyze)
+scheduler = None
+if SCHEDULER_ENABLED:
+    scheduler = RefreshScheduler(predictor, yf_data, result_store, load_watchlist(markets=predictor.sources.markets),
+                                 use_process_pool=NLP_PROCESS_POOL).start()
+
+
+@app.before_request
+def bind_request_id():
+    # every record logged for this request, in jobs and worker threads too, carries its id;
+    # a caller's X-Request-ID is kept so logs join up across services
+    request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g.request_id_token = REQUEST_ID.set(request_id)
+
+
+@app.after_request
+def add_request_id(response):
+    response.headers['X-Request-ID'] = REQUEST_ID.get() or ''
+    return response
+
+
+@app.teardown_request
+def unbind_request_id(exc):
+    token = g.pop('request_id_token', None)
+    if token is not None:
+        REQUEST_ID.reset(token)
+
+
+def json_response(payload, status=200, headers=None):
+    return Response(encode_json(payload), status=status, headers=headers, mimetype='application/json')
+
+
+def analysis_response(payload):
+    # a finished analysis: 304 when the client already holds this exact body, gzip when it accepts it
+    body = encode_json(payload)
+    etag = etag_of(body)
+    # weak, the same ETag covers the plain and the gzipped body
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        body, compressed = gzip_body(body, request.headers.get('Accept-Encoding'))
+        response = Response(body, mimetype='application/json')
+        if compressed:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag, weak=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def busy_response(e):
+    return json_response({'success': False, 'error': str(e)}, 503, {'Retry-After': str(e.retry_after)})
+
+
+def job_location(job):
+    return {'Location': f'/jobs/{job.id}'}
+
+
+def read_stock_request():
+    payload = request.get_json(silent=True) or request.form
+    return payload.get('stock_symbol', '').strip().upper(), payload.get('stock_type', 'US'), read_backend(payload)
+
+
+def read_backend(payload):
+    # per request choice of sentiment scorer, 'vader' or the trained 'linear' model
+    return payload.get('backend') or SENTIMENT_BACKEND
+
+
+def bad_backend(backend):
+    # an unknown backend, or 'linear' without a trained model file
+    return json_response({'success': False, 'error': f'backend must be one of {list(available_backends())}, got {backend}'}, 400)
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/analyze', methods=['POST'])
+@app.route('/analyze', methods=['GET', 'POST'])
 def analyze():
+    # GET takes the same fields in the query string, for clients and caches that revalidate
     try:
-        stock_symbol = request.form.get('stock_symbol', '').upper()
-        stock_type = request.form.get('stock_type', ' ').lower()
+        stock_symbol = request.values.get('stock_symbol', '').upper()
+        stock_type = request.values.get('stock_type', ' ').lower()
+        backend = read_backend(request.values)
+        if backend not in available_backends():
+            return bad_backend(backend)
         logging.info("getting user data")
-        sentiment_result = sentiment_result.predict(stock_symbol, stock_type)
-        stock_data = stock_data.get_yf_data(stock_symbol)
-        result = {
-            'stock_symbol': stock_symbol,
-            'sentiment': sentiment_result,
-            'stock_data': stock_data
-        }
+        # symbols the scheduler keeps fresh are answered straight from the result store
+        result = orchestrator.lookup(stock_symbol, stock_type, backend)
+        if result is not None:
+            return analysis_response(result)
+        # the work runs on the job queue's workers, sentiment and price side by side; a full
+        # queue is refused right away and a slow ticker turns into a job to poll
+        try:
+            job = jobs.submit(stock_symbol, stock_type, backend)
+        except QueueFullError as e:
+            return busy_response(e)
+        if not job.wait(ANALYZE_WAIT_TIMEOUT):
+            return json_response(job.to_dict(), 202, job_location(job))
+        if job.status == 'failed':
+            return json_response({'success': False, 'error': job.error}, 500)
         logging.info("done and dusted")
-        return jsonify (result)
+        return analysis_response(job.result)
     except Exception as e :
         raise CustomException (e, sys)
-    
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    # submit/poll variant of /analyze for tickers that take long to analyze
+    stock_symbol, stock_type, backend = read_stock_request()
+    if not stock_symbol:
+        return json_response({'success': False, 'error': 'stock_symbol is required'}, 400)
+    if backend not in available_backends():
+        return bad_backend(backend)
+    try:
+        job = jobs.submit(stock_symbol, stock_type, backend)
+    except QueueFullError as e:
+        return busy_response(e)
+    return json_response(job.to_dict(), 202, job_location(job))
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return json_response({'success': False, 'error': f'unknown or expired job {job_id}'}, 404)
+    if not job.done.is_set():
+        return json_response(job.to_dict(), 202, {'Retry-After': str(jobs.retry_after())})
+    return json_response(job.to_dict())
+
+@app.route('/metrics')
+def metrics():
+    # prometheus text exposition; METRICS_ENABLED=0 turns collection and this route off
+    if not REGISTRY.enabled:
+        return Response("metrics are disabled\n", status=404, mimetype='text/plain')
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/analyze/batch', methods=['POST'])
+def analyze_batch():
+    # streams one NDJSON line per symbol as soon as its analysis finishes
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        payload = {}
+    stock_symbols = payload.get('stock_symbols', [])
+    if not isinstance(stock_symbols, list) or not all(isinstance(symbol, str) for symbol in stock_symbols):
+        return jsonify({'success': False, 'error': 'stock_symbols must be a list of strings'}), 400
+    stock_symbols = [symbol.strip().upper() for symbol in stock_symbols if symbol.strip()]
+    stock_type = payload.get('stock_type', 'US')
+    backend = read_backend(payload)
+    if backend not in available_backends():
+        return bad_backend(backend)
+    if not stock_symbols:
+        return jsonify({'success': False, 'error': 'stock_symbols must be a non-empty list'}), 400
+    if len(stock_symbols) > MAX_BATCH_SYMBOLS:
+        return jsonify({'success': False, 'error': f'at most {MAX_BATCH_SYMBOLS} symbols per batch'}), 400
+    logging.info(f"batch analysis of {len(stock_symbols)} symbols")
+
+    def generate():
+        for stock_symbol, sentiment in predictor.predict_many(stock_symbols, stock_type, backend):
+            line = {'stock_symbol': stock_symbol, 'sentiment': sentiment}
+            yield encode_json(line) + b'\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 if __name__ == '__main__':
-    app.run(debug=True) 
\ No newline at end of file
+    # Flask's development server; set FLASK_DEBUG=1 for the reloader and debugger
+    app.run(debug=FLASK_DEBUG, threaded=True) 
\ No newline at end of file
@@ -0,0 +1,45 @@
+import time
+from itertools import islice
+from src.quote_service import Quote
+
+
+class FakeSubreddit:
+    def __init__(self, reddit, name):
+        self.reddit = reddit
+        self.name = name
+
+    def search(self, query, limit=100, sort='new', **generator_kwargs):
+        self.reddit.calls.append((self.name, query, limit))
+        if self.reddit.delay:
+            time.sleep(self.reddit.delay)
+        return islice(self.reddit.posts, limit)
+
+    def new(self, limit=100):
+        return self.search('', limit)
+
+
+class FakeReddit:
+    # stands in for praw.Reddit: every search hands out the next `limit` posts of the corpus,
+    # after `delay` seconds of simulated network time
+    def __init__(self, posts, delay=0.0):
+        self.posts = iter(posts)
+        self.delay = delay
+        self.calls = []
+
+    def subreddit(self, name):
+        return FakeSubreddit(self, name)
+
+
+class FakeQuoteService:
+    def __init__(self, price=100.0, currency='USD', delay=0.0):
+        self.price = price
+        self.currency = currency
+        self.delay = delay
+        self.calls = 0
+
+    def get_quotes(self, symbols):
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        return {symbol.upper(): Quote(symbol=symbol.upper(), current_price=self.price, currency=self.currency)
+                for symbol in symbols}
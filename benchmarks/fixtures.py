@@ -0,0 +1,72 @@
+import json
+import random
+from types import SimpleNamespace
+
+# reddit-like vocabulary: tickers, trading slang, VADER-laden words, links and markdown
+TICKERS = ["AAPL", "TSLA", "NVDA", "AMD", "MSFT", "RCF", "TCS", "INFY", "RELIANCE", "GME"]
+WORDS = ("stock shares calls puts earnings guidance quarter revenue margin dividend buyback valuation market "
+         "holding bought sold selling buying long short squeeze moon rocket crash dip rally breakout support "
+         "resistance chart volume options expiry strike premium portfolio position bag hold the a is are was "
+         "to of and in it this that for on with my i you they we just").split()
+SENTIMENT_WORDS = ("good great amazing love bullish win profit gains strong excellent happy best awesome "
+                   "bad terrible hate bearish loss losses weak awful worst scam fear panic sad angry").split()
+MODIFIERS = ["not", "never", "very", "extremely", "so", "but", "kind of", "barely", "really", "isn't", "don't"]
+DECORATIONS = ["!", "?", "!!", "...", " :)", " :(", " 🚀", " https://example.com/chart.png",
+               " [DD](https://reddit.com/r/stocks/comments/abc)", " 100%", " $"]
+SUBREDDITS = ["stocks", "investing", "wallstreetbets", "IndianStockMarket", "IndianStreetBets"]
+START_UTC = 1735689600  # 2025-01-01
+
+
+def make_post(rng, index):
+    ticker = rng.choice(TICKERS)
+    body = []
+    for _ in range(rng.randint(0, 160)):
+        roll = rng.random()
+        if roll < 0.12:
+            body.append(rng.choice(SENTIMENT_WORDS))
+        elif roll < 0.17:
+            body.append(rng.choice(MODIFIERS))
+        elif roll < 0.20:
+            body.append(rng.choice(TICKERS))
+        else:
+            body.append(rng.choice(WORDS))
+        if rng.random() < 0.04:
+            body[-1] += rng.choice(DECORATIONS)
+    title = f"{ticker} {' '.join(rng.choices(WORDS + SENTIMENT_WORDS, k=rng.randint(3, 12)))}"
+    if rng.random() < 0.3:
+        title = title.upper()
+    return SimpleNamespace(
+        id=f"b{index:07d}",
+        title=title,
+        selftext=" ".join(body),
+        score=int(rng.paretovariate(1.2)) - 1,
+        created_utc=float(START_UTC + index * 37 + rng.randint(0, 3600)),
+        permalink=f"/r/stocks/comments/b{index:07d}/post/",
+        subreddit=SimpleNamespace(display_name=rng.choice(SUBREDDITS)),
+    )
+
+
+def generate_posts(size, seed=0):
+    # deterministic: the same size and seed always yield the same corpus
+    rng = random.Random(seed)
+    for index in range(size):
+        yield make_post(rng, index)
+
+
+def write_jsonl(path, posts):
+    with open(path, 'w') as f:
+        for post in posts:
+            f.write(json.dumps({
+                'id': post.id, 'title': post.title, 'selftext': post.selftext, 'score': post.score,
+                'created_utc': post.created_utc, 'permalink': post.permalink,
+                'subreddit': post.subreddit.display_name,
+            }) + '\n')
+
+
+def read_jsonl(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                record['subreddit'] = SimpleNamespace(display_name=record['subreddit'])
+                yield SimpleNamespace(**record)
@@ -0,0 +1,103 @@
+# Load test of the Flask app against stubbed Reddit and quote sources.
+#
+#   python -m benchmarks.load_test --clients 32 --duration 30 --reddit-delay 0.3
+#
+# The app is served by werkzeug's threaded server on a local port, every client posts /analyze
+# in a loop and the report shows the status codes and the latency percentiles of the answers.
+# With the job queue in front of the pipeline the p99 of 200s is bounded by the queue depth
+# however many clients are added, the overflow is answered with 503 and Retry-After instead.
+# Clients and server share one process here, so past a few dozen clients the numbers also
+# include their contention for the GIL.
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+from itertools import cycle
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("NLTK_AUTO_DOWNLOAD", "0")
+os.environ.setdefault("POST_CACHE_DIR", tempfile.mkdtemp(prefix="load_test_cache_"))
+
+import numpy as np
+import requests
+from werkzeug.serving import make_server
+
+from benchmarks.fakes import FakeQuoteService, FakeReddit
+from benchmarks.fixtures import generate_posts
+from src.post_sources import PostSources, RedditClients, RedditSearchSource
+
+
+def run_client(url, symbols, deadline):
+    session = requests.Session()
+    samples = []
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        response = session.post(f'{url}/analyze', data={'stock_symbol': random.choice(symbols), 'stock_type': 'US'})
+        samples.append((response.status_code, time.perf_counter() - start))
+        if response.status_code == 503:
+            # a real client would honour Retry-After, the load test only backs off briefly
+            time.sleep(min(float(response.headers.get('Retry-After', 1)), 0.5))
+    return samples
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test /analyze against stubbed data sources")
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=20.0, help="seconds")
+    parser.add_argument('--symbols', type=int, default=200, help="distinct tickers the clients ask for")
+    parser.add_argument('--reddit-delay', type=float, default=0.2, help="simulated seconds per reddit search")
+    parser.add_argument('--quote-delay', type=float, default=0.05, help="simulated seconds per quote request")
+    parser.add_argument('--result-cache', action='store_true', help="keep the sentiment/price result caches on")
+    parser.add_argument('--workers', type=int, help="JOB_WORKERS for the app")
+    parser.add_argument('--queue-size', type=int, help="JOB_QUEUE_SIZE for the app")
+    parser.add_argument('--port', type=int, default=5055)
+    args = parser.parse_args(argv)
+
+    # the job queue reads its size from the environment when app is imported
+    if args.workers:
+        os.environ["JOB_WORKERS"] = str(args.workers)
+    if args.queue_size:
+        os.environ["JOB_QUEUE_SIZE"] = str(args.queue_size)
+    import app as server
+    corpus = list(generate_posts(10000))
+    # one reddit search source without the configured rate limit, the load test measures the app
+    server.predictor.sources = PostSources([RedditSearchSource(
+        'reddit', 'stocks', RedditClients(lambda: FakeReddit(cycle(corpus), delay=args.reddit_delay)))])
+    server.yf_data.quote_service = FakeQuoteService(delay=args.quote_delay)
+    if not args.result_cache:
+        for cache in (server.sentiment_cache, server.stock_data_cache):
+            cache.ttl = cache.grace = 0
+
+    httpd = make_server('127.0.0.1', args.port, server.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{args.port}'
+    symbols = [f'T{i:04d}' for i in range(args.symbols)]
+
+    started = time.monotonic()
+    deadline = started + args.duration
+    with ThreadPoolExecutor(max_workers=args.clients) as clients:
+        futures = [clients.submit(run_client, url, symbols, deadline) for _ in range(args.clients)]
+        samples = [sample for future in futures for sample in future.result()]
+    elapsed = time.monotonic() - started
+    job_stats = server.jobs.stats()
+    httpd.shutdown()
+    server.jobs.shutdown()
+
+    statuses = Counter(status for status, _ in samples)
+    print(f"{args.clients} clients, {elapsed:.1f}s, {len(samples)} requests, "
+          f"{statuses.get(200, 0) / elapsed:.1f} analyses/s")
+    print("status codes: " + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items())))
+    for status in sorted(statuses):
+        latencies = np.array([latency for code, latency in samples if code == status]) * 1000
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(f"  {status}: p50 {p50:.0f} ms, p95 {p95:.0f} ms, p99 {p99:.0f} ms, max {latencies.max():.0f} ms")
+    print(f"job queue: {job_stats}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
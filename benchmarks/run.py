@@ -0,0 +1,172 @@
+# Offline benchmark of the sentiment pipeline.
+#
+#   python -m benchmarks.run --sizes 100,10000,1000000
+#   python -m benchmarks.run --save-baseline benchmarks/baseline.json
+#   python -m benchmarks.run --baseline benchmarks/baseline.json --threshold 0.15
+#
+# The corpus is split into requests of --request-size posts, the way /analyze sees them. Every
+# stage is timed per request: throughput is rows per second over the whole corpus and p50/p99
+# are per-request latencies. PRAW and yfinance are replaced by the fakes in benchmarks/fakes.py,
+# and NLTK corpora must already be installed locally, nothing is downloaded.
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+from itertools import islice
+
+os.environ.setdefault("NLTK_AUTO_DOWNLOAD", "0")
+
+import numpy as np
+
+from benchmarks.fakes import FakeQuoteService, FakeReddit
+from benchmarks.fixtures import generate_posts, read_jsonl
+from src.get_reddit_data import YfData
+from src.post_sources import PostSources, RedditClients, RedditSearchSource
+from src.post_batch import full_text
+from src.post_cache import PostCache
+from src.post_dedup import NearDuplicateFilter
+from src.sentiment_history import SentimentHistory
+from src.predict import Predict
+
+STAGES = ['fetch', 'clean', 'vader', 'quality_filter', 'sentiment', 'trend', 'quote', 'pipeline']
+
+
+def chunks(posts, size):
+    posts = iter(posts)
+    while True:
+        chunk = list(islice(posts, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def peak_rss_mib():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def run_request(predictor, yf_data, reddit, posts, timings):
+    sentiment_analysis = predictor.sentiment_analysis
+
+    def timed(stage, function):
+        start = time.perf_counter()
+        value = function()
+        timings[stage].append(time.perf_counter() - start)
+        return value
+
+    reddit.posts = iter(posts)
+    frame = timed('fetch', lambda: predictor.sources.fetch('BENCH', 'US', limit=len(posts)))
+    cleaned = timed('clean', lambda: predictor.cleaner.clean_batch(full_text(frame)))
+    scores = timed('vader', lambda: sentiment_analysis.polarity_scores_batch(cleaned))
+    scored = frame.assign(full_text=cleaned, **{col: scores[col] for col in scores.columns})
+    filtered = timed('quality_filter', lambda: sentiment_analysis.filter_low_quality_posts(scored))
+    filtered = timed('sentiment', lambda: filtered.assign(
+        sentiment=sentiment_analysis.sentiment_scores(filtered)).assign(
+        sentiment_category=lambda df: sentiment_analysis.categorize_sentiments(df['sentiment'])))
+    timed('trend', lambda: sentiment_analysis.analyze_trend(filtered))
+    timed('quote', lambda: yf_data.get_yf_data('BENCH'))
+    reddit.posts = iter(posts)
+    timed('pipeline', lambda: predictor.predict('BENCH', 'US'))
+
+
+def run_size(size, request_size, repeat, corpus=None, seed=0):
+    timings = {stage: [] for stage in STAGES}
+    rows = 0
+    yf_data = YfData(quote_service=FakeQuoteService())
+    for _ in range(repeat):
+        # fresh caches each round, so the pipeline stage always scores every post
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # one fake client for every source thread, each request swaps its posts in
+            reddit = FakeReddit(())
+            sources = PostSources([RedditSearchSource('bench', 'stocks', RedditClients(lambda: reddit))])
+            predictor = Predict(post_cache=PostCache(cache_dir, max_entries=size + 1), sources=sources,
+                                history=SentimentHistory(cache_dir), deduper=NearDuplicateFilter(cache_dir))
+            posts = islice(read_jsonl(corpus), size) if corpus else generate_posts(size, seed)
+            for request in chunks(posts, request_size):
+                run_request(predictor, yf_data, reddit, request, timings)
+                rows += len(request)
+            predictor.post_cache.close()
+            predictor.close()
+    result = {'rows': rows, 'requests': len(timings['pipeline']), 'peak_rss_mib': round(peak_rss_mib(), 1), 'stages': {}}
+    for stage, samples in timings.items():
+        samples = np.array(samples)
+        result['stages'][stage] = {
+            'rows_per_s': round(rows / samples.sum(), 1) if samples.sum() > 0 else None,
+            'p50_ms': round(float(np.percentile(samples, 50)) * 1000, 3),
+            'p99_ms': round(float(np.percentile(samples, 99)) * 1000, 3),
+            'total_s': round(float(samples.sum()), 4),
+        }
+    return result
+
+
+def compare(results, baseline, threshold):
+    # a stage regresses when its throughput drops, or its p99 grows, by more than `threshold`
+    regressions = []
+    for size, result in results['sizes'].items():
+        base = baseline.get('sizes', {}).get(size)
+        if base is None:
+            continue
+        for stage, current in result['stages'].items():
+            previous = base['stages'].get(stage)
+            if previous is None:
+                continue
+            if previous['rows_per_s'] and current['rows_per_s'] < previous['rows_per_s'] * (1 - threshold):
+                regressions.append(f"{size} rows / {stage}: {current['rows_per_s']:,.0f} rows/s "
+                                   f"vs baseline {previous['rows_per_s']:,.0f}")
+            if current['p99_ms'] > previous['p99_ms'] * (1 + threshold):
+                regressions.append(f"{size} rows / {stage}: p99 {current['p99_ms']:.2f} ms "
+                                   f"vs baseline {previous['p99_ms']:.2f} ms")
+    return regressions
+
+
+def print_report(results):
+    for size, result in results['sizes'].items():
+        print(f"\n{size} rows, {result['requests']} requests, peak RSS {result['peak_rss_mib']} MiB")
+        print(f"{'stage':<16}{'rows/s':>14}{'p50 ms':>12}{'p99 ms':>12}{'total s':>12}")
+        for stage, stats in result['stages'].items():
+            print(f"{stage:<16}{stats['rows_per_s'] or 0:>14,.0f}{stats['p50_ms']:>12.3f}"
+                  f"{stats['p99_ms']:>12.3f}{stats['total_s']:>12.3f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the sentiment pipeline")
+    parser.add_argument('--sizes', default='100,10000', help="comma separated corpus sizes, e.g. 100,10000,1000000")
+    parser.add_argument('--request-size', type=int, default=100, help="posts per simulated /analyze request")
+    parser.add_argument('--repeat', type=int, default=3, help="passes over each corpus")
+    parser.add_argument('--corpus', help="replay posts from a JSONL file instead of the generated fixture")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', help="baseline JSON to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument('--save-baseline', help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    results = {
+        'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                 'request_size': args.request_size, 'repeat': args.repeat},
+        'sizes': {},
+    }
+    for size in (int(size) for size in args.sizes.split(',')):
+        results['sizes'][str(size)] = run_size(size, args.request_size, args.repeat, args.corpus, args.seed)
+    print_report(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nbaseline written to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("\nregressions:\n  " + "\n  ".join(regressions))
+            return 1
+        print("\nno regressions against the baseline")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+import json
+import math
+import gzip
+import hashlib
+from dataclasses import dataclass, field
+import numpy as np
+import pandas as pd
+
+try:
+    # optional, several times faster than json and encodes numpy arrays natively
+    import orjson
+except ImportError:
+    orjson = None
+
+# responses smaller than this are sent uncompressed, gzip would not pay for itself
+GZIP_MIN_BYTES = 1024
+
+
+def finite_or_none(value):
+    # NaN and inf are not JSON, they go on the wire as null
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+@dataclass(slots=True)
+class TopPost:
+    title: str
+    score: int
+    sentiment: float
+    subreddit: str
+    url: str
+
+    def to_dict(self):
+        return {'title': self.title, 'score': self.score, 'sentiment': finite_or_none(self.sentiment),
+                'subreddit': self.subreddit, 'url': self.url}
+
+
+@dataclass(slots=True)
+class Trend:
+    trend: str
+    current_sentiment: float
+    # parallel arrays: UTC midnight of each day in epoch seconds, and that day's moving average
+    # (nan where its window has no posts)
+    days: np.ndarray = field(default_factory=lambda: np.empty(0, dtype='int64'))
+    moving_avg: np.ndarray = field(default_factory=lambda: np.empty(0, dtype='float64'))
+
+    @classmethod
+    def from_analysis(cls, analysis):
+        # the dict of SentimentAnalysis.analyze_trend or SentimentHistory.trend
+        series = analysis['moving_avg']
+        if len(series) and isinstance(series.index, pd.DatetimeIndex):
+            days = series.index.as_unit('s').asi8
+        else:
+            days = np.empty(0, dtype='int64')
+        return cls(analysis['trend'], float(analysis['current_sentiment']), days,
+                   series.to_numpy(dtype='float64') if len(days) else np.empty(0, dtype='float64'))
+
+    def moving_avg_series(self):
+        index = pd.to_datetime(self.days, unit='s')
+        index.name = 'date'
+        return pd.Series(self.moving_avg, index=index, name='sentiment')
+
+    def to_dict(self):
+        values = self.moving_avg.astype(object)
+        values[~np.isfinite(self.moving_avg)] = None
+        return {'trend': self.trend, 'current_sentiment': finite_or_none(self.current_sentiment),
+                'moving_avg': {'epoch': self.days.tolist(), 'value': values.tolist()}}
+
+
+@dataclass(slots=True)
+class SentimentResult:
+    # a successful analysis; failures stay {'success': False, 'error': ...} dicts
+    stock_symbol: str
+    sentiment: float
+    tendency: dict
+    post_count: int
+    top_posts: list
+    trend: Trend
+    success: bool = True
+
+    def top_posts_frame(self):
+        return pd.DataFrame([post.to_dict() for post in self.top_posts],
+                            columns=['title', 'score', 'sentiment', 'subreddit', 'url'])
+
+    def to_dict(self):
+        # the wire format, with the keys the front ends have always read
+        return {
+            'Success': True,
+            'stock_symbol': self.stock_symbol,
+            'Sentiment': finite_or_none(self.sentiment),
+            'Tendency': self.tendency,
+            'post count': self.post_count,
+            'Top Post': [post.to_dict() for post in self.top_posts],
+            'Trend': self.trend.to_dict(),
+        }
+
+
+def succeeded(result):
+    # SentimentResult, or a dict without success=False (stock data, results stored before SentimentResult)
+    if isinstance(result, dict):
+        return result.get('success', True)
+    return bool(getattr(result, 'success', False))
+
+
+def to_json_default(value):
+    # values json cannot encode on its own: typed results, and pandas/numpy values of older dicts
+    if isinstance(value, (SentimentResult, Trend, TopPost)):
+        return value.to_dict()
+    if isinstance(value, pd.Series):
+        return {str(key): item for key, item in value.items()}
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def finite_json(value):
+    # the payload with NaN and inf replaced by null at any depth, as orjson writes them
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: finite_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [finite_json(item) for item in value]
+    if value is None or isinstance(value, (str, int)):
+        return value
+    return finite_json(to_json_default(value))
+
+
+def encode_json(payload):
+    # compact UTF-8 JSON bytes; orjson when it is installed
+    if orjson is not None:
+        # dataclasses go through to_json_default too, orjson would otherwise dump their fields
+        return orjson.dumps(payload, default=to_json_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATACLASS)
+    try:
+        return json.dumps(payload, default=to_json_default, separators=(',', ':'), allow_nan=False).encode('utf-8')
+    except ValueError:
+        # a bare NaN (a price in stock_data, say) is not JSON; only then is the payload walked
+        return json.dumps(finite_json(payload), separators=(',', ':'), allow_nan=False).encode('utf-8')
+
+
+def etag_of(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def gzip_body(body, accept_encoding):
+    # (body, compressed) for a client's Accept-Encoding header
+    if len(body) < GZIP_MIN_BYTES or 'gzip' not in (accept_encoding or ''):
+        return body, False
+    return gzip.compress(body, compresslevel=5), True
+
+
+if __name__=="__main__":
+    # payload size and encode time of a result with 90 days of trend: the old dict with a pandas
+    # Series through json's default hook, against SentimentResult
+    import time
+    import random
+
+    random.seed(0)
+    index = pd.date_range('2025-01-01', periods=90, freq='D', name='date')
+    moving_avg = pd.Series([random.uniform(-1, 1) if i >= 6 else float('nan') for i in range(90)], index=index)
+    top_posts = [{'title': f"TSLA post {i} " * 5, 'score': 1000 - i, 'sentiment': random.uniform(-1, 1),
+                  'subreddit': 'stocks', 'url': f'https://reddit.com/r/stocks/comments/p{i}/'} for i in range(5)]
+    tendency = {'very positive': 40, 'poistive': 12, 'neutral': 9, 'negetive': 7, 'Very negetive': 20}
+    old = {'Success': True, 'stock_symbol': 'TSLA', 'Sentiment': np.float64(0.21), 'Tendency': tendency,
+           'post count': 100, 'Top Post': top_posts,
+           'Trend': {'trend': 'Bullish', 'moving_avg': moving_avg, 'current_sentiment': np.float64(moving_avg.iloc[-1])}}
+    new = SentimentResult('TSLA', 0.21, tendency, 100, [TopPost(**post) for post in top_posts],
+                          Trend.from_analysis(old['Trend']))
+
+    def timed(function, repeat=2000):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            body = function()
+        return body, (time.perf_counter() - start) / repeat * 1e6
+
+    cases = [
+        ('dict + json default hook', lambda: json.dumps(old, default=to_json_default).encode('utf-8')),
+        ('SentimentResult + json', lambda: json.dumps(new.to_dict(), separators=(',', ':')).encode('utf-8')),
+    ]
+    if orjson is not None:
+        cases.append(('SentimentResult + orjson', lambda: orjson.dumps(new.to_dict())))
+    for name, function in cases:
+        body, micros = timed(function)
+        print(f"{name:<26} {len(body):>6} bytes, {len(gzip.compress(body, 5)):>5} gzipped, {micros:7.1f} us")
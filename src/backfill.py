@@ -0,0 +1,268 @@
+# Backfill of sentiment history from local reddit dumps (JSONL, or zstd compressed like the
+# pushshift archives), beyond the 100 posts a search returns.
+#
+#   python -m src.backfill RS_2024-01.zst RS_2024-02.zst --out backfill/ --watchlist watchlist.json
+#   python -m src.backfill posts.jsonl --out backfill/ --symbols TSLA,AAPL --processes 8
+#
+# Lines are read in chunks of --chunk-size and routed, cleaned and scored in a process pool, with
+# at most two chunks per process in flight, so memory stays flat however large the input is.
+# Every chunk writes posts/part-N.parquet (the scored posts, one row per post and symbol it
+# mentions) and daily/part-N.parquet, then records its input offset in checkpoint.json; a rerun
+# resumes after the last finished chunk. daily.parquet combines the daily parts at the end.
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import resource
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from src.logger import logging, setup_worker_logging
+from src.exception import CustomException
+from src.text_cleaning import TextCleaner
+from src.sentiment_analysis import SentimentAnalysis, SENTIMENT_BACKEND
+from src.sentiment_history import CATEGORIES, CATEGORY_COLUMNS, utc_days, EPOCH_ORDINAL
+from src.symbol_router import SymbolRouter
+from src.post_batch import POST_COLUMNS, POST_DTYPES, full_text
+
+BACKFILL_CHUNK_SIZE = int(os.getenv("BACKFILL_CHUNK_SIZE", 20000))
+# pushshift archives are compressed with a 2 GiB window (zstd --long=31)
+ZSTD_MAX_WINDOW = 2**31
+POST_OUTPUT_COLUMNS = ['stock_symbol', 'post_id', 'created_utc', 'subreddit', 'score', 'title', 'url',
+                       'compound', 'quality_score', 'sentiment', 'sentiment_category']
+REMOVED_TEXTS = ('[removed]', '[deleted]')
+
+
+def open_dump(path):
+    # a binary stream of the decompressed lines
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise CustomException(ImportError(f"reading {path} needs the zstandard package"), sys)
+        reader = zstandard.ZstdDecompressor(max_window_size=ZSTD_MAX_WINDOW).stream_reader(open(path, 'rb'))
+        return io.BufferedReader(reader, buffer_size=1 << 20)
+    return open(path, 'rb', buffering=1 << 20)
+
+
+def skip_to(stream, path, offset):
+    # plain files seek, a zstd stream is decompressed and discarded up to the offset
+    if not offset:
+        return
+    if not path.endswith('.zst'):
+        stream.seek(offset)
+        return
+    remaining = offset
+    while remaining:
+        skipped = len(stream.read(min(remaining, 1 << 24)))
+        if not skipped:
+            break
+        remaining -= skipped
+
+
+def read_chunks(path, offset=0, chunk_size=BACKFILL_CHUNK_SIZE):
+    # yields (end offset, chunk of raw lines as one bytes object); offsets count decompressed bytes
+    with open_dump(path) as stream:
+        skip_to(stream, path, offset)
+        lines = []
+        for line in stream:
+            lines.append(line)
+            offset += len(line)
+            if len(lines) >= chunk_size:
+                yield offset, b''.join(lines)
+                lines = []
+        if lines:
+            yield offset, b''.join(lines)
+
+
+def parse_post(line):
+    # a submission (title/selftext) or a comment (body) of a dump, as a POST_COLUMNS tuple
+    try:
+        post = json.loads(line)
+    except ValueError:
+        return None
+    if 'id' not in post or 'created_utc' not in post:
+        return None
+    text = post.get('selftext', post.get('body')) or ''
+    if text in REMOVED_TEXTS:
+        text = ''
+    permalink = post.get('permalink') or ''
+    return (str(post['id']), post.get('title') or '', text, int(post.get('score') or 0), int(float(post['created_utc'])),
+            f'https://reddit.com{permalink}' if permalink else '', post.get('subreddit') or '')
+
+
+def daily_aggregates(scored):
+    # per symbol and UTC day: post count, sentiment sum and the count of each category
+    categories = pd.get_dummies(pd.Categorical(scored['sentiment_category'], categories=CATEGORIES)).to_numpy(dtype='int64')
+    frame = pd.DataFrame(categories, columns=CATEGORY_COLUMNS, index=scored.index)
+    frame.insert(0, 'stock_symbol', scored['stock_symbol'].astype(str))
+    frame.insert(1, 'day', utc_days(scored['created_utc']))
+    frame.insert(2, 'post_count', 1)
+    frame.insert(3, 'sentiment_sum', scored['sentiment'].to_numpy())
+    return frame.groupby(['stock_symbol', 'day'], as_index=False, sort=False).sum()
+
+
+# per-process state of the backfill pool
+_worker = {}
+
+def _init_backfill_worker(symbols, aliases, backend):
+    setup_worker_logging()
+    _worker['router'] = SymbolRouter(symbols, aliases)
+    _worker['cleaner'] = TextCleaner()
+    _worker['sentiment_analysis'] = SentimentAnalysis()
+    _worker['backend'] = backend
+
+
+def score_chunk(chunk):
+    # raw dump lines to (scored posts, daily aggregates, lines read); every post is cleaned and
+    # scored once, however many symbols it mentions
+    router, sentiment_analysis = _worker['router'], _worker['sentiment_analysis']
+    posts, mentions = [], []
+    lines = chunk.splitlines()
+    for line in lines:
+        post = parse_post(line)
+        if post is not None:
+            symbols = router.route(f"{post[1]} {post[2]}")
+            if symbols:
+                posts.append(post)
+                mentions.append(sorted(symbols))
+    if not posts:
+        return None, None, len(lines)
+    frame = pd.DataFrame(posts, columns=POST_COLUMNS)
+    cleaned = _worker['cleaner'].clean_batch(full_text(frame))
+    scores = sentiment_analysis.polarity_scores_batch(cleaned, _worker['backend'])
+    frame = frame.assign(full_text=cleaned.to_numpy(), **{col: scores[col].to_numpy() for col in scores.columns})
+    filtered = sentiment_analysis.filter_low_quality_posts(frame)
+    if filtered.empty:
+        return None, None, len(lines)
+    scored = sentiment_analysis.add_sentiment(filtered)
+    # one row per (post, symbol it mentions); the frame's index is the position in posts
+    kept = filtered.index.to_numpy()
+    scored = scored.iloc[np.repeat(np.arange(len(scored)), [len(mentions[position]) for position in kept])]
+    scored.insert(0, 'stock_symbol', [symbol for position in kept for symbol in mentions[position]])
+    scored = scored.astype({key: value for key, value in POST_DTYPES.items() if key in scored.columns})
+    return scored[POST_OUTPUT_COLUMNS].reset_index(drop=True), daily_aggregates(scored), len(lines)
+
+
+class Checkpoint:
+    # finished input offsets and the next part number, rewritten atomically after every chunk
+    def __init__(self, path):
+        self.path = path
+        self.state = {'inputs': {}, 'next_part': 0}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def input(self, path):
+        return self.state['inputs'].setdefault(os.path.abspath(path), {'offset': 0, 'lines': 0, 'done': False})
+
+    def save(self):
+        temporary = f"{self.path}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(temporary, self.path)
+
+
+def finish_daily(out_dir):
+    # the daily parts summed into daily.parquet, with the mean sentiment per day
+    daily_dir = os.path.join(out_dir, 'daily')
+    parts = sorted(os.listdir(daily_dir)) if os.path.isdir(daily_dir) else []
+    if not parts:
+        return None
+    daily = pd.concat([pd.read_parquet(os.path.join(daily_dir, part)) for part in parts], ignore_index=True)
+    daily = daily.groupby(['stock_symbol', 'day'], as_index=False).sum().sort_values(['stock_symbol', 'day'])
+    daily.insert(2, 'date', pd.to_datetime(daily['day'] - EPOCH_ORDINAL, unit='D').dt.date)
+    daily['mean_sentiment'] = daily['sentiment_sum'] / daily['post_count']
+    daily = daily.drop(columns='day').reset_index(drop=True)
+    daily.to_parquet(os.path.join(out_dir, 'daily.parquet'), index=False)
+    return daily
+
+
+def backfill(paths, out_dir, symbols, aliases=None, processes=None, chunk_size=BACKFILL_CHUNK_SIZE,
+             backend=SENTIMENT_BACKEND):
+    try:
+        processes = processes or os.cpu_count() or 1
+        for sub_dir in ('posts', 'daily'):
+            os.makedirs(os.path.join(out_dir, sub_dir), exist_ok=True)
+        checkpoint = Checkpoint(os.path.join(out_dir, 'checkpoint.json'))
+        start = time.perf_counter()
+        totals = {'lines': 0, 'rows': 0}
+
+        def write(progress, offset, result):
+            scored, daily, lines = result
+            part = checkpoint.state['next_part']
+            if scored is not None:
+                scored.to_parquet(os.path.join(out_dir, 'posts', f'part-{part:06d}.parquet'), index=False)
+                daily.to_parquet(os.path.join(out_dir, 'daily', f'part-{part:06d}.parquet'), index=False)
+                checkpoint.state['next_part'] = part + 1
+                totals['rows'] += len(scored)
+            progress['offset'] = offset
+            progress['lines'] += lines
+            totals['lines'] += lines
+            checkpoint.save()
+            elapsed = time.perf_counter() - start
+            logging.info(f"backfill: {totals['lines']} posts read, {totals['rows']} scored rows, "
+                         f"{totals['lines'] / elapsed / processes:,.0f} posts/s per core")
+
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_backfill_worker,
+                                 initargs=(list(symbols), aliases or {}, backend)) as pool:
+            for path in paths:
+                progress = checkpoint.input(path)
+                if progress['done']:
+                    logging.info(f"backfill: {path} is already done")
+                    continue
+                # oldest first, so the checkpoint only ever moves past finished chunks
+                inflight = deque()
+                for offset, chunk in read_chunks(path, progress['offset'], chunk_size):
+                    inflight.append((offset, pool.submit(score_chunk, chunk)))
+                    if len(inflight) >= 2 * processes:
+                        offset, future = inflight.popleft()
+                        write(progress, offset, future.result())
+                while inflight:
+                    offset, future = inflight.popleft()
+                    write(progress, offset, future.result())
+                progress['done'] = True
+                checkpoint.save()
+        daily = finish_daily(out_dir)
+        elapsed = time.perf_counter() - start
+        summary = {'posts': totals['lines'], 'rows': totals['rows'], 'seconds': round(elapsed, 2),
+                   'posts_per_s': round(totals['lines'] / elapsed, 1),
+                   'posts_per_s_per_core': round(totals['lines'] / elapsed / processes, 1),
+                   'processes': processes, 'days': 0 if daily is None else len(daily),
+                   # ru_maxrss is KiB on Linux; the reader, and the largest worker, the pool has been joined by now
+                   'peak_rss_mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                   'peak_worker_rss_mib': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)}
+        logging.info(f"backfill finished: {summary}")
+        return summary
+    except Exception as e:
+        raise CustomException(e,sys)
+
+
+if __name__=="__main__":
+    from src.scheduler import load_watchlist, WATCHLIST_FILE
+    from src.logger import setup_logging
+
+    parser = argparse.ArgumentParser(description="Score local reddit dumps into per-symbol Parquet files")
+    parser.add_argument('inputs', nargs='+', help=".jsonl or .zst files, one post or comment per line")
+    parser.add_argument('--out', required=True, help="output directory, also holds checkpoint.json")
+    parser.add_argument('--symbols', help="comma separated symbols, instead of the watchlist")
+    parser.add_argument('--watchlist', default=WATCHLIST_FILE, help="symbols and their aliases")
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=BACKFILL_CHUNK_SIZE, help="lines per chunk")
+    parser.add_argument('--backend', default=SENTIMENT_BACKEND)
+    args = parser.parse_args()
+    setup_logging()
+
+    if args.symbols:
+        symbols, aliases = [symbol.strip().upper() for symbol in args.symbols.split(',') if symbol.strip()], {}
+    else:
+        items = load_watchlist(args.watchlist)
+        symbols, aliases = [item.stock_symbol for item in items], {item.stock_symbol: item.aliases for item in items}
+    summary = backfill(args.inputs, args.out, symbols, aliases, args.processes, args.chunk_size, args.backend)
+    print(f"{summary['posts']} posts in {summary['seconds']}s: {summary['posts_per_s']:,.0f} posts/s, "
+          f"{summary['posts_per_s_per_core']:,.0f} posts/s per core on {summary['processes']} processes, "
+          f"{summary['rows']} scored rows over {summary['days']} symbol days, peak RSS {summary['peak_rss_mib']} MiB "
+          f"(reader), {summary['peak_worker_rss_mib']} MiB (largest worker)")
@@ -2,22 +2,66 @@ import sys
 
 def get_error_details(error,error_details:sys):
     _,_,exc_tb=error_details.exc_info()
-    script_name=exc_tb.tb_frame.f_code.co_filename
-    error_line=exc_tb.tb_lineno
-    error_message="Error is in python script name [{0}], in line numer [{1}] with error message [{2}] ".format(
+    script_name,error_line=error_location(exc_tb, error)
+    return format_error(script_name,error_line,error)
+
+def error_location(exc_tb, error):
+    # the frame that caught the error; raised outside an except block, the error's own traceback
+    # or, failing that, the caller of CustomException
+    exc_tb = exc_tb or getattr(error, '__traceback__', None)
+    if exc_tb is not None:
+        return exc_tb.tb_frame.f_code.co_filename, exc_tb.tb_lineno
+    frame = sys._getframe(2)
+    return frame.f_code.co_filename, frame.f_lineno
+
+def format_error(script_name,error_line,error):
+    return "Error is in python script name [{0}], in line numer [{1}] with error message [{2}] ".format(
         script_name,error_line,str(error))
-    return error_message
 
 class CustomException(Exception):
+    # only where the error was caught is read when wrapping; the message is built the first time
+    # it is asked for, most wrapped errors are re-raised or logged once and some never printed
     def __init__(self, error_message, error_details:sys):
         super().__init__(error_message)
-        self.error_message = get_error_details(error_message,error_details=error_details)
+        self.error = error_message
+        self.script_name,self.error_line = error_location(error_details.exc_info()[2], error_message)
+        self._error_message = None
+
+    @property
+    def error_message(self):
+        if self._error_message is None:
+            self._error_message = format_error(self.script_name,self.error_line,self.error)
+        return self._error_message
+
     def __str__(self):
         return self.error_message
-    
+
+    def __reduce__(self):
+        # pickled without error_details, so an error raised in a process pool worker reaches the parent
+        return _restore_custom_exception, (self.error, self.script_name, self.error_line)
+
+def _restore_custom_exception(error, script_name, error_line):
+    exception = CustomException.__new__(CustomException)
+    Exception.__init__(exception, error)
+    exception.error = error
+    exception.script_name,exception.error_line = script_name,error_line
+    exception._error_message = None
+    return exception
+
 if __name__=="__main__":
+    import timeit
+    # cost of wrapping an error, against building the message up front as before
+    def wrap(eager):
+        try:
+            1/0
+        except Exception as e:
+            error = CustomException(e,sys)
+            if eager:
+                str(error)
+    for eager in (True, False):
+        seconds = timeit.timeit(lambda: wrap(eager), number=100000) / 100000
+        print(f"{'eager' if eager else 'lazy'}: {seconds * 1e6:.2f} us per wrap")
     try:
         a=1/0
     except Exception as e:
         raise CustomException(e,sys)
-        
\ No newline at end of file
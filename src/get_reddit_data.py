@@ -1,97 +1,157 @@
 import os
 import sys
-import time
 import pandas as pd
-import praw
-import yfinance as yf
-from datetime import datetime
 from src.logger import logging
 from src.exception import CustomException
+from src.quote_service import QuoteService
+from src.metrics import stage_timer
+from src.post_batch import frame_from_records, frame_from_submissions
 from dotenv import load_dotenv
-from requests.exceptions import HTTPError
 
 
 load_dotenv()
 
 
+MARKETS = ('US', 'India')
+
+
+def normalize_stock_type(stock_type, markets=MARKETS):
+    # front ends send 'India', 'india', 'US', 'USA', ...; markets come from the sources config,
+    # anything unknown searches the US subreddits (the first market when there is no US)
+    wanted = str(stock_type).strip().lower()
+    for market in markets:
+        if market.lower() == wanted:
+            return market
+    return 'US' if 'US' in markets else markets[0]
+
+
 class RedditData:
-    def __init__(self):
-        self.reddit = praw.Reddit(
+    def __init__(self, reddit=None, post_store=None, incremental_page_size=25, timeout=None):
+        # reddit and post_store can be swapped for fakes in tests
+        if reddit is None:
+            import praw
+            # timeout bounds every HTTP request praw makes, in seconds
+            reddit = praw.Reddit(
                      client_id=os.getenv("REDDIT_CLIENT_ID"),
                      client_secret=os.getenv("REDDIT_SECRET_ID"),
-                     user_agent=os.getenv("REDDIT_USER_AGENT"))
-        
-    
-    def get_reddit_data(self, stock_symbol:str, stock_type:str,limit=100,max_try=3):
-        logging.info("creating search query to search reddit")
+                     user_agent=os.getenv("REDDIT_USER_AGENT"),
+                     **({'timeout': timeout} if timeout else {}))
+        self.reddit = reddit
+        self.post_store = post_store
+        self.incremental_page_size = incremental_page_size
+
+    def get_subreddits(self, stock_type):
+        if stock_type=="India":
+            return "IndianStockMarket+IndianStreetBets+IndiaInvestments"
+        return 'stocks+investing+wallstreetbets'
+
+    def post_record(self, post):
+        return (post.id, post.title, post.selftext, post.score, post.created_utc,
+                f'https://reddit.com{post.permalink}', post.subreddit.display_name)
+
+    def get_reddit_data(self, stock_symbol:str, stock_type:str,limit=100,max_try=3,incremental=False):
+        return self.search(stock_symbol, self.get_subreddits(stock_type), limit, incremental)
+
+    def search(self, stock_symbol, subreddit, limit=100, incremental=False, query='{symbol} stock'):
+        # subreddit is one name or several joined with '+'
+        logging.debug(f"searching r/{subreddit} for {stock_symbol}")
         try:
-            if stock_type=="India":
-                subreddit="IndianStockMarket+IndianStreetBets+IndiaInvestments"
-            else:
-                subreddit='stocks+investing+wallstreetbets'
-            data=[]
-            result=self.reddit.subreddit(subreddit).search(f'{stock_symbol} stock',limit=limit,sort='new')
-            logging.info("reddit search is done")
-            for post in result:
-                
-                    full_text=f"{post.title} {post.selftext}"
-                    data.append({
-                        'stock_symbol': stock_symbol,
-                        'title':post.title,
-                        'text':post.selftext,
-                        'score': post.score,
-                        'full_text': full_text,
-                        'created_utc': datetime.fromtimestamp(post.created_utc).strftime('%Y-%m-%d %H:%M:%S'),
-                        'url': f'https://reddit.com{post.permalink}',
-                        'subreddit': post.subreddit.display_name
-                    })
-            data=pd.DataFrame(data)
-            logging.info("reddit search result is done")
+            if incremental and self.post_store is not None:
+                return self.get_new_reddit_data(stock_symbol, subreddit, limit, query)
+            result=self.reddit.subreddit(subreddit).search(query.format(symbol=stock_symbol),limit=limit,sort='new')
+            data = frame_from_submissions(stock_symbol, result)
+            logging.debug(f"reddit search found {len(data)} posts for {stock_symbol}")
             return data
             
         except Exception as e:
             raise CustomException(e,sys)
 
+    def get_subreddit_posts(self, stock_symbol, subreddit, limit=100, mentions=None):
+        # the newest `limit` posts of a subreddit, only those `mentions` accepts; catches posts
+        # of small subreddits that name the ticker without matching the search query
+        try:
+            posts = self.reddit.subreddit(subreddit).new(limit=limit)
+            if mentions is not None:
+                posts = (post for post in posts if mentions(f"{post.title} {post.selftext}"))
+            return frame_from_submissions(stock_symbol, posts)
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def get_new_posts(self, subreddit, limit=100, watermark=None):
+        # the subreddit's new-post listing as POST_COLUMNS tuples, newest first, down to the
+        # (created_utc, post_id) watermark of the previous call
+        try:
+            new_posts = []
+            for post in self.reddit.subreddit(subreddit).new(limit=limit):
+                if watermark is not None and (post.id == watermark[1] or post.created_utc < watermark[0]):
+                    break
+                new_posts.append(self.post_record(post))
+            return new_posts
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def get_new_reddit_data(self, stock_symbol, subreddit, limit=100, query='{symbol} stock'):
+        # pages through sort='new' results only until the newest post stored by the previous call,
+        # then answers from the persisted store
+        watermark = self.post_store.get_watermark(stock_symbol, subreddit)
+        generator_kwargs = {}
+        if watermark is not None:
+            # small pages, so a quiet ticker costs one small request instead of a full 100 post page
+            generator_kwargs['request_limit'] = self.incremental_page_size
+        result = self.reddit.subreddit(subreddit).search(
+            query.format(symbol=stock_symbol), limit=limit, sort='new', **generator_kwargs)
+        new_posts = []
+        for post in result:
+            if watermark is not None and (post.id == watermark[1] or post.created_utc < watermark[0]):
+                break
+            new_posts.append(self.post_record(post))
+        logging.info(f"incremental reddit search found {len(new_posts)} new posts for {stock_symbol}")
+        self.post_store.add_posts(stock_symbol, subreddit, new_posts)
+        stored = self.post_store.load_posts(stock_symbol, subreddit, limit)
+        return frame_from_records(stock_symbol, stored.itertuples(index=False, name=None))
+
 
 class YfData:
-    def __init__(self):
-        pass
-    def get_yf_data(self, stock_symbol, max_retries=5, retry_delay=5):
-        logging.info("get yf data")
-        for attempt in range (max_retries):
-            try:
-                if attempt > 0:
-                    time.sleep(retry_delay)
-                stock = yf.Ticker(stock_symbol)
-                try:
-                    current_price = stock.info.get('currentPrice')
-                    if current_price is None:
-                        raise ValueError ("No current price is found")
-                    return {
-                        'stock_data':
-                        {
-                          'current price': current_price,
-                          'currency': stock.info.get('currency', 'INR')
-                        }
-                    }
-                except HTTPError as e:
-                    if e.response.status_code == 429:
-                        print(f"Rate limit hit, attempt {attempt + 1} of {max_retries}")
-                        if attempt == max_retries - 1:
-                            raise ValueError("Rate limit exceeded. Please try again later.")
-                        continue
-                    raise
-                
-            except Exception as e:
-                print(f"Error fetching stock data (attempt {attempt + 1}): {str(e)}")
-                if attempt == max_retries - 1:
-                    return {
-                        'success': False,
-                        'error': f"Failed to fetch stock data for {stock_symbol} after {max_retries} attempts: {str(e)}"
-                    }
-                continue 
-
-                
+    def __init__(self, quote_service=None):
+        self.quote_service = quote_service or QuoteService()
+
+    def format_quote(self, stock_symbol, quote):
+        if quote is None or quote.current_price is None:
+            return {
+                'success': False,
+                'error': f"No current price is found for {stock_symbol}"
+            }
+        return {
+            'stock_data':
+            {
+              'current price': quote.current_price,
+              'currency': quote.currency
+            }
+        }
+
+    def get_yf_data(self, stock_symbol):
+        logging.debug(f"get yf data for {stock_symbol}")
+        return self.get_yf_data_many([stock_symbol])[stock_symbol]
+
+    def get_yf_data_many(self, stock_symbols):
+        # one bulk quote request per batch of symbols instead of a Ticker.info call per symbol
+        try:
+            with stage_timer('yfinance_fetch') as stage:
+                quotes = self.quote_service.get_quotes(stock_symbols)
+                stage.rows = len(quotes)
+        except Exception as e:
+            logging.error(f"Error fetching stock data for {stock_symbols}: {e}")
+            return {
+                stock_symbol: {
+                    'success': False,
+                    'error': f"Failed to fetch stock data for {stock_symbol}: {str(e)}"
+                }
+                for stock_symbol in stock_symbols
+            }
+        return {stock_symbol: self.format_quote(stock_symbol, quotes.get(stock_symbol.upper()))
+                for stock_symbol in stock_symbols}
+
+
 
 if __name__=="__main__":
     stock_type='India'
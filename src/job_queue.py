@@ -0,0 +1,143 @@
+import os
+import time
+import uuid
+import queue
+import threading
+import contextvars
+from collections import OrderedDict
+from src.logger import logging
+from src.metrics import JOB_EVENTS, STAGE_SECONDS
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 8))
+# jobs waiting for a worker; a queued job waits about JOB_QUEUE_SIZE / JOB_WORKERS service times
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 2 * JOB_WORKERS))
+# finished jobs can be polled for this many seconds
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", 600))
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"job queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Job:
+    __slots__ = ('id', 'key', 'status', 'result', 'error', 'submitted_at', 'started_at', 'finished_at', 'done', 'context')
+
+    def __init__(self, key):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+        # the submitter's context, so the job logs under its request id
+        self.context = contextvars.copy_context()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def to_dict(self):
+        job = {'job_id': self.id, 'status': self.status}
+        if self.status == 'done':
+            job['result'] = self.result
+        elif self.status == 'failed':
+            job['error'] = self.error
+        return job
+
+
+class JobQueue:
+    # a bounded queue in front of a fixed pool of worker threads; submit() refuses work instead
+    # of letting requests pile up, and identical queued or running jobs are shared
+    def __init__(self, handler, max_queued=JOB_QUEUE_SIZE, workers=JOB_WORKERS, result_ttl=JOB_RESULT_TTL, name='analyze'):
+        self.handler = handler
+        self.name = name
+        self.workers = workers
+        self.result_ttl = result_ttl
+        self._queue = queue.Queue(maxsize=max_queued)
+        # every pollable job by id; the finished ones also in _finished, in the order they finished
+        self._jobs = {}
+        self._finished = OrderedDict()
+        self._active = {}
+        self._lock = threading.Lock()
+        # moving average of the handler's run time, used for Retry-After
+        self._service_time = 1.0
+        self._threads = [threading.Thread(target=self._work, name=f"{name}-worker-{i}", daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, *args):
+        with self._lock:
+            self._expire()
+            job = self._active.get(args)
+            if job is not None:
+                JOB_EVENTS.inc(1, self.name, 'coalesced')
+                return job
+            job = Job(args)
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                JOB_EVENTS.inc(1, self.name, 'rejected')
+                raise QueueFullError(self._retry_after())
+            self._active[args] = job
+            self._jobs[job.id] = job
+            JOB_EVENTS.inc(1, self.name, 'submitted')
+            return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    def retry_after(self):
+        with self._lock:
+            return self._retry_after()
+
+    def _retry_after(self):
+        # time for the workers to drain what is queued now, in whole seconds
+        return max(1, round(self._service_time * (self._queue.qsize() + 1) / self.workers))
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._finished:
+            job = next(iter(self._finished.values()))
+            if now - job.finished_at < self.result_ttl:
+                break
+            self._finished.popitem(last=False)
+            self._jobs.pop(job.id, None)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.started_at = time.monotonic()
+            STAGE_SECONDS.observe(job.started_at - job.submitted_at, f'{self.name}_queue_wait')
+            job.status = 'running'
+            try:
+                job.result = job.context.run(self.handler, *job.key)
+                job.status = 'done'
+            except Exception as e:
+                logging.error(f"job {job.id} {job.key} failed: {e}")
+                job.error = str(e)
+                job.status = 'failed'
+            job.finished_at = time.monotonic()
+            with self._lock:
+                self._service_time = 0.8 * self._service_time + 0.2 * (job.finished_at - job.started_at)
+                self._active.pop(job.key, None)
+                self._finished[job.id] = job
+            JOB_EVENTS.inc(1, self.name, job.status)
+            job.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {'queued': self._queue.qsize(), 'active': len(self._active), 'jobs': len(self._jobs),
+                    'workers': self.workers, 'service_time': round(self._service_time, 3)}
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._queue.put(None)
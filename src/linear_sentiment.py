@@ -0,0 +1,188 @@
+import os
+import sys
+import time
+import argparse
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from src.logger import logging
+from src.exception import CustomException
+
+LINEAR_MODEL_PATH = os.getenv("LINEAR_MODEL_PATH", os.path.join("models", "linear_sentiment.joblib"))
+MODEL_VERSION = 2
+CLASSES = np.array(['negative', 'neutral', 'positive'])
+# numeric labels are read like VADER's compound: below -0.05 negative, above 0.05 positive
+NEUTRAL_BAND = 0.05
+
+
+def word_ngrams(max_ngram):
+    # TextCleaner output is lowercased and space separated already, so tokens are a plain split;
+    # sklearn's regex tokenizer would cost more than the model itself
+    if max_ngram == 1:
+        return str.split
+
+    def analyzer(text):
+        tokens = text.split()
+        grams = list(tokens)
+        for n in range(2, max_ngram + 1):
+            grams.extend(' '.join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+        return grams
+    return analyzer
+
+
+def make_vectorizer(n_features, max_ngram):
+    # stateless, so only its parameters are persisted with the model
+    from sklearn.feature_extraction.text import HashingVectorizer
+    return HashingVectorizer(n_features=n_features, analyzer=word_ngrams(max_ngram), alternate_sign=False,
+                             norm='l2', dtype=np.float32)
+
+
+class LinearSentimentModel:
+    # hashed word n-grams and a three class linear model over TextCleaner output: a batch is
+    # scored with one sparse matrix product. Returns VADER's (neg, neu, pos, compound) columns,
+    # the class probabilities and pos - neg, so it can stand in for VaderScorer.score_batch
+    def __init__(self, weights, intercept, n_features, max_ngram=1):
+        # weights is (n_features, 3), the transposed coef_ of the classifier
+        self.weights = weights
+        self.intercept = intercept
+        self.n_features = n_features
+        self.max_ngram = max_ngram
+        self.vectorizer = make_vectorizer(n_features, max_ngram)
+
+    def logits(self, features):
+        return np.asarray(features @ self.weights, dtype=np.float64) + self.intercept
+
+    def predict(self, texts):
+        return CLASSES[self.logits(self.vectorizer.transform(texts)).argmax(axis=1)]
+
+    def score_batch(self, texts):
+        logits = self.logits(self.vectorizer.transform(texts))
+        logits -= logits.max(axis=1, keepdims=True)
+        probabilities = np.exp(logits)
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        scores = np.empty((len(probabilities), 4), dtype=np.float64)
+        scores[:, :3] = probabilities
+        scores[:, 3] = probabilities[:, 2] - probabilities[:, 0]
+        return scores
+
+    def save(self, path):
+        import joblib
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # plain arrays rather than a pickled estimator, so load() can memory-map them
+        joblib.dump({'version': MODEL_VERSION, 'weights': np.ascontiguousarray(self.weights),
+                     'intercept': self.intercept, 'n_features': self.n_features,
+                     'max_ngram': self.max_ngram}, path)
+        logging.info(f"linear sentiment model saved to {path}")
+
+    @classmethod
+    def load(cls, path=LINEAR_MODEL_PATH, mmap_mode='r'):
+        # memory-mapped, every worker process shares the same pages of the coefficient matrix
+        import joblib
+        try:
+            data = joblib.load(path, mmap_mode=mmap_mode)
+            if data['version'] != MODEL_VERSION:
+                raise ValueError(f"{path} is a version {data['version']} model, expected {MODEL_VERSION}")
+            return cls(data['weights'], np.asarray(data['intercept']), data['n_features'], data['max_ngram'])
+        except Exception as e:
+            raise CustomException(e,sys)
+
+
+@lru_cache(maxsize=None)
+def get_linear_model(path=LINEAR_MODEL_PATH):
+    return LinearSentimentModel.load(path)
+
+
+def label_classes(labels):
+    # 'negative'/'neutral'/'positive' (any case), or numbers such as -1/0/1 or compound scores
+    numeric = pd.to_numeric(labels, errors='coerce')
+    if numeric.notna().all():
+        return np.where(numeric < -NEUTRAL_BAND, 'negative', np.where(numeric > NEUTRAL_BAND, 'positive', 'neutral'))
+    classes = labels.astype(str).str.strip().str.lower().to_numpy()
+    unknown = set(classes) - set(CLASSES)
+    if unknown:
+        raise ValueError(f"unknown labels {sorted(unknown)[:5]}, expected {list(CLASSES)} or numbers")
+    return classes
+
+
+def iter_labelled(paths, text_column, label_column, chunk_size):
+    for path in paths:
+        for chunk in pd.read_csv(path, usecols=[text_column, label_column], chunksize=chunk_size):
+            chunk = chunk.dropna()
+            yield chunk[text_column].astype(str), label_classes(chunk[label_column])
+
+
+def train(paths, text_column='text', label_column='label', n_features=2**20, max_ngram=1, epochs=5,
+          alpha=1e-6, chunk_size=50000, test_fraction=0.1, seed=0):
+    # streams the CSVs in chunks through TextCleaner into an SGD logistic regression, so the
+    # training set does not have to fit in memory; every 1/test_fraction-th row is held out
+    from sklearn.linear_model import SGDClassifier
+    from src.text_cleaning import TextCleaner
+    try:
+        cleaner = TextCleaner()
+        vectorizer = make_vectorizer(n_features, max_ngram)
+        classifier = SGDClassifier(loss='log_loss', alpha=alpha, random_state=seed)
+        holdout_every = int(round(1 / test_fraction)) if test_fraction else 0
+        held_out = []
+        for epoch in range(epochs):
+            seen = 0
+            for texts, labels in iter_labelled(paths, text_column, label_column, chunk_size):
+                features = vectorizer.transform(cleaner.clean_batch(texts).tolist())
+                test = (np.arange(seen, seen + len(labels)) % holdout_every == 0) if holdout_every else np.zeros(len(labels), bool)
+                seen += len(labels)
+                if epoch == 0 and test.any():
+                    held_out.append((features[test], labels[test]))
+                classifier.partial_fit(features[~test], labels[~test], classes=CLASSES)
+            logging.info(f"linear sentiment training: epoch {epoch + 1}/{epochs} over {seen} rows")
+        model = LinearSentimentModel(classifier.coef_.T.astype(np.float32), classifier.intercept_.astype(np.float64),
+                                     n_features, max_ngram)
+        if held_out:
+            correct = sum(int((CLASSES[model.logits(features).argmax(axis=1)] == labels).sum())
+                          for features, labels in held_out)
+            total = sum(len(labels) for _, labels in held_out)
+            logging.info(f"linear sentiment held out accuracy: {correct / total:.3f} on {total} rows")
+            print(f"held out accuracy: {correct / total:.3f} on {total} rows")
+        return model
+    except Exception as e:
+        raise CustomException(e,sys)
+
+
+def benchmark(model, texts):
+    # posts per second of both backends on the same cleaned texts
+    from src.sentiment_analysis import get_vader_scorer
+    results = {}
+    for name, score_batch in (('vader', get_vader_scorer().score_batch), ('linear', model.score_batch)):
+        start = time.perf_counter()
+        score_batch(texts)
+        elapsed = time.perf_counter() - start
+        results[name] = len(texts) / elapsed
+        print(f"{name}: {len(texts) / elapsed:,.0f} posts/s")
+    return results
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Train or benchmark the linear sentiment backend")
+    commands = parser.add_subparsers(dest='command', required=True)
+    train_parser = commands.add_parser('train', help="fit on labelled CSV files")
+    train_parser.add_argument('csv', nargs='+')
+    train_parser.add_argument('--text-column', default='text')
+    train_parser.add_argument('--label-column', default='label')
+    train_parser.add_argument('--out', default=LINEAR_MODEL_PATH)
+    train_parser.add_argument('--n-features', type=int, default=2**20)
+    train_parser.add_argument('--max-ngram', type=int, default=1)
+    train_parser.add_argument('--epochs', type=int, default=5)
+    train_parser.add_argument('--alpha', type=float, default=1e-6)
+    train_parser.add_argument('--test-fraction', type=float, default=0.1)
+    bench_parser = commands.add_parser('bench', help="posts/s of the linear model against VADER")
+    bench_parser.add_argument('csv', nargs='+')
+    bench_parser.add_argument('--text-column', default='text')
+    bench_parser.add_argument('--model', default=LINEAR_MODEL_PATH)
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        model = train(args.csv, args.text_column, args.label_column, args.n_features, args.max_ngram,
+                      args.epochs, args.alpha, test_fraction=args.test_fraction)
+        model.save(args.out)
+    else:
+        from src.text_cleaning import TextCleaner
+        texts = pd.concat([pd.read_csv(path, usecols=[args.text_column])[args.text_column] for path in args.csv])
+        benchmark(LinearSentimentModel.load(args.model), TextCleaner().clean_batch(texts.astype(str)).tolist())
@@ -1,17 +1,249 @@
-import logging
 import os
-from datetime import datetime
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+import contextvars
+import multiprocessing.util
+from contextlib import contextmanager
+
+LOG_DIR = os.getenv("LOG_DIR", "log")
+LOG_FILE = os.getenv("LOG_FILE", "app.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# 'json' (one object per line) or 'text', the old "[ time ] name - level - message" lines
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+# the file rolls over at this size or after this many seconds, whichever comes first (0 turns either off)
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 50 * 2**20))
+LOG_ROTATE_SECONDS = int(os.getenv("LOG_ROTATE_SECONDS", 24 * 3600))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 7))
+# fraction of DEBUG records kept, per-post debug logs would otherwise dominate the file
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", 0.01))
+# remove the root handlers others installed before setup_logging (Flask, Streamlit, pytest keep theirs otherwise)
+LOG_REPLACE_HANDLERS = os.getenv("LOG_REPLACE_HANDLERS", "0") == "1"
+TEXT_FORMAT = "[ %(asctime)s ] %(name)s - %(levelname)s - %(message)s"
+
+# set per HTTP request (or job), copied onto every record logged while it is set
+REQUEST_ID = contextvars.ContextVar('request_id', default=None)
+# attributes every LogRecord has; anything else on a record came in through extra={...}
+RECORD_FIELDS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+# records of debug_sampled(), already sampled by the time they are built
+SAMPLED_LOGGER = logging.getLogger('sampled')
+
+
+def debug_sampled(message, *args, **kwargs):
+    # for DEBUG records logged per post: the sample is drawn before the LogRecord is built, so a
+    # dropped call costs one random(). Pass %-style args, an f-string would still be formatted
+    if random.random() < LOG_DEBUG_SAMPLE_RATE:
+        SAMPLED_LOGGER.debug(message, *args, **kwargs)
+
+
+@contextmanager
+def request_context(request_id):
+    token = REQUEST_ID.set(request_id)
+    try:
+        yield request_id
+    finally:
+        REQUEST_ID.reset(token)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        if record.request_id is not None:
+            entry['request_id'] = record.request_id
+        # extra fields such as stage, seconds and rows
+        for key, value in record.__dict__.items():
+            if key not in RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z"
+
+
+class RecordContext(logging.Filter):
+    # runs in the thread that logs: tags the record with the request id and keeps a sample of
+    # DEBUG records, so dropped ones never reach the queue. Those of debug_sampled() are kept
+    def __init__(self, debug_sample_rate=LOG_DEBUG_SAMPLE_RATE):
+        super().__init__()
+        self.debug_sample_rate = debug_sample_rate
+
+    def filter(self, record):
+        if (record.levelno <= logging.DEBUG and record.name != SAMPLED_LOGGER.name
+                and random.random() >= self.debug_sample_rate):
+            return False
+        record.request_id = REQUEST_ID.get()
+        return True
+
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    # the writer thread formats and writes; the caller only merges the message arguments and
+    # renders a traceback, the two things that cannot wait for another thread. The record is
+    # not copied, this is the only handler that sees it
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RotatingLogHandler(logging.handlers.RotatingFileHandler):
+    # RotatingFileHandler that also rolls over every rotate_seconds; backups are app.log.1, .2, ...
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT,
+                 rotate_seconds=LOG_ROTATE_SECONDS):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.rotate_seconds = rotate_seconds
+        self.rollover_at = time.time() + rotate_seconds if rotate_seconds else None
 
-LOG_FILE_NAME = f"{datetime.now().strftime('%m_%d_%Y_%H_%M_%S')}.log"
-LOG_DIR = "log"
-os.makedirs(LOG_DIR,exist_ok=True)
-log_file_path = os.path.join(LOG_DIR,LOG_FILE_NAME)
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
 
-logging.basicConfig(
-    filename=log_file_path,
-    format = "[ %(asctime)s ] %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
+    def doRollover(self):
+        super().doRollover()
+        if self.rotate_seconds:
+            self.rollover_at = time.time() + self.rotate_seconds
+
+
+class LogPipeline:
+    # root logger -> QueueLogHandler -> queue -> one writer thread -> file. Logging costs the
+    # caller a queue put; formatting, the write and rotation happen on the writer thread.
+    def __init__(self, path, level=LOG_LEVEL, log_format=LOG_FORMAT, rotate=True, replace_handlers=LOG_REPLACE_HANDLERS):
+        self.path = path
+        self.level = level
+        self.log_format = log_format
+        self.rotate = rotate
+        self.replace_handlers = replace_handlers
+        self.listener = None
+        self.queue_handler = None
+
+    def file_handler(self):
+        if self.rotate:
+            handler = RotatingLogHandler(self.path)
+        else:
+            # worker processes append to the file the main process rotates, and reopen it after a rollover
+            handler = logging.handlers.WatchedFileHandler(self.path, encoding='utf-8', delay=True)
+        handler.setFormatter(JsonFormatter() if self.log_format == 'json' else logging.Formatter(TEXT_FORMAT))
+        return handler
+
+    def start(self):
+        log_queue = queue.SimpleQueue()
+        self.queue_handler = QueueLogHandler(log_queue)
+        self.queue_handler.addFilter(RecordContext())
+        root = logging.getLogger()
+        if self.replace_handlers:
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+        root.addHandler(self.queue_handler)
+        root.setLevel(self.level)
+        self.listener = logging.handlers.QueueListener(log_queue, self.file_handler())
+        self.listener.start()
+        if not self.rotate:
+            # pool workers leave through os._exit, past atexit; multiprocessing still runs its finalizers
+            multiprocessing.util.Finalize(self, self.stop, exitpriority=0)
+        return self
+
+    def stop(self):
+        # drains the queue; records logged after this are dropped
+        if self.listener is not None:
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+        logging.getLogger().removeHandler(self.queue_handler)
+
+
+log_file_path = os.path.join(LOG_DIR,LOG_FILE)
+PIPELINE = None
+
+
+def setup_logging(replace_handlers=LOG_REPLACE_HANDLERS):
+    # called once by the entry points (app.py, streamlit_app.py, the scheduler and backfill CLIs);
+    # importing this module configures nothing
+    global PIPELINE
+    if PIPELINE is None:
+        os.makedirs(LOG_DIR,exist_ok=True)
+        PIPELINE = LogPipeline(log_file_path, replace_handlers=replace_handlers).start()
+        atexit.register(PIPELINE.stop)
+    return PIPELINE
+
+
+def setup_worker_logging():
+    # process pool initializer. A forked worker inherits the parent's queue handler but not the
+    # thread that drains it: it appends through its own pipeline, the parent rotates the file
+    global PIPELINE
+    if PIPELINE is None:
+        return None
+    logging.getLogger().removeHandler(PIPELINE.queue_handler)
+    PIPELINE = LogPipeline(log_file_path, rotate=False).start()
+    return PIPELINE
 
 if __name__=="__main__":
-    logging.info("loging has started")
+    # caller-side cost of a log call from 1 and 8 threads: the old synchronous file handler
+    # against the queue pipeline, and a DEBUG call sampled by the filter or before the record
+    import tempfile
+    import threading
+
+    calls = 20000
+    directory = tempfile.mkdtemp()
+
+    def run(label, log, threads):
+        latencies = []
+
+        def worker(thread):
+            local = []
+            for i in range(calls // threads):
+                start = time.perf_counter()
+                log(f"thread {thread} scored post {i}: compound 0.4215", stage='score', seconds=0.0012)
+                local.append(time.perf_counter() - start)
+            latencies.extend(local)
+
+        # threads copy the caller's context, so their records carry its request id
+        workers = [threading.Thread(target=contextvars.copy_context().run, args=(worker, thread))
+                   for thread in range(threads)]
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        print(f"{label:<16} {threads} threads: p50 {latencies[len(latencies) // 2] * 1e6:5.1f} us, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:7.1f} us, {calls / elapsed:>9,.0f} calls/s")
+
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.setLevel(logging.INFO)
+    blocking = logging.FileHandler(os.path.join(directory, 'blocking.log'))
+    blocking.setFormatter(logging.Formatter(TEXT_FORMAT))
+    root.addHandler(blocking)
+    for threads in (1, 8):
+        run('synchronous file', lambda message, **extra: logging.info(message, extra=extra), threads)
+    root.removeHandler(blocking)
+    blocking.close()
+
+    pipeline = LogPipeline(os.path.join(directory, 'queued.log'), level='DEBUG').start()
+    with request_context('bench'):
+        for threads in (1, 8):
+            run('queue + json', lambda message, **extra: logging.info(message, extra=extra), threads)
+            run('filtered debug', lambda message, **extra: logging.debug(message, extra=extra), threads)
+            run('debug_sampled', lambda message, **extra: debug_sampled(message, extra=extra), threads)
+    pipeline.stop()
+    with open(os.path.join(directory, 'queued.log')) as f:
+        lines = f.readlines()
+    print(f"{len(lines)} records written, last: {lines[-1].strip()}")
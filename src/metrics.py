@@ -0,0 +1,195 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+from src.logger import logging, debug_sampled
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# stages slower than this are logged at INFO, faster ones go to the sampled DEBUG records
+STAGE_SLOW_SECONDS = float(os.getenv("STAGE_SLOW_SECONDS", 1.0))
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, registry, name, help_text, label_names=()):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    # a value that goes up and down, such as calls running right now
+    def dec(self, amount=1, *label_values):
+        self.inc(-amount, *label_values)
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, registry, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # per label set: [count per bucket (+Inf last), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        if not self.registry.enabled:
+            return
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    labels = _format_labels(self.label_names, label_values, [('le', _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.label_names, label_values)
+                lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class StageTimer:
+    # `with stage_timer('clean') as stage: ...; stage.rows = len(df)`
+    __slots__ = ('stage', 'rows', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.rows = None
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        STAGE_SECONDS.observe(seconds, self.stage)
+        # the histogram has every stage; the log keeps the slow ones and a sample of the rest
+        if seconds >= STAGE_SLOW_SECONDS:
+            logging.info("slow stage %s took %.1f ms", self.stage, seconds * 1000,
+                         extra={'stage': self.stage, 'seconds': round(seconds, 6), 'rows': self.rows})
+        else:
+            debug_sampled("stage %s took %.1f ms", self.stage, seconds * 1000,
+                          extra={'stage': self.stage, 'seconds': round(seconds, 6), 'rows': self.rows})
+        if self.rows is not None:
+            STAGE_ROWS.inc(self.rows, self.stage)
+        if exc_type is not None:
+            STAGE_ERRORS.inc(1, self.stage)
+        return False
+
+
+class _NoopTimer:
+    __slots__ = ('rows',)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class MetricsRegistry:
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self._metrics = []
+
+    def counter(self, name, help_text, label_names=()):
+        metric = Counter(self, name, help_text, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, label_names=()):
+        metric = Gauge(self, name, help_text, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(self, name, help_text, label_names, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram('stock_trend_stage_seconds', 'Latency of each pipeline stage in seconds', ['stage'])
+STAGE_ROWS = REGISTRY.counter('stock_trend_stage_rows_total', 'Rows processed by each pipeline stage', ['stage'])
+STAGE_ERRORS = REGISTRY.counter('stock_trend_stage_errors_total', 'Pipeline stages that raised', ['stage'])
+CACHE_EVENTS = REGISTRY.counter('stock_trend_cache_events_total', 'Cache lookups by cache and outcome', ['cache', 'event'])
+JOB_EVENTS = REGISTRY.counter('stock_trend_job_events_total', 'Background jobs by queue and outcome', ['queue', 'event'])
+CALL_TIMEOUTS = REGISTRY.counter('stock_trend_call_timeouts_total', 'Analysis calls past their deadline, cancelled or left running', ['call', 'outcome'])
+OVERDUE_CALLS = REGISTRY.gauge('stock_trend_overdue_calls', 'Analysis calls still running past a deadline', ['call'])
+_NOOP_TIMER = _NoopTimer()
+
+
+def stage_timer(stage):
+    if not REGISTRY.enabled:
+        return _NOOP_TIMER
+    return StageTimer(stage)
+
+
+if __name__=="__main__":
+    # per-stage overhead with metrics on and off, logging to the file as the app does
+    from src.logger import setup_logging
+
+    setup_logging()
+    iterations = 100000
+    for enabled in (True, False):
+        REGISTRY.enabled = enabled
+        start = time.perf_counter()
+        for _ in range(iterations):
+            with stage_timer('benchmark') as stage:
+                stage.rows = 100
+        elapsed = time.perf_counter() - start
+        print(f"metrics {'on' if enabled else 'off'}: {elapsed / iterations * 1e6:.2f} us per stage")
@@ -0,0 +1,167 @@
+import os
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from src.logger import logging
+from src.metrics import STAGE_SECONDS, CALL_TIMEOUTS, OVERDUE_CALLS
+from src.get_reddit_data import normalize_stock_type
+from src.result_store import RESULT_STORE_MAX_AGE, sentiment_kind
+from src.analysis_result import succeeded
+
+SENTIMENT_TIMEOUT = float(os.getenv("SENTIMENT_TIMEOUT", 60))
+STOCK_DATA_TIMEOUT = float(os.getenv("STOCK_DATA_TIMEOUT", 15))
+
+
+class AnalysisOrchestrator:
+    # runs the reddit/NLP pipeline and the price fetch side by side, so a request takes
+    # as long as the slower of the two instead of their sum
+    def __init__(self, predictor, yf_data, sentiment_cache=None, stock_data_cache=None,
+                 sentiment_timeout=SENTIMENT_TIMEOUT, stock_data_timeout=STOCK_DATA_TIMEOUT, max_workers=8,
+                 use_process_pool=False, result_store=None, store_max_age=RESULT_STORE_MAX_AGE):
+        self.predictor = predictor
+        self.yf_data = yf_data
+        # stock types the predictor's post sources are configured for
+        self.markets = predictor.sources.markets
+        self.sentiment_cache = sentiment_cache
+        self.stock_data_cache = stock_data_cache
+        self.sentiment_timeout = sentiment_timeout
+        self.stock_data_timeout = stock_data_timeout
+        # score posts in the predictor's process pool instead of the calling thread
+        self.use_process_pool = use_process_pool
+        # results the scheduler published ahead of time, shared with the other front ends
+        self.result_store = result_store
+        self.store_max_age = store_max_age
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analyze")
+        # (call, arguments) -> [future, waiting requests, past a deadline]: requests for a symbol whose
+        # call is still running, maybe past an earlier request's deadline, wait on it instead of taking
+        # another pool thread
+        self._calls = {}
+        self._calls_lock = threading.Lock()
+
+    def _stored(self, kind, stock_symbol, stock_type):
+        if self.result_store is None:
+            return None
+        return self.result_store.get(stock_symbol, stock_type, kind, max_age=self.store_max_age)
+
+    def _publish(self, kind, stock_symbol, stock_type, value):
+        # failures are not published, the next request retries them
+        if self.result_store is not None and succeeded(value):
+            self.result_store.put(stock_symbol, stock_type, kind, value)
+        return value
+
+    def lookup(self, stock_symbol, stock_type, backend=None):
+        # counts the request for the scheduler's priorities and returns the published analysis,
+        # or None when either side is missing or too old
+        stock_type = normalize_stock_type(stock_type, self.markets)
+        if self.result_store is None:
+            return None
+        self.result_store.record_request(stock_symbol, stock_type)
+        sentiment = self._stored(sentiment_kind(backend), stock_symbol, stock_type)
+        stock_data = self._stored('stock_data', stock_symbol, stock_type) if sentiment is not None else None
+        if stock_data is None:
+            return None
+        return {'stock_symbol': stock_symbol, 'sentiment': sentiment, 'stock_data': stock_data}
+
+    def get_sentiment(self, stock_symbol, stock_type, backend=None):
+        kind = sentiment_kind(backend)
+        stored = self._stored(kind, stock_symbol, stock_type)
+        if stored is not None:
+            return stored
+        predict = self.predictor.predict_pooled if self.use_process_pool else self.predictor.predict
+        compute = lambda: self._publish(kind, stock_symbol, stock_type, predict(stock_symbol, stock_type, backend))
+        if self.sentiment_cache is None:
+            return compute()
+        return self.sentiment_cache.get_or_compute((stock_symbol, stock_type, kind), compute)
+
+    def get_stock_data(self, stock_symbol, stock_type):
+        stored = self._stored('stock_data', stock_symbol, stock_type)
+        if stored is not None:
+            return stored
+        compute = lambda: self._publish('stock_data', stock_symbol, stock_type, self.yf_data.get_yf_data(stock_symbol))
+        if self.stock_data_cache is None:
+            return compute()
+        return self.stock_data_cache.get_or_compute((stock_symbol, stock_type), compute)
+
+    def _submit(self, name, function, *args):
+        key = (name, args)
+        with self._calls_lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call[1] += 1
+                return key, call[0]
+            # each call runs in a copy of this context, keeping the request id in the pool threads
+            future = self.executor.submit(contextvars.copy_context().run, function, *args)
+            self._calls[key] = [future, 1, False]
+        future.add_done_callback(lambda future: self._call_done(key, future))
+        return key, future
+
+    def _call_done(self, key, future):
+        with self._calls_lock:
+            call = self._calls.get(key)
+            if call is None or call[0] is not future:
+                return
+            del self._calls[key]
+
+    def _timed_out(self, key, future):
+        # a call nobody else waits for is cancelled if it has not started; one that is running
+        # cannot be stopped, it is counted until it finishes. Cancelling runs the done callbacks,
+        # so it happens outside the lock
+        with self._calls_lock:
+            call = self._calls.get(key)
+            if call is None or call[0] is not future:
+                return
+            sole = call[1] == 1
+            if sole:
+                del self._calls[key]
+        if sole and future.cancel():
+            CALL_TIMEOUTS.inc(1, key[0], 'cancelled')
+            return
+        CALL_TIMEOUTS.inc(1, key[0], 'running')
+        with self._calls_lock:
+            if sole and not future.done():
+                call = self._calls.setdefault(key, call)
+            overdue = call[0] is future and not call[2]
+            if overdue:
+                call[2] = True
+        if overdue:
+            OVERDUE_CALLS.inc(1, key[0])
+            future.add_done_callback(lambda future: OVERDUE_CALLS.dec(1, key[0]))
+
+    def _release(self, key, future):
+        with self._calls_lock:
+            call = self._calls.get(key)
+            if call is not None and call[0] is future:
+                call[1] -= 1
+
+    def analyze(self, stock_symbol, stock_type, backend=None):
+        start = time.monotonic()
+        stock_type = normalize_stock_type(stock_type, self.markets)
+        calls = {
+            'sentiment': (self._submit('sentiment', self.get_sentiment, stock_symbol, stock_type, backend),
+                          self.sentiment_timeout),
+            'stock_data': (self._submit('stock_data', self.get_stock_data, stock_symbol, stock_type),
+                           self.stock_data_timeout),
+        }
+        result = {'stock_symbol': stock_symbol}
+        for name, ((key, future), timeout) in calls.items():
+            # both calls started together, so each deadline is measured from the same start
+            remaining = max(0.0, start + timeout - time.monotonic())
+            try:
+                result[name] = future.result(timeout=remaining)
+            except TimeoutError:
+                logging.warning(f"{name} for {stock_symbol} timed out after {timeout}s")
+                self._timed_out(key, future)
+                result[name] = {'success': False, 'error': f'{name} for {stock_symbol} timed out after {timeout}s'}
+            except Exception as e:
+                logging.error(f"{name} for {stock_symbol} failed: {e}")
+                result[name] = {'success': False, 'error': str(e)}
+            finally:
+                self._release(key, future)
+        elapsed = time.monotonic() - start
+        STAGE_SECONDS.observe(elapsed, 'analyze')
+        logging.info(f"analysis of {stock_symbol} took {elapsed:.2f}s")
+        return result
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
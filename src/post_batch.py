@@ -0,0 +1,131 @@
+import sys
+import time
+import pandas as pd
+from src.exception import CustomException
+
+# one post per row; title and text are stored once, full_text is derived when needed
+POST_COLUMNS = ['post_id', 'title', 'text', 'score', 'created_utc', 'url', 'subreddit']
+POST_DTYPES = {
+    'stock_symbol': 'category',
+    'score': 'int64',
+    'created_utc': 'int64',
+    'subreddit': 'category',
+}
+
+
+def build_post_frame(stock_symbol, columns):
+    # columns maps every name in POST_COLUMNS to a list of values, created_utc in epoch seconds
+    try:
+        length = len(columns['post_id'])
+        if length == 0:
+            return pd.DataFrame()
+        frame = pd.DataFrame({
+            'stock_symbol': pd.Categorical([stock_symbol] * length),
+            'title': columns['title'],
+            'text': columns['text'],
+            'score': columns['score'],
+            'created_utc': pd.Series(columns['created_utc'], dtype='float64').astype('int64'),
+            'url': columns['url'],
+            'subreddit': columns['subreddit'],
+            'post_id': columns['post_id'],
+        })
+        return frame.astype(POST_DTYPES)
+    except Exception as e:
+        raise CustomException(e,sys)
+
+
+def frame_from_records(stock_symbol, records):
+    # records are tuples in POST_COLUMNS order, e.g. rows read back from the post store
+    records = list(records)
+    if not records:
+        return pd.DataFrame()
+    return build_post_frame(stock_symbol, dict(zip(POST_COLUMNS, map(list, zip(*records)))))
+
+
+def frame_from_submissions(stock_symbol, submissions):
+    columns = {name: [] for name in POST_COLUMNS}
+    post_id, title, text = columns['post_id'].append, columns['title'].append, columns['text'].append
+    score, created_utc = columns['score'].append, columns['created_utc'].append
+    url, subreddit = columns['url'].append, columns['subreddit'].append
+    for post in submissions:
+        post_id(post.id)
+        title(post.title)
+        text(post.selftext)
+        score(post.score)
+        created_utc(post.created_utc)
+        url(f'https://reddit.com{post.permalink}')
+        subreddit(post.subreddit.display_name)
+    return build_post_frame(stock_symbol, columns)
+
+
+def full_text(posts_df):
+    # raw "title text" of each post, or the cleaned text once Predict has replaced it
+    if 'full_text' in posts_df.columns:
+        return posts_df['full_text']
+    return posts_df['title'] + ' ' + posts_df['text']
+
+
+def created_datetimes(created_utc):
+    # epoch seconds from build_post_frame, or the older '%Y-%m-%d %H:%M:%S' strings
+    if pd.api.types.is_numeric_dtype(created_utc):
+        return pd.to_datetime(created_utc, unit='s')
+    return pd.to_datetime(created_utc)
+
+
+def to_arrow(posts_df):
+    import pyarrow as pa
+    return pa.Table.from_pandas(posts_df, preserve_index=False)
+
+
+def to_parquet(posts_df, path):
+    posts_df.to_parquet(path, index=False)
+
+
+def read_parquet(path):
+    return pd.read_parquet(path).astype(POST_DTYPES)
+
+
+if __name__=="__main__":
+    # memory per 10k posts and construction time, against the old list-of-dicts frame
+    import random
+    from datetime import datetime
+    from types import SimpleNamespace
+
+    random.seed(0)
+    subreddits = [SimpleNamespace(display_name=name) for name in ('stocks', 'investing', 'wallstreetbets')]
+    words = "stock buy sell calls puts earnings moon crash holding shares bullish bearish".split()
+    submissions = [SimpleNamespace(
+        id=f"p{i}", title=" ".join(random.choices(words, k=8)), selftext=" ".join(random.choices(words, k=120)),
+        score=random.randint(0, 500), created_utc=1750000000.0 + i * 60, permalink=f"/r/stocks/comments/p{i}/",
+        subreddit=random.choice(subreddits)) for i in range(10000)]
+
+    start = time.perf_counter()
+    old = pd.DataFrame([{
+        'stock_symbol': 'AAPL',
+        'title': post.title,
+        'text': post.selftext,
+        'score': post.score,
+        'full_text': f"{post.title} {post.selftext}",
+        'created_utc': datetime.fromtimestamp(post.created_utc).strftime('%Y-%m-%d %H:%M:%S'),
+        'url': f'https://reddit.com{post.permalink}',
+        'subreddit': post.subreddit.display_name,
+    } for post in submissions])
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new = frame_from_submissions('AAPL', submissions)
+    new_time = time.perf_counter() - start
+
+    old_mb = old.memory_usage(deep=True).sum() / 2**20
+    new_mb = new.memory_usage(deep=True).sum() / 2**20
+    print(f"list of dicts: {old_mb:.2f} MiB, {old_time * 1000:.1f} ms")
+    print(f"columnar:      {new_mb:.2f} MiB, {new_time * 1000:.1f} ms")
+    try:
+        import io
+        buffer = io.BytesIO()
+        to_parquet(new, buffer)
+        buffer.seek(0)
+        pd.testing.assert_frame_equal(new, read_parquet(buffer))
+        print(f"parquet round trip ok, {buffer.getbuffer().nbytes / 2**20:.2f} MiB on disk")
+    except ImportError:
+        print("pyarrow is not installed, skipping the parquet round trip")
@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import threading
+import pandas as pd
+from src.logger import logging
+from src.exception import CustomException
+from src.post_batch import full_text
+from src.metrics import CACHE_EVENTS
+
+# bump whenever TextCleaner or the VADER scoring changes so stale entries stop matching
+PIPELINE_VERSION = "1"
+CACHE_DIR = os.getenv("POST_CACHE_DIR", "cache")
+SCORE_COLUMNS = ['full_text', 'neg', 'neu', 'pos', 'compound']
+
+
+class PostCache:
+    def __init__(self, cache_dir=CACHE_DIR, max_entries=200000, pipeline_version=PIPELINE_VERSION):
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.path = os.path.join(cache_dir, "post_cache.sqlite3")
+            self.max_entries = max_entries
+            self.pipeline_version = pipeline_version
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self._lock = threading.Lock()
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS posts ("
+                "key TEXT PRIMARY KEY, full_text TEXT, neg REAL, neu REAL, pos REAL, compound REAL, "
+                "last_access REAL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS posts_last_access ON posts (last_access)")
+            self._conn.commit()
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def make_key(self, url, text, backend='vader'):
+        # scores of other sentiment backends are cached under their own keys
+        version = self.pipeline_version if backend == 'vader' else f"{self.pipeline_version}:{backend}"
+        content = f"{version}\0{url}\0{text}"
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def make_keys(self, posts_df, backend='vader'):
+        return [self.make_key(url, text, backend) for url, text in zip(posts_df['url'], full_text(posts_df))]
+
+    def get_many(self, keys):
+        # returns the cached rows indexed by key; keys that are not cached are simply absent
+        try:
+            unique_keys = list(dict.fromkeys(keys))
+            rows = []
+            with self._lock:
+                for start in range(0, len(unique_keys), 500):
+                    chunk = unique_keys[start:start + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    rows.extend(self._conn.execute(
+                        f"SELECT key, {', '.join(SCORE_COLUMNS)} FROM posts WHERE key IN ({placeholders})",
+                        chunk).fetchall())
+                    self._conn.execute(
+                        f"UPDATE posts SET last_access = ? WHERE key IN ({placeholders})",
+                        [time.time(), *chunk])
+                self._conn.commit()
+                self.hits += len(rows)
+                self.misses += len(unique_keys) - len(rows)
+            CACHE_EVENTS.inc(len(rows), 'post', 'hit')
+            CACHE_EVENTS.inc(len(unique_keys) - len(rows), 'post', 'miss')
+            cached = pd.DataFrame(rows, columns=['key', *SCORE_COLUMNS]).set_index('key')
+            return cached.astype({col: float for col in SCORE_COLUMNS[1:]})
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def put_many(self, scored_df):
+        # scored_df is indexed by key and carries the cleaned text and the VADER scores
+        try:
+            now = time.time()
+            rows = [(key, *values, now) for key, values in
+                    zip(scored_df.index, scored_df[SCORE_COLUMNS].itertuples(index=False, name=None))]
+            with self._lock:
+                self._conn.executemany(
+                    f"INSERT OR REPLACE INTO posts (key, {', '.join(SCORE_COLUMNS)}, last_access) "
+                    f"VALUES ({','.join('?' * (len(SCORE_COLUMNS) + 2))})", rows)
+                self._evict()
+                self._conn.commit()
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM posts WHERE key IN (SELECT key FROM posts ORDER BY last_access LIMIT ?)",
+                (overflow,))
+            self.evictions += overflow
+            CACHE_EVENTS.inc(overflow, 'post', 'eviction')
+            logging.info(f"post cache evicted {overflow} entries")
+
+    def stats(self):
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': size}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,219 @@
+import os
+import sys
+import time
+import zlib
+import sqlite3
+import threading
+from collections import defaultdict
+import numpy as np
+from src.logger import logging, debug_sampled
+from src.exception import CustomException
+from src.post_cache import CACHE_DIR
+
+POST_DEDUP = os.getenv("POST_DEDUP", "1") == "1"
+# estimated jaccard similarity of the cleaned word shingles above which two posts are the same post
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.8))
+# signatures older than this are forgotten
+DEDUP_RETENTION_DAYS = float(os.getenv("DEDUP_RETENTION_DAYS", 30))
+MERSENNE_PRIME = (1 << 31) - 1
+MAX_HASH = np.uint32(MERSENNE_PRIME)
+
+
+class NearDuplicateFilter:
+    # MinHash signatures of the cleaned text with LSH banding: posts sharing a band bucket are
+    # candidates, and a candidate whose estimated similarity passes the threshold is a duplicate.
+    # Signatures are kept per stock_symbol in sqlite, so a copy of a post seen in an earlier run
+    # is caught too. 128 permutations in 16 bands of 8 rows make posts above ~0.7 similarity
+    # candidates, so the check costs a few bucket lookups per post instead of a pass over all posts.
+    def __init__(self, cache_dir=CACHE_DIR, num_perm=128, bands=16, threshold=DEDUP_THRESHOLD, shingle_size=3,
+                 retention_days=DEDUP_RETENTION_DAYS, seed=1):
+        try:
+            if num_perm % bands:
+                raise ValueError(f"num_perm {num_perm} is not a multiple of bands {bands}")
+            self.num_perm = num_perm
+            self.bands = bands
+            self.rows = num_perm // bands
+            self.threshold = threshold
+            self.shingle_size = shingle_size
+            self.retention_days = retention_days
+            # fixed seed: persisted signatures only compare with signatures from the same permutations
+            rng = np.random.RandomState(seed)
+            self.a = rng.randint(1, MERSENNE_PRIME, size=(num_perm, 1)).astype('int64')
+            self.b = rng.randint(0, MERSENNE_PRIME, size=(num_perm, 1)).astype('int64')
+            os.makedirs(cache_dir, exist_ok=True)
+            self.path = os.path.join(cache_dir, "post_dedup.sqlite3")
+            self._lock = threading.Lock()
+            self._indexes = {}
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # canonical_id is null for an original post, or the post it duplicates
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS signatures ("
+                "stock_symbol TEXT, post_id TEXT, signature BLOB, canonical_id TEXT, seen_at REAL, "
+                "PRIMARY KEY (stock_symbol, post_id))")
+            self._conn.commit()
+            self.prune()
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def shingles(self, text):
+        # stable 31 bit hashes of the word n-grams; python's hash() is salted per process
+        tokens = text.split()
+        if len(tokens) < self.shingle_size:
+            grams = [' '.join(tokens)] if tokens else []
+        else:
+            grams = [' '.join(tokens[i:i + self.shingle_size]) for i in range(len(tokens) - self.shingle_size + 1)]
+        return np.fromiter((zlib.crc32(gram.encode('utf-8')) & MERSENNE_PRIME for gram in set(grams)), dtype='int64')
+
+    def signature(self, text):
+        hashes = self.shingles(text)
+        if len(hashes) == 0:
+            return None
+        return ((self.a * hashes[None, :] + self.b) % MERSENNE_PRIME).min(axis=1).astype('uint32')
+
+    def band_keys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def similarity(self, first, second):
+        return float(np.count_nonzero(first == second)) / self.num_perm
+
+    def _index(self, stock_symbol):
+        # band buckets of one symbol's originals, loaded from sqlite on first use; 'seen' holds
+        # every post id oldest first, so expiring past the retention only looks at its front
+        index = self._indexes.get(stock_symbol)
+        if index is None:
+            index = self._indexes[stock_symbol] = {'buckets': defaultdict(list), 'signatures': {}, 'canonical': {}, 'seen': {}}
+            rows = self._conn.execute(
+                "SELECT post_id, signature, canonical_id, seen_at FROM signatures WHERE stock_symbol = ? ORDER BY seen_at",
+                (stock_symbol,))
+            for post_id, blob, canonical_id, seen_at in rows:
+                index['canonical'][post_id] = canonical_id
+                index['seen'][post_id] = seen_at
+                if canonical_id is None and blob is not None:
+                    self._add_to_index(index, post_id, np.frombuffer(blob, dtype='uint32'))
+        self._expire(stock_symbol, index)
+        return index
+
+    def _add_to_index(self, index, post_id, signature):
+        index['signatures'][post_id] = signature
+        for key in self.band_keys(signature):
+            index['buckets'][key].append(post_id)
+
+    def _expire(self, stock_symbol, index):
+        # forgets the symbol's posts seen before the retention, in memory and in sqlite
+        cutoff = time.time() - self.retention_days * 86400
+        seen = index['seen']
+        expired = 0
+        while seen:
+            post_id, seen_at = next(iter(seen.items()))
+            if seen_at >= cutoff:
+                break
+            del seen[post_id]
+            index['canonical'].pop(post_id, None)
+            signature = index['signatures'].pop(post_id, None)
+            if signature is not None:
+                for key in self.band_keys(signature):
+                    bucket = index['buckets'][key]
+                    bucket.remove(post_id)
+                    if not bucket:
+                        del index['buckets'][key]
+            expired += 1
+        if expired:
+            self._conn.execute("DELETE FROM signatures WHERE stock_symbol = ? AND seen_at < ?", (stock_symbol, cutoff))
+            self._conn.commit()
+            logging.info(f"dedup: forgot {expired} posts of {stock_symbol} older than {self.retention_days} days")
+
+    def known_duplicates(self, stock_symbol, post_ids):
+        # post ids already judged to be copies in an earlier run, they need no cleaning at all
+        with self._lock:
+            canonical = self._index(stock_symbol)['canonical']
+            return np.array([canonical.get(post_id) is not None for post_id in post_ids], dtype=bool)
+
+    def dedupe(self, stock_symbol, post_ids, texts):
+        # returns a keep mask: False for posts that copy an earlier post of this symbol, in this
+        # batch (first one wins, so pass posts oldest first) or in an earlier run
+        try:
+            keep = np.ones(len(post_ids), dtype=bool)
+            new_rows = []
+            with self._lock:
+                index = self._index(stock_symbol)
+                for position, (post_id, text) in enumerate(zip(post_ids, texts)):
+                    if post_id in index['canonical']:
+                        keep[position] = index['canonical'][post_id] is None
+                        continue
+                    signature = self.signature(text)
+                    canonical_id = None
+                    if signature is not None:
+                        candidates = {candidate for key in self.band_keys(signature) for candidate in index['buckets'].get(key, ())}
+                        for candidate in candidates:
+                            if candidate != post_id and self.similarity(signature, index['signatures'][candidate]) >= self.threshold:
+                                canonical_id = candidate
+                                break
+                    index['canonical'][post_id] = canonical_id
+                    seen_at = index['seen'][post_id] = time.time()
+                    if canonical_id is None:
+                        if signature is not None:
+                            self._add_to_index(index, post_id, signature)
+                    else:
+                        keep[position] = False
+                        # per post, so sampled before the record is built
+                        debug_sampled("dedup: %s copies %s", post_id, canonical_id, extra={'stock_symbol': stock_symbol})
+                    new_rows.append((stock_symbol, post_id, None if signature is None or canonical_id is not None
+                                     else signature.tobytes(), canonical_id, seen_at))
+                if new_rows:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO signatures (stock_symbol, post_id, signature, canonical_id, seen_at) "
+                        "VALUES (?, ?, ?, ?, ?)", new_rows)
+                    self._conn.commit()
+            duplicates = len(keep) - int(keep.sum())
+            if duplicates:
+                logging.info(f"dedup: dropped {duplicates} near-duplicate posts of {len(keep)} for {stock_symbol}")
+            return keep
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def prune(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM signatures WHERE seen_at < ?", (time.time() - self.retention_days * 86400,))
+            self._conn.commit()
+            self._indexes.clear()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+if __name__=="__main__":
+    # LSH against the exact all-pairs comparison on a corpus with planted near-duplicates
+    import random
+    import tempfile
+
+    random.seed(0)
+    vocabulary = [f"word{i}" for i in range(3000)]
+    originals = [' '.join(random.choices(vocabulary, k=random.randint(20, 80))) for _ in range(5000)]
+    texts, copies = list(originals), set()
+    for _ in range(1000):
+        tokens = random.choice(originals).split()
+        # a copy-paste with a couple of words edited at the end
+        tokens[-2:] = random.choices(vocabulary, k=2)
+        copies.add(len(texts))
+        texts.append(' '.join(tokens))
+    post_ids = [f"p{i}" for i in range(len(texts))]
+    with tempfile.TemporaryDirectory() as cache_dir:
+        dedup = NearDuplicateFilter(cache_dir)
+        start = time.perf_counter()
+        keep = dedup.dedupe('BENCH', post_ids, texts)
+        lsh_time = time.perf_counter() - start
+        signatures = [dedup.signature(text) for text in texts[:1500]]
+        start = time.perf_counter()
+        pairs = sum(dedup.similarity(signatures[i], signatures[j]) >= dedup.threshold
+                    for i in range(len(signatures)) for j in range(i))
+        pairwise_time = (time.perf_counter() - start) * (len(texts) / 1500) ** 2
+        dropped = {position for position, kept in enumerate(keep) if not kept}
+        print(f"{len(texts)} posts: dropped {len(dropped)}, {len(dropped & copies)} of {len(copies)} planted copies, "
+              f"{len(dropped - copies)} originals")
+        print(f"LSH dedup {lsh_time:.2f}s, all pairs would take ~{pairwise_time:.0f}s")
+        # a second run only looks the ids up, and a fresh copy matches a signature from the first run
+        keep_again = dedup.dedupe('BENCH', post_ids + ['late'], texts + [texts[10] + ' again'])
+        print(f"second run keeps {int(keep_again.sum())}, late copy kept: {bool(keep_again[-1])}")
+        dedup.close()
@@ -0,0 +1,303 @@
+import os
+import re
+import sys
+import json
+import time
+import threading
+import contextvars
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import pandas as pd
+from src.logger import logging
+from src.exception import CustomException
+from src.quote_service import TokenBucket
+from src.get_reddit_data import RedditData, MARKETS, normalize_stock_type
+from src.post_batch import POST_DTYPES, frame_from_records
+from src.metrics import stage_timer, STAGE_ERRORS
+
+SOURCES_FILE = os.getenv("SOURCES_FILE", "sources.json")
+# a source that has not answered after this many seconds is left out of the result
+SOURCE_TIMEOUT = float(os.getenv("SOURCE_TIMEOUT", 10))
+SOURCE_WORKERS = int(os.getenv("SOURCE_WORKERS", 16))
+# calls one source may have running or queued at once; a stuck source is skipped past this
+# instead of taking every worker thread
+SOURCE_MAX_IN_FLIGHT = int(os.getenv("SOURCE_MAX_IN_FLIGHT", 4))
+# used when there is no sources file: the subreddits RedditData has always searched
+DEFAULT_SOURCE_CONFIG = {
+    'rate_limits': {'reddit': 1.5},
+    'sources': [
+        {'name': 'reddit_us', 'type': 'reddit_search', 'markets': ['US'],
+         'subreddits': ['stocks', 'investing', 'wallstreetbets'], 'rate_limit': 'reddit'},
+        {'name': 'reddit_india', 'type': 'reddit_search', 'markets': ['India'],
+         'subreddits': ['IndianStockMarket', 'IndianStreetBets', 'IndiaInvestments'], 'rate_limit': 'reddit'},
+    ],
+}
+
+
+def mentions_symbol(stock_symbol):
+    # 'TSLA' or '$TSLA' as a whole word; case sensitive, so tickers like ON or IT do not match prose
+    pattern = re.compile(rf'(?<![\w$])\$?{re.escape(stock_symbol)}(?!\w)')
+    return lambda text: pattern.search(text) is not None
+
+
+class RedditClients:
+    # praw clients are not thread safe: every fetch thread gets its own, built on first use
+    def __init__(self, reddit_factory=None, post_store=None, timeout=None):
+        self.reddit_factory = reddit_factory
+        self.post_store = post_store
+        self.timeout = timeout
+        self._thread_local = threading.local()
+
+    def get(self):
+        reddit_data = getattr(self._thread_local, 'reddit_data', None)
+        if reddit_data is None:
+            reddit = self.reddit_factory() if self.reddit_factory is not None else None
+            reddit_data = self._thread_local.reddit_data = RedditData(
+                reddit=reddit, post_store=self.post_store, timeout=self.timeout)
+        return reddit_data
+
+
+class PostSource(ABC):
+    # one place posts come from; markets=None serves every stock_type. Reddit sources name the
+    # subreddits they read in `stream`, a RoutedFeed reads their new-post listing instead
+    stream = None
+
+    def __init__(self, name, markets=None, timeout=SOURCE_TIMEOUT, rate_limiter=None, max_in_flight=SOURCE_MAX_IN_FLIGHT):
+        self.name = name
+        self.markets = tuple(markets) if markets else None
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.max_in_flight = max_in_flight
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def serves(self, stock_type):
+        return self.markets is None or stock_type in self.markets
+
+    @abstractmethod
+    def fetch(self, stock_symbol, stock_type, limit=100):
+        # the post frame of build_post_frame, or an empty DataFrame
+        ...
+
+
+class RedditSearchSource(PostSource):
+    # reddit search over a set of subreddits, sort='new'; 'all' searches the whole site
+    def __init__(self, name, subreddits, clients, query='{symbol} stock', incremental=False, **kwargs):
+        super().__init__(name, **kwargs)
+        self.subreddits = self.stream = subreddits if isinstance(subreddits, str) else '+'.join(subreddits)
+        self.clients = clients
+        self.query = query
+        self.incremental = incremental
+
+    def fetch(self, stock_symbol, stock_type, limit=100):
+        return self.clients.get().search(stock_symbol, self.subreddits, limit, self.incremental, self.query)
+
+
+class SubredditSource(PostSource):
+    # the newest posts of one subreddit that mention the symbol, for small subreddits where
+    # search finds little; scan_limit posts are read per fetch
+    def __init__(self, name, subreddit, clients, scan_limit=100, **kwargs):
+        super().__init__(name, **kwargs)
+        self.subreddit = self.stream = subreddit
+        self.clients = clients
+        self.scan_limit = scan_limit
+
+    def fetch(self, stock_symbol, stock_type, limit=100):
+        frame = self.clients.get().get_subreddit_posts(stock_symbol, self.subreddit, self.scan_limit,
+                                                       mentions_symbol(stock_symbol))
+        return frame.head(limit)
+
+
+class JsonlReplaySource(PostSource):
+    # replays posts saved one JSON object per line (id, title, selftext, score, created_utc,
+    # permalink, subreddit) for tests and backfills; records with a stock_symbol field are
+    # matched on it, the others on a mention of the symbol. The file is re-read when it changes.
+    def __init__(self, name, path, **kwargs):
+        super().__init__(name, **kwargs)
+        self.path = path
+        self._records = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def records(self):
+        with self._lock:
+            mtime = os.path.getmtime(self.path)
+            if self._records is None or mtime != self._mtime:
+                records = []
+                with open(self.path) as f:
+                    for line in f:
+                        if line.strip():
+                            post = json.loads(line)
+                            records.append((post.get('stock_symbol'), (
+                                post['id'], post.get('title', ''), post.get('selftext', ''), post.get('score', 0),
+                                post['created_utc'], f"https://reddit.com{post.get('permalink', '')}",
+                                post.get('subreddit', self.name))))
+                # newest first, like a sort='new' search
+                records.sort(key=lambda record: record[1][4], reverse=True)
+                self._records, self._mtime = records, mtime
+            return self._records
+
+    def fetch(self, stock_symbol, stock_type, limit=100):
+        mentions = mentions_symbol(stock_symbol)
+        matches = []
+        for symbol, record in self.records():
+            if (symbol == stock_symbol) if symbol is not None else mentions(f"{record[1]} {record[2]}"):
+                matches.append(record)
+                if limit is not None and len(matches) >= limit:
+                    break
+        return frame_from_records(stock_symbol, matches)
+
+
+def merge_posts(frames):
+    # one post frame, newest first; a post found by several sources is kept once
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0]
+    merged = pd.concat(frames, ignore_index=True).drop_duplicates('post_id')
+    merged = merged.sort_values('created_utc', ascending=False, kind='stable', ignore_index=True)
+    # concat turns categoricals with different categories into objects
+    return merged.astype(POST_DTYPES)
+
+
+class PostSources:
+    # runs every source serving the stock_type at once, so a fetch takes as long as the slowest
+    # source (at most its timeout) instead of the sum of all of them
+    def __init__(self, sources, max_workers=SOURCE_WORKERS):
+        self.sources = list(sources)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="source")
+
+    @property
+    def markets(self):
+        markets = [market for source in self.sources for market in (source.markets or ())]
+        return tuple(dict.fromkeys(markets)) or MARKETS
+
+    def _fetch_one(self, source, stock_symbol, stock_type, limit):
+        if source.rate_limiter is not None:
+            source.rate_limiter.acquire()
+        with stage_timer(f'source_{source.name}') as stage:
+            frame = source.fetch(stock_symbol, stock_type, limit)
+            stage.rows = len(frame)
+        return frame
+
+    def fetch(self, stock_symbol, stock_type, limit=100):
+        start = time.monotonic()
+        stock_type = normalize_stock_type(stock_type, self.markets)
+        sources = [source for source in self.sources if source.serves(stock_type)]
+        if not sources:
+            raise CustomException(ValueError(f"no post source serves {stock_type}"), sys)
+        futures, errors = [], []
+        for source in sources:
+            if not source.in_flight.acquire(blocking=False):
+                errors.append(f"{source.name} skipped, {source.max_in_flight} calls still in flight")
+                continue
+            future = self.executor.submit(contextvars.copy_context().run, self._fetch_one, source,
+                                          stock_symbol, stock_type, limit)
+            # the slot is freed when the call finishes or is cancelled, not when this fetch gives up
+            future.add_done_callback(lambda _, source=source: source.in_flight.release())
+            futures.append((source, future))
+        frames = []
+        for source, future in futures:
+            # every source started together, so each deadline is measured from the same start
+            remaining = max(0.0, start + source.timeout - time.monotonic())
+            try:
+                frames.append(future.result(timeout=remaining))
+            except TimeoutError:
+                # a call still queued is dropped; a running one keeps its thread until praw's own
+                # timeout, and its slot, and its posts are dropped
+                future.cancel()
+                errors.append(f"{source.name} timed out after {source.timeout}s")
+            except Exception as e:
+                errors.append(f"{source.name} failed: {e}")
+        for error in errors:
+            STAGE_ERRORS.inc(1, 'source_fetch')
+            logging.warning(f"post source {error} for {stock_symbol}")
+        if len(errors) == len(sources):
+            raise CustomException(RuntimeError(f"every post source failed for {stock_symbol}: {'; '.join(errors)}"), sys)
+        merged = merge_posts(frames)
+        logging.info(f"fetched {len(merged)} posts for {stock_symbol} from {len(frames)} of {len(sources)} "
+                     f"sources in {time.monotonic() - start:.2f}s")
+        return merged
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def build_source(config, clients, rate_limiters, default_timeout):
+    kind = config.get('type', 'reddit_search')
+    kwargs = {
+        'markets': config.get('markets'),
+        'timeout': float(config.get('timeout', default_timeout)),
+        'rate_limiter': rate_limiters.get(config['rate_limit']) if config.get('rate_limit') else None,
+        'max_in_flight': int(config.get('max_in_flight', SOURCE_MAX_IN_FLIGHT)),
+    }
+    if kind == 'reddit_search':
+        return RedditSearchSource(config['name'], config['subreddits'], clients,
+                                  config.get('query', '{symbol} stock'), clients.post_store is not None, **kwargs)
+    if kind == 'subreddit':
+        return SubredditSource(config['name'], config['subreddit'], clients, int(config.get('scan_limit', 100)), **kwargs)
+    if kind == 'jsonl':
+        return JsonlReplaySource(config['name'], config['path'], **kwargs)
+    raise ValueError(f"unknown post source type {kind!r} for {config.get('name')}")
+
+
+def load_sources(path=SOURCES_FILE, reddit_factory=None, post_store=None, max_workers=SOURCE_WORKERS):
+    # {"timeout": 10, "rate_limits": {"reddit": 1.5},
+    #  "sources": [{"name": "reddit_us", "type": "reddit_search", "markets": ["US"],
+    #               "subreddits": ["stocks", "investing"], "rate_limit": "reddit"}, ...]}
+    # types are reddit_search, subreddit and jsonl; "enabled": false skips a source, "max_in_flight"
+    # bounds its concurrent calls.
+    # post_store switches the reddit searches to incremental fetching.
+    try:
+        if os.path.exists(path):
+            with open(path) as f:
+                config = json.load(f)
+        else:
+            logging.info(f"sources file {path} not found, using the default reddit searches")
+            config = DEFAULT_SOURCE_CONFIG
+        default_timeout = float(config.get('timeout', SOURCE_TIMEOUT))
+        # one bucket per named limit, shared by every source that names it
+        rate_limiters = {name: TokenBucket(float(rate)) for name, rate in config.get('rate_limits', {}).items()}
+        clients = RedditClients(reddit_factory, post_store, timeout=max(1, round(default_timeout)))
+        sources = [build_source(source, clients, rate_limiters, default_timeout)
+                   for source in config.get('sources', []) if source.get('enabled', True)]
+        if not sources:
+            raise ValueError(f"{path} configures no enabled post sources")
+        return PostSources(sources, max_workers)
+    except Exception as e:
+        raise CustomException(e,sys)
+
+
+if __name__=="__main__":
+    # three sources of 0.2s, 0.5s and 1s: fetched together the request takes the slowest one,
+    # and a source stuck past its timeout only costs the timeout
+    class SlowSource(PostSource):
+        def __init__(self, name, delay, size, **kwargs):
+            super().__init__(name, **kwargs)
+            self.delay = delay
+            self.records = [(f"{name}{i}", f"TSLA post {i}", "", i, 1750000000 + i * 60,
+                             f"https://reddit.com/{name}{i}", name) for i in range(size)]
+
+        def fetch(self, stock_symbol, stock_type, limit=100):
+            time.sleep(self.delay)
+            return frame_from_records(stock_symbol, self.records[:limit])
+
+    sources = [SlowSource('fast', 0.2, 50), SlowSource('medium', 0.5, 80), SlowSource('slow', 1.0, 100)]
+    fetcher = PostSources(sources)
+    start = time.perf_counter()
+    posts = fetcher.fetch('TSLA', 'US')
+    print(f"{len(posts)} posts from 3 sources in {time.perf_counter() - start:.2f}s, "
+          f"sequential would take {sum(source.delay for source in sources):.2f}s")
+    stuck = PostSources(sources + [SlowSource('stuck', 5.0, 10, timeout=1.5)])
+    start = time.perf_counter()
+    posts = stuck.fetch('TSLA', 'US')
+    print(f"{len(posts)} posts with a stuck source in {time.perf_counter() - start:.2f}s")
+    # 40 fetches in a row against a source that never answers: it holds at most max_in_flight
+    # worker threads, so the fast source keeps answering instead of queueing behind it
+    hung = PostSources([SlowSource('fast', 0.05, 50), SlowSource('hung', 3.0, 10, timeout=0.2)])
+    start = time.perf_counter()
+    answered = sum(len(hung.fetch('TSLA', 'US')) > 0 for _ in range(40))
+    print(f"{answered} of 40 fetches answered past a hung source in {time.perf_counter() - start:.2f}s")
+    fetcher.close()
+    stuck.close()
+    hung.close()
@@ -0,0 +1,93 @@
+import os
+import sys
+import sqlite3
+import threading
+import pandas as pd
+from src.logger import logging
+from src.exception import CustomException
+from src.post_cache import CACHE_DIR
+from src.post_batch import POST_COLUMNS
+
+
+# stock_symbol of the watermark of a whole listing rather than of one symbol's posts in it
+LISTING = ''
+
+
+class PostStore:
+    # persisted posts and the newest post seen per (stock_symbol, subreddit set)
+    def __init__(self, cache_dir=CACHE_DIR):
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.path = os.path.join(cache_dir, "post_store.sqlite3")
+            self._lock = threading.Lock()
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS posts ("
+                "stock_symbol TEXT, subreddits TEXT, post_id TEXT, title TEXT, text TEXT, score INTEGER, "
+                "created_utc REAL, url TEXT, subreddit TEXT, PRIMARY KEY (stock_symbol, subreddits, post_id))")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS posts_by_time ON posts (stock_symbol, subreddits, created_utc)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS watermarks ("
+                "stock_symbol TEXT, subreddits TEXT, created_utc REAL, post_id TEXT, "
+                "PRIMARY KEY (stock_symbol, subreddits))")
+            self._conn.commit()
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def get_watermark(self, stock_symbol, subreddits):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT created_utc, post_id FROM watermarks WHERE stock_symbol = ? AND subreddits = ?",
+                (stock_symbol, subreddits)).fetchone()
+        return row
+
+    def set_watermark(self, stock_symbol, subreddits, created_utc, post_id):
+        with self._lock:
+            self._upsert_watermark(stock_symbol, subreddits, created_utc, post_id)
+            self._conn.commit()
+
+    def _upsert_watermark(self, stock_symbol, subreddits, created_utc, post_id):
+        self._conn.execute(
+            "INSERT INTO watermarks (stock_symbol, subreddits, created_utc, post_id) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (stock_symbol, subreddits) DO UPDATE SET "
+            "created_utc = excluded.created_utc, post_id = excluded.post_id "
+            "WHERE excluded.created_utc >= watermarks.created_utc",
+            (stock_symbol, subreddits, created_utc, post_id))
+
+    def add_posts(self, stock_symbol, subreddits, posts):
+        # posts is a list of tuples in POST_COLUMNS order; the watermark moves to the newest one
+        if not posts:
+            return
+        try:
+            newest = max(posts, key=lambda post: post[4])
+            with self._lock:
+                self._conn.executemany(
+                    f"INSERT OR REPLACE INTO posts (stock_symbol, subreddits, {', '.join(POST_COLUMNS)}) "
+                    f"VALUES ({','.join('?' * (len(POST_COLUMNS) + 2))})",
+                    [(stock_symbol, subreddits, *post) for post in posts])
+                self._upsert_watermark(stock_symbol, subreddits, newest[4], newest[0])
+                self._conn.commit()
+            logging.info(f"stored {len(posts)} new posts for {stock_symbol} in {subreddits}")
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def keys(self):
+        # every (stock_symbol, subreddits) with stored posts
+        with self._lock:
+            return self._conn.execute("SELECT stock_symbol, subreddits FROM watermarks WHERE stock_symbol != ?",
+                                      (LISTING,)).fetchall()
+
+    def load_posts(self, stock_symbol, subreddits, limit=100):
+        # newest `limit` posts (all of them for None), newest first, like a sort='new' search
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(POST_COLUMNS)} FROM posts WHERE stock_symbol = ? AND subreddits = ? "
+                "ORDER BY created_utc DESC LIMIT ?",
+                (stock_symbol, subreddits, -1 if limit is None else limit)).fetchall()
+        return pd.DataFrame(rows, columns=POST_COLUMNS)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
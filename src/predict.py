@@ -1,27 +1,261 @@
+import os
 import sys
+import time
+import threading
+import contextvars
+import numpy as np
 import pandas as pd
-from src.logger import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from src.logger import logging, setup_worker_logging
 from src.exception import CustomException
 
-from src.sentiment_analysis import SentimentAnalysis
+from src.sentiment_analysis import SentimentAnalysis, SENTIMENT_BACKEND
 from src.text_cleaning import TextCleaner
-from src.get_reddit_data import RedditData
+from src.post_sources import load_sources
+from src.get_reddit_data import normalize_stock_type
+from src.post_cache import PostCache, SCORE_COLUMNS
+from src.post_store import PostStore
+from src.post_batch import full_text
+from src.sentiment_history import SentimentHistory, SENTIMENT_HISTORY
+from src.post_dedup import NearDuplicateFilter, POST_DEDUP
+from src.metrics import stage_timer
+
+REDDIT_INCREMENTAL = os.getenv("REDDIT_INCREMENTAL", "0") == "1"
+
+
+def clean_texts(cleaner, post_df):
+    # clean_batch fuses clean_text and text_processing into one pass
+    return cleaner.clean_batch(full_text(post_df))
+
+
+def score_texts(sentiment_analysis, cleaned, backend=None):
+    # score cleaned texts with VADER or the linear backend, returns the SCORE_COLUMNS frame
+    scores = sentiment_analysis.polarity_scores_batch(cleaned, backend or SENTIMENT_BACKEND)
+    return scores.assign(full_text=cleaned)[SCORE_COLUMNS]
+
+
+def timed_clean(clean, post_df):
+    # stage timers run in the process serving /metrics, around pooled calls as well, a worker
+    # process would record into its own registry
+    with stage_timer('clean') as stage:
+        cleaned = clean(post_df)
+        stage.rows = len(cleaned)
+    return cleaned
+
+
+def timed_scores(score, cleaned, backend=None):
+    backend = backend or SENTIMENT_BACKEND
+    with stage_timer(backend) as stage:
+        start = time.perf_counter()
+        scores = score(cleaned, backend)
+        stage.rows = len(scores)
+    if len(scores):
+        logging.info(f"{backend} scored {len(scores)} posts, {len(scores) / max(time.perf_counter() - start, 1e-9):,.0f} posts/s")
+    return scores
+
+
+def clean_posts(cleaner, post_df):
+    return timed_clean(lambda posts: clean_texts(cleaner, posts), post_df)
+
+
+def polarity_scores(sentiment_analysis, cleaned, backend=None):
+    return timed_scores(lambda texts, backend: score_texts(sentiment_analysis, texts, backend), cleaned, backend)
+
+
+def score_posts(cleaner, sentiment_analysis, post_df):
+    # clean and VADER-score raw posts, returns the SCORE_COLUMNS frame
+    return polarity_scores(sentiment_analysis, clean_posts(cleaner, post_df))
+
+
+# per-process analyzers for the NLP process pool
+_worker_cleaner = None
+_worker_sentiment_analysis = None
+
+def _init_nlp_worker():
+    global _worker_cleaner, _worker_sentiment_analysis
+    setup_worker_logging()
+    _worker_cleaner = TextCleaner()
+    _worker_sentiment_analysis = SentimentAnalysis()
+
+def _clean_posts_in_worker(post_df):
+    return clean_texts(_worker_cleaner, post_df)
+
+def _polarity_scores_in_worker(cleaned, backend=None):
+    return score_texts(_worker_sentiment_analysis, cleaned, backend)
+
 
 class Predict:
-    def __init__(self):
-        self.reddit_data=RedditData()
+    def __init__(self, post_cache=None, nlp_processes=None, fetch_workers=8, incremental=REDDIT_INCREMENTAL,
+                 reddit_factory=None, history=None, deduper=None, sources=None):
+        self.incremental = incremental
+        self.post_store = PostStore() if incremental else None
+        # the sources configured in SOURCES_FILE, fetched concurrently; reddit_factory builds their
+        # praw clients, None means praw.Reddit from the environment
+        self.sources = sources if sources is not None else load_sources(
+            reddit_factory=reddit_factory, post_store=self.post_store)
         self.cleaner=TextCleaner()
         self.sentiment_analysis = SentimentAnalysis()
-    def predict(self, stock_symbol, stock_type):
-        logging.info ("started predicting")
+        self.post_cache = post_cache if post_cache is not None else PostCache()
+        # daily sentiment of every analysis, the Trend is computed over it
+        self.history = history if history is not None else (SentimentHistory() if SENTIMENT_HISTORY else None)
+        # near-duplicate posts are dropped between cleaning and scoring
+        self.deduper = deduper if deduper is not None else (NearDuplicateFilter() if POST_DEDUP else None)
+        self.nlp_processes = nlp_processes or os.cpu_count() or 1
+        self.fetch_workers = fetch_workers
+        self._nlp_pool = None
+        self._pool_lock = threading.Lock()
+
+    def fetch_posts(self, stock_symbol, stock_type):
+        # thread safe, every source keeps its praw clients per thread
+        with stage_timer('fetch') as stage:
+            post_df = self.sources.fetch(stock_symbol, stock_type)
+            stage.rows = len(post_df)
+        return post_df
+
+    def score_new_posts(self, post_df):
+        return score_posts(self.cleaner, self.sentiment_analysis, post_df)
+
+    def _submit_nlp(self, function, *args):
+        # a worker that died breaks every later submit, so the broken pool is replaced and the
+        # call tried once more on the new one
+        for attempt in range(2):
+            pool = self.nlp_pool
+            try:
+                return pool.submit(function, *args).result()
+            except BrokenProcessPool as e:
+                self._drop_nlp_pool(pool)
+                if attempt:
+                    raise CustomException(e,sys)
+                logging.warning(f"NLP process pool broke ({e}), starting a new one")
+
+    def _drop_nlp_pool(self, pool):
+        with self._pool_lock:
+            # another thread may have replaced it already
+            if self._nlp_pool is pool:
+                self._nlp_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _clean(self, post_df, pooled):
+        if pooled:
+            return timed_clean(lambda posts: self._submit_nlp(_clean_posts_in_worker, posts), post_df)
+        return clean_posts(self.cleaner, post_df)
+
+    def _polarity_scores(self, cleaned, pooled, backend=None):
+        if pooled:
+            return timed_scores(lambda texts, backend: self._submit_nlp(_polarity_scores_in_worker, texts, backend),
+                                cleaned, backend)
+        return polarity_scores(self.sentiment_analysis, cleaned, backend)
+
+    def _dedupe(self, stock_symbol, post_df, texts):
+        # keep mask over post_df; the oldest of a set of copies is the one that stays
+        with stage_timer('dedup') as stage:
+            order = np.argsort(post_df['created_utc'].to_numpy(), kind='stable')
+            post_ids = post_df['post_id'].astype(str).to_numpy()
+            keep = np.empty(len(post_df), dtype=bool)
+            keep[order] = self.deduper.dedupe(stock_symbol, post_ids[order], texts[order])
+            stage.rows = len(post_df)
+        return keep
+
+    def prepare_posts(self, post_df, stock_symbol=None, pooled=False, backend=None, stock_type=None):
+        # only posts the cache has not seen go through TextCleaner and VADER (or the linear
+        # backend), and with a stock_symbol near-duplicate posts are dropped after cleaning.
+        # With a stock_type as well, the scored posts are added to the sentiment history
+        backend = backend or SENTIMENT_BACKEND
+        dedupe = self.deduper is not None and stock_symbol is not None
+        if dedupe and len(post_df) > 0:
+            # copies found in earlier runs need no work at all
+            post_df = post_df[~self.deduper.known_duplicates(stock_symbol, post_df['post_id'].astype(str))]
+        if len(post_df) == 0:
+            return post_df
+        with stage_timer('post_cache_lookup') as stage:
+            keys = np.array(self.post_cache.make_keys(post_df, backend), dtype=object)
+            cached = self.post_cache.get_many(keys)
+            missing = ~np.isin(keys, cached.index.to_numpy(dtype=object))
+            stage.rows = len(keys)
+        cleaned = self._clean(post_df[missing], pooled) if missing.any() else pd.Series(dtype=object)
+        if dedupe:
+            texts = np.empty(len(post_df), dtype=object)
+            texts[~missing] = cached.loc[keys[~missing], 'full_text'].to_numpy(dtype=object)
+            texts[missing] = cleaned.to_numpy(dtype=object)
+            keep = self._dedupe(stock_symbol, post_df, texts)
+            cleaned = cleaned[keep[missing]]
+            post_df, keys, missing = post_df[keep], keys[keep], missing[keep]
+        if missing.any():
+            fresh = self._polarity_scores(cleaned, pooled, backend)
+            fresh.index = keys[missing]
+            fresh = fresh[~fresh.index.duplicated()]
+            self.post_cache.put_many(fresh)
+            cached = pd.concat([cached, fresh])
+        logging.info(f"post cache: {int((~missing).sum())} hits, {int(missing.sum())} misses")
+        scored = cached.loc[keys]
+        post_df = post_df.assign(**{col: scored[col].to_numpy() for col in SCORE_COLUMNS})
+        history = self.history_for(backend)
+        if history is not None and stock_symbol is not None and stock_type is not None:
+            with stage_timer('history') as stage:
+                quality = self.sentiment_analysis.filter_low_quality_posts(post_df)
+                stage.rows = history.add_posts(stock_symbol, stock_type, self.sentiment_analysis.add_sentiment(quality))
+        return post_df
+
+    def history_for(self, backend):
+        # the history accumulates one backend's scores only, the configured default
+        return self.history if (backend or SENTIMENT_BACKEND) == SENTIMENT_BACKEND else None
+
+    def predict(self, stock_symbol, stock_type, backend=None):
+        logging.debug(f"started predicting {stock_symbol}")
         try:
-            post_df = self.reddit_data.get_reddit_data(stock_symbol,stock_type)
-            logging.info(" Reddit search is done")
-            post_df['full_text']= post_df['full_text'].apply(self.cleaner.clean_text)
-            post_df['full_text']= post_df['full_text'].apply(self.cleaner.text_processing)
-            logging.info("cleaning is done")
-            sentiment_result=self.sentiment_analysis.get_result(post_df, stock_symbol)
-            logging.info("sentiment analysis is done")
-            return sentiment_result
+            post_df = self.fetch_posts(stock_symbol, stock_type)
+            logging.debug(f"reddit search is done for {stock_symbol}")
+            return self.predict_posts(stock_symbol, post_df, backend=backend, stock_type=stock_type)
         except Exception as e:
             raise CustomException(e,sys)
+
+    def predict_posts(self, stock_symbol, post_df, backend=None, pooled=False, stock_type=None):
+        # the pipeline after the fetch, for posts fetched elsewhere such as a RoutedFeed; the
+        # trend comes from the sentiment history when the stock_type is known
+        if stock_type is not None:
+            stock_type = normalize_stock_type(stock_type, self.sources.markets)
+        post_df = self.prepare_posts(post_df, stock_symbol, pooled=pooled, backend=backend, stock_type=stock_type)
+        logging.debug(f"cleaning is done for {stock_symbol}")
+        history = self.history_for(backend) if stock_type is not None else None
+        sentiment_result=self.sentiment_analysis.get_result(post_df, stock_symbol, history=history, stock_type=stock_type)
+        logging.debug(f"sentiment analysis is done for {stock_symbol}")
+        return sentiment_result
+
+    @property
+    def nlp_pool(self):
+        with self._pool_lock:
+            if self._nlp_pool is None:
+                self._nlp_pool = ProcessPoolExecutor(max_workers=self.nlp_processes, initializer=_init_nlp_worker)
+            return self._nlp_pool
+
+    def warm_nlp_pool(self):
+        # forks the NLP workers now, before a server starts its own threads
+        self.nlp_pool.submit(os.getpid).result()
+
+    def predict_pooled(self, stock_symbol, stock_type, backend=None):
+        # variant of predict that cleans and scores in the process pool
+        post_df = self.fetch_posts(stock_symbol, stock_type)
+        return self.predict_posts(stock_symbol, post_df, backend=backend, pooled=True, stock_type=stock_type)
+
+    def predict_many(self, stock_symbols, stock_type, backend=None):
+        # yields (stock_symbol, result) in completion order; reddit searches run on a bounded
+        # thread pool and the CPU bound cleaning/scoring on a process pool sized to the cores
+        logging.info(f"started predicting {len(stock_symbols)} symbols")
+        with ThreadPoolExecutor(max_workers=self.fetch_workers, thread_name_prefix="reddit") as fetch_pool:
+            futures = {fetch_pool.submit(contextvars.copy_context().run, self.predict_pooled, symbol, stock_type, backend): symbol
+                       for symbol in dict.fromkeys(stock_symbols)}
+            for future in as_completed(futures):
+                stock_symbol = futures[future]
+                try:
+                    yield stock_symbol, future.result()
+                except Exception as e:
+                    logging.error(f"prediction for {stock_symbol} failed: {e}")
+                    yield stock_symbol, {'success': False, 'error': str(e)}
+
+    def close(self):
+        self.sources.close()
+        with self._pool_lock:
+            if self._nlp_pool is not None:
+                self._nlp_pool.shutdown()
+                self._nlp_pool = None
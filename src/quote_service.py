@@ -0,0 +1,255 @@
+import os
+import sys
+import time
+import json
+import random
+import threading
+from dataclasses import dataclass
+from typing import Optional
+import requests
+from requests.adapters import HTTPAdapter
+from src.logger import logging
+from src.exception import CustomException
+
+YAHOO_QUOTE_URL = os.getenv("YAHOO_QUOTE_URL", "https://query1.finance.yahoo.com")
+YAHOO_COOKIE_URL = "https://fc.yahoo.com"
+YAHOO_REQUESTS_PER_SECOND = float(os.getenv("YAHOO_REQUESTS_PER_SECOND", 2))
+
+
+@dataclass(frozen=True, slots=True)
+class Quote:
+    symbol: str
+    current_price: Optional[float]
+    # None when yahoo leaves it out, the market of a symbol does not tell its quote currency
+    currency: Optional[str]
+    previous_close: Optional[float] = None
+    change_percent: Optional[float] = None
+    market_time: Optional[int] = None
+
+
+class QuoteFetchError(Exception):
+    # a quote request still failing after every retry
+    pass
+
+
+class RateLimitError(QuoteFetchError):
+    # ... whose last attempt was answered with HTTP 429
+    pass
+
+
+class TokenBucket:
+    # shared by every caller; a 429 seen by one caller pauses all of them
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+YAHOO_RATE_LIMITER = TokenBucket(YAHOO_REQUESTS_PER_SECOND)
+
+
+class QuoteService:
+    def __init__(self, base_url=YAHOO_QUOTE_URL, session=None, limiter=YAHOO_RATE_LIMITER, max_retries=5,
+                 backoff_base=1.0, backoff_max=30.0, batch_size=50, timeout=10, use_crumb=None):
+        self.base_url = base_url.rstrip('/')
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.batch_size = batch_size
+        self.timeout = timeout
+        # the public yahoo endpoint wants a cookie + crumb pair, local stubs do not
+        self.use_crumb = use_crumb if use_crumb is not None else 'yahoo.com' in self.base_url
+        self.session = session or self._make_session()
+        self._crumb = None
+        self._crumb_lock = threading.Lock()
+
+    def _make_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['User-Agent'] = 'Mozilla/5.0 (stock_trend quote service)'
+        return session
+
+    def _get_crumb(self):
+        with self._crumb_lock:
+            if self._crumb is None:
+                self.session.get(YAHOO_COOKIE_URL, timeout=self.timeout)
+                response = self.session.get(f"{self.base_url}/v1/test/getcrumb", timeout=self.timeout)
+                response.raise_for_status()
+                self._crumb = response.text.strip()
+            return self._crumb
+
+    def _backoff(self, attempt, retry_after=None):
+        # exponential backoff with full jitter, never shorter than the server's Retry-After
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _fetch_chunk(self, symbols):
+        params = {'symbols': ','.join(symbols)}
+        last_failure = None
+        for attempt in range(self.max_retries):
+            # no backoff after the last attempt, the error is raised right away
+            last_attempt = attempt + 1 == self.max_retries
+            self.limiter.acquire()
+            try:
+                if self.use_crumb:
+                    params['crumb'] = self._get_crumb()
+                response = self.session.get(f"{self.base_url}/v7/finance/quote", params=params, timeout=self.timeout)
+            except requests.RequestException as e:
+                last_failure = e
+                delay = self._backoff(attempt)
+                logging.warning(f"quote request failed ({e}), attempt {attempt + 1} of {self.max_retries}")
+                if not last_attempt:
+                    time.sleep(delay)
+                continue
+            last_failure = f"HTTP {response.status_code}"
+            if response.status_code == 429 or response.status_code >= 500:
+                retry_after = response.headers.get('Retry-After')
+                delay = self._backoff(attempt, float(retry_after) if retry_after and retry_after.isdigit() else None)
+                logging.warning(f"quote request got HTTP {response.status_code}, attempt {attempt + 1} "
+                                f"of {self.max_retries}, backing off {delay:.2f}s")
+                if response.status_code == 429:
+                    # the shared bucket honours Retry-After for every caller, this one included
+                    self.limiter.pause(delay)
+                elif not last_attempt:
+                    time.sleep(delay)
+                continue
+            if response.status_code in (401, 403) and self.use_crumb:
+                self._crumb = None
+                continue
+            response.raise_for_status()
+            return response.json()['quoteResponse']['result']
+        message = f"quote request for {','.join(symbols)} failed after {self.max_retries} attempts, last with {last_failure}"
+        if last_failure == "HTTP 429":
+            raise RateLimitError(message)
+        raise QuoteFetchError(message)
+
+    def get_quotes(self, symbols):
+        # returns {symbol: Quote} for every symbol yahoo knows about, one request per batch_size symbols
+        try:
+            symbols = list(dict.fromkeys(symbol.upper() for symbol in symbols))
+            quotes = {}
+            for start in range(0, len(symbols), self.batch_size):
+                for item in self._fetch_chunk(symbols[start:start + self.batch_size]):
+                    quotes[item['symbol']] = Quote(
+                        symbol=item['symbol'],
+                        current_price=item.get('regularMarketPrice'),
+                        currency=item.get('currency'),
+                        previous_close=item.get('regularMarketPreviousClose'),
+                        change_percent=item.get('regularMarketChangePercent'),
+                        market_time=item.get('regularMarketTime'),
+                    )
+            return quotes
+        except QuoteFetchError:
+            raise
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def get_quote(self, symbol):
+        return self.get_quotes([symbol]).get(symbol.upper())
+
+
+if __name__=="__main__":
+    # checks against a local stub server that replays recorded responses; each scenario sets the
+    # statuses the stub answers with, in order, before it serves the recorded quotes
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs
+
+    recorded = {
+        'AAPL': {'symbol': 'AAPL', 'regularMarketPrice': 211.16, 'currency': 'USD', 'regularMarketPreviousClose': 210.02},
+        'RCF.NS': {'symbol': 'RCF.NS', 'regularMarketPrice': 152.3, 'currency': 'INR', 'regularMarketPreviousClose': 150.1},
+        'NOCCY': {'symbol': 'NOCCY', 'regularMarketPrice': 10.5},
+    }
+    stub = {'statuses': [], 'requests': []}
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            stub['requests'].append(self.path)
+            if stub['statuses']:
+                self.send_response(stub['statuses'].pop(0))
+                self.send_header('Retry-After', '0')
+                self.end_headers()
+                return
+            symbols = parse_qs(urlparse(self.path).query)['symbols'][0].split(',')
+            body = json.dumps({'quoteResponse': {'result': [recorded[s] for s in symbols if s in recorded]}})
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    def scenario(statuses, base_url=url, **kwargs):
+        stub['statuses'], stub['requests'] = list(statuses), []
+        return QuoteService(base_url, limiter=TokenBucket(1000), backoff_base=0.01, max_retries=3, **kwargs)
+
+    # 429 and 503 are retried, unknown symbols are left out
+    quotes = scenario([429, 503]).get_quotes(['aapl', 'RCF.NS', 'MISSING'])
+    assert set(quotes) == {'AAPL', 'RCF.NS'} and quotes['AAPL'].current_price == 211.16, quotes
+    assert len(stub['requests']) == 3, stub['requests']
+    # a missing currency stays unknown
+    assert scenario([]).get_quotes(['NOCCY'])['NOCCY'].currency is None
+    # batches of batch_size symbols, one request each
+    scenario([], batch_size=1).get_quotes(['AAPL', 'RCF.NS'])
+    assert len(stub['requests']) == 2, stub['requests']
+    # only a final 429 is a RateLimitError, other exhausted retries are QuoteFetchError
+    for statuses, expected in (([429, 429, 429], RateLimitError), ([429, 503, 503], QuoteFetchError),
+                               ([500, 500, 429], RateLimitError)):
+        try:
+            scenario(statuses).get_quotes(['AAPL'])
+            raise AssertionError(f"{statuses} did not raise")
+        except QuoteFetchError as e:
+            assert type(e) is expected, (statuses, e)
+    # no backoff after the last attempt: 3 attempts sleep twice
+    sleeps, real_sleep = [], time.sleep
+    time.sleep = sleeps.append
+    try:
+        scenario([503, 503, 503]).get_quotes(['AAPL'])
+    except QuoteFetchError:
+        pass
+    finally:
+        time.sleep = real_sleep
+    assert len(sleeps) == 2, sleeps
+    # a 404 is not retried
+    try:
+        scenario([404]).get_quotes(['AAPL'])
+        raise AssertionError("404 did not raise")
+    except CustomException:
+        assert len(stub['requests']) == 1, stub['requests']
+    # connection errors are retried and end in QuoteFetchError
+    server.shutdown()
+    server.server_close()
+    try:
+        scenario([], timeout=1).get_quotes(['AAPL'])
+        raise AssertionError("closed server did not raise")
+    except QuoteFetchError as e:
+        assert not isinstance(e, RateLimitError), e
+    print("quote service checks passed")
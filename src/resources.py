@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import threading
+from functools import lru_cache
+from src.logger import logging
+from src.exception import CustomException
+
+# corpora bundled with the app are looked up first, then the usual nltk_data locations
+NLTK_DATA_DIR = os.getenv("NLTK_DATA_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "nltk_data"))
+# set NLTK_AUTO_DOWNLOAD=0 on machines that must never reach the network
+NLTK_AUTO_DOWNLOAD = os.getenv("NLTK_AUTO_DOWNLOAD", "1") == "1"
+NLTK_RESOURCES = {
+    'vader_lexicon': 'sentiment/vader_lexicon.zip',
+    'punkt_tab': 'tokenizers/punkt_tab',
+    'stopwords': 'corpora/stopwords',
+    'wordnet': 'corpora/wordnet',
+}
+
+_download_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def ensure_nltk_resource(name):
+    # checks the local corpora without touching the network, downloads only what is missing
+    import nltk
+    if NLTK_DATA_DIR not in nltk.data.path:
+        nltk.data.path.insert(0, NLTK_DATA_DIR)
+    path = NLTK_RESOURCES[name]
+    try:
+        nltk.data.find(path)
+        return True
+    except LookupError:
+        if not NLTK_AUTO_DOWNLOAD:
+            raise CustomException(LookupError(f"NLTK resource {name} is not installed in {NLTK_DATA_DIR}"), sys)
+    with _download_lock:
+        logging.info(f"downloading NLTK resource {name} to {NLTK_DATA_DIR}")
+        nltk.download(name, download_dir=NLTK_DATA_DIR, quiet=True)
+    try:
+        nltk.data.find(path)
+    except LookupError as e:
+        raise CustomException(e,sys)
+    return True
+
+
+# analyzers are built on first use and shared by the whole process
+
+@lru_cache(maxsize=None)
+def get_sentiment_analyzer():
+    ensure_nltk_resource('vader_lexicon')
+    from nltk.sentiment import SentimentIntensityAnalyzer
+    return SentimentIntensityAnalyzer()
+
+
+@lru_cache(maxsize=None)
+def get_stop_words():
+    ensure_nltk_resource('stopwords')
+    from nltk.corpus import stopwords
+    return frozenset(stopwords.words('english'))
+
+
+@lru_cache(maxsize=None)
+def get_lemmatizer():
+    ensure_nltk_resource('wordnet')
+    from nltk.stem import WordNetLemmatizer
+    return WordNetLemmatizer()
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer():
+    ensure_nltk_resource('punkt_tab')
+    from nltk.tokenize import word_tokenize
+    return word_tokenize
+
+
+if __name__=="__main__":
+    # import-to-first-request latency of the NLP pipeline, without any network call
+    start = time.perf_counter()
+    from src.predict import Predict
+    imported = time.perf_counter()
+    predictor = Predict()
+    constructed = time.perf_counter()
+    import pandas as pd
+    posts = pd.DataFrame({'title': ["AAPL earnings beat, holding my calls!"],
+                          'text': ["Great quarter, not selling. https://example.com"]})
+    predictor.score_new_posts(posts)
+    first_request = time.perf_counter()
+    predictor.score_new_posts(posts)
+    second_request = time.perf_counter()
+    print(f"import: {(imported - start) * 1000:.0f} ms, Predict(): {(constructed - imported) * 1000:.0f} ms, "
+          f"first request: {(first_request - constructed) * 1000:.0f} ms, "
+          f"second request: {(second_request - first_request) * 1000:.1f} ms")
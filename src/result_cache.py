@@ -0,0 +1,95 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from src.logger import logging
+from src.metrics import CACHE_EVENTS
+from src.analysis_result import succeeded
+
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", 300))
+RESULT_CACHE_GRACE = float(os.getenv("RESULT_CACHE_GRACE", 900))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 256))
+
+
+class ResultCache:
+    # fresh entries are served for `ttl` seconds, then for another `grace` seconds they are
+    # served stale while a single background refresh runs. Failed results ({'success': False, ...})
+    # go to the callers waiting on them but are not stored, the next call tries again
+    def __init__(self, ttl=RESULT_CACHE_TTL, grace=RESULT_CACHE_GRACE, max_entries=RESULT_CACHE_MAX_ENTRIES, name='result'):
+        self.name = name
+        self.ttl = ttl
+        self.grace = grace
+        self.max_entries = max_entries
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                age = time.monotonic() - stored_at
+                if age < self.ttl + self.grace:
+                    self._entries.move_to_end(key)
+                    if age < self.ttl:
+                        self.hits += 1
+                        CACHE_EVENTS.inc(1, self.name, 'hit')
+                    else:
+                        self.stale_hits += 1
+                        CACHE_EVENTS.inc(1, self.name, 'stale_hit')
+                        if key not in self._inflight:
+                            future = self._inflight[key] = Future()
+                            threading.Thread(target=self._compute, args=(key, compute, future), daemon=True).start()
+                    return value
+                del self._entries[key]
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                CACHE_EVENTS.inc(1, self.name, 'miss')
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+                CACHE_EVENTS.inc(1, self.name, 'coalesced')
+        # concurrent callers for the same key wait on the owner's computation
+        if owner:
+            self._compute(key, compute, future)
+        return future.result()
+
+    def _compute(self, key, compute, future):
+        try:
+            value = compute()
+        except Exception as e:
+            logging.error(f"result cache computation failed for {key}: {e}")
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            return
+        with self._lock:
+            if succeeded(value):
+                self._entries[key] = (value, time.monotonic())
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            else:
+                CACHE_EVENTS.inc(1, self.name, 'failure_not_cached')
+            self._inflight.pop(key, None)
+        future.set_result(value)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'stale_hits': self.stale_hits, 'misses': self.misses,
+                    'coalesced': self.coalesced, 'entries': len(self._entries), 'refreshing': len(self._inflight)}
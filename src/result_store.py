@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import pickle
+import sqlite3
+import threading
+from src.logger import logging
+from src.exception import CustomException
+from src.post_cache import CACHE_DIR
+from src.sentiment_analysis import SENTIMENT_BACKEND
+
+# results older than this are not served from the store, the front end computes them instead
+RESULT_STORE_MAX_AGE = float(os.getenv("RESULT_STORE_MAX_AGE", 1800))
+# request counts halve after this many seconds without requests, so a ticker that was hot once
+# does not keep its priority
+REQUEST_HALF_LIFE = float(os.getenv("REQUEST_HALF_LIFE", 6 * 3600))
+
+
+def sentiment_kind(backend=None):
+    # results of the default backend are the ones the scheduler publishes
+    backend = backend or SENTIMENT_BACKEND
+    return 'sentiment' if backend == SENTIMENT_BACKEND else f'sentiment:{backend}'
+
+
+class ResultStore:
+    # analysis results shared by every process on the machine: the scheduler writes them ahead
+    # of time, the Flask and Streamlit front ends read them and count what users ask for
+    def __init__(self, cache_dir=CACHE_DIR, request_half_life=REQUEST_HALF_LIFE):
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.path = os.path.join(cache_dir, "result_store.sqlite3")
+            self.request_half_life = request_half_life
+            self._lock = threading.Lock()
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            # decay(seconds): the factor a request count shrinks by over that many seconds
+            self._conn.create_function('decay', 1, self._decay, deterministic=True)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "stock_symbol TEXT, stock_type TEXT, kind TEXT, value BLOB, updated_at REAL, "
+                "PRIMARY KEY (stock_symbol, stock_type, kind))")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS requests ("
+                "stock_symbol TEXT, stock_type TEXT, count INTEGER, last_requested REAL, "
+                "PRIMARY KEY (stock_symbol, stock_type))")
+            self._conn.commit()
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def get(self, stock_symbol, stock_type, kind, max_age=RESULT_STORE_MAX_AGE):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, updated_at FROM results WHERE stock_symbol = ? AND stock_type = ? AND kind = ?",
+                (stock_symbol, stock_type, kind)).fetchone()
+        if row is None or time.time() - row[1] > max_age:
+            return None
+        # values are pickled by this app only, the store file is as trusted as the code
+        return pickle.loads(row[0])
+
+    def put(self, stock_symbol, stock_type, kind, value):
+        try:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO results (stock_symbol, stock_type, kind, value, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (stock_symbol, stock_type, kind, blob, time.time()))
+                self._conn.commit()
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def _decay(self, seconds):
+        return 0.5 ** (max(seconds, 0.0) / self.request_half_life)
+
+    def updated_at(self, kind):
+        # {(stock_symbol, stock_type): last write} for one kind of result
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT stock_symbol, stock_type, updated_at FROM results WHERE kind = ?", (kind,)).fetchall()
+        return {(symbol, stock_type): updated_at for symbol, stock_type, updated_at in rows}
+
+    def record_request(self, stock_symbol, stock_type):
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT INTO requests (stock_symbol, stock_type, count, last_requested) VALUES (?, ?, 1, ?) "
+                    "ON CONFLICT (stock_symbol, stock_type) DO UPDATE SET "
+                    "count = count * decay(excluded.last_requested - last_requested) + 1, "
+                    "last_requested = excluded.last_requested",
+                    (stock_symbol, stock_type, time.time()))
+                self._conn.commit()
+        except Exception as e:
+            # counting is best effort, a locked database must not fail the request
+            logging.warning(f"could not record request for {stock_symbol}: {e}")
+
+    def request_counts(self, limit=None):
+        # {(stock_symbol, stock_type): request count decayed to now}, most requested first
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT stock_symbol, stock_type, count * decay(? - last_requested) AS recent FROM requests "
+                "ORDER BY recent DESC LIMIT ?", (time.time(), -1 if limit is None else limit)).fetchall()
+        return {(symbol, stock_type): count for symbol, stock_type, count in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,222 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from src.logger import logging
+from src.exception import CustomException
+from src.quote_service import TokenBucket
+from src.get_reddit_data import normalize_stock_type, MARKETS
+from src.symbol_router import RoutedFeed
+from src.analysis_result import succeeded
+from src.metrics import STAGE_SECONDS, STAGE_ERRORS
+
+WATCHLIST_FILE = os.getenv("WATCHLIST_FILE", "watchlist.json")
+SCHEDULER_INTERVAL = float(os.getenv("SCHEDULER_INTERVAL", 900))
+# the most requested symbols are refreshed more often, but never more often than this
+SCHEDULER_MIN_INTERVAL = float(os.getenv("SCHEDULER_MIN_INTERVAL", 120))
+# each interval is stretched or shrunk by up to this fraction so refreshes do not line up
+SCHEDULER_JITTER = float(os.getenv("SCHEDULER_JITTER", 0.1))
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", 4))
+# this many of the most requested symbols are refreshed even when they are not on the watchlist
+SCHEDULER_HOT_SYMBOLS = int(os.getenv("SCHEDULER_HOT_SYMBOLS", 20))
+# reddit allows 100 requests a minute per OAuth client, the rest is left to the front ends
+REDDIT_REQUESTS_PER_SECOND = float(os.getenv("REDDIT_REQUESTS_PER_SECOND", 1))
+REDDIT_RATE_LIMITER = TokenBucket(REDDIT_REQUESTS_PER_SECOND)
+# read each subreddit's new posts once per tick and route them to the symbols they mention,
+# instead of a reddit search per symbol
+SCHEDULER_ROUTING = os.getenv("SCHEDULER_ROUTING", "0") == "1"
+
+
+@dataclass(slots=True)
+class WatchItem:
+    stock_symbol: str
+    stock_type: str
+    interval: float
+    next_run: float = 0.0
+    # recent requests, decayed with REQUEST_HALF_LIFE
+    requests: float = 0.0
+    # company names the routed feed also matches, e.g. "Tesla" for TSLA
+    aliases: tuple = ()
+
+
+def load_watchlist(path=WATCHLIST_FILE, default_interval=SCHEDULER_INTERVAL, markets=MARKETS):
+    # {"default_interval": 900,
+    #  "symbols": ["TSLA", {"symbol": "AAPL", "type": "US", "interval": 300, "aliases": ["Apple"]}]}
+    if not os.path.exists(path):
+        logging.warning(f"watchlist {path} not found, only requested symbols will be refreshed")
+        return []
+    try:
+        with open(path) as f:
+            config = json.load(f)
+        default_interval = float(config.get('default_interval', default_interval))
+        items = []
+        for entry in config.get('symbols', []):
+            if isinstance(entry, str):
+                entry = {'symbol': entry}
+            items.append(WatchItem(entry['symbol'].strip().upper(), normalize_stock_type(entry.get('type', 'US'), markets),
+                                   float(entry.get('interval', default_interval)), aliases=tuple(entry.get('aliases', ()))))
+        return items
+    except Exception as e:
+        raise CustomException(e,sys)
+
+
+class RefreshScheduler:
+    # refreshes sentiment and prices for the watchlist in the background and publishes them to
+    # the result store, so the front ends answer watched and popular symbols without waiting
+    def __init__(self, predictor, yf_data, result_store, watchlist=(), max_concurrency=SCHEDULER_CONCURRENCY,
+                 default_interval=SCHEDULER_INTERVAL, min_interval=SCHEDULER_MIN_INTERVAL, jitter=SCHEDULER_JITTER,
+                 hot_symbols=SCHEDULER_HOT_SYMBOLS, reddit_limiter=REDDIT_RATE_LIMITER, use_process_pool=False,
+                 poll_interval=5.0, routing=SCHEDULER_ROUTING):
+        self.predictor = predictor
+        self.yf_data = yf_data
+        self.result_store = result_store
+        self.max_concurrency = max_concurrency
+        self.default_interval = default_interval
+        self.min_interval = min_interval
+        self.jitter = jitter
+        self.hot_symbols = hot_symbols
+        self.reddit_limiter = reddit_limiter
+        self.use_process_pool = use_process_pool
+        self.poll_interval = poll_interval
+        self.items = {}
+        self._inflight = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="scheduler")
+        # the feed's listings go through the post sources' own rate limits
+        self.feed = RoutedFeed(predictor.sources, predictor.post_store) if routing else None
+        # a restart picks up where the last run left off instead of refreshing everything at once
+        updated = result_store.updated_at('sentiment')
+        for item in watchlist:
+            self._add(item, updated.get((item.stock_symbol, item.stock_type)))
+
+    def _add(self, item, updated_at=None):
+        if updated_at is not None:
+            item.next_run = time.monotonic() + max(0.0, updated_at + self.interval(item) - time.time())
+        self.items[(item.stock_symbol, item.stock_type)] = item
+
+    def interval(self, item):
+        # halves with every doubling of 1 + the recent request count (1 request: 1/2, 3: 1/4,
+        # 7: 1/8), down to min_interval
+        return max(self.min_interval, item.interval / (1 + item.requests))
+
+    def _next_run(self, item, now):
+        return now + self.interval(item) * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def sync_requests(self):
+        # request counts come from every front end through the result store
+        counts = self.result_store.request_counts()
+        for key, item in self.items.items():
+            item.requests = counts.get(key, 0)
+        updated = None
+        for (stock_symbol, stock_type), count in list(counts.items())[:self.hot_symbols]:
+            if (stock_symbol, stock_type) not in self.items:
+                if updated is None:
+                    updated = self.result_store.updated_at('sentiment')
+                item = WatchItem(stock_symbol, stock_type, self.default_interval, requests=count)
+                self._add(item, updated.get((stock_symbol, stock_type)))
+                logging.info(f"scheduler: refreshing {stock_symbol} ({stock_type}), {count:.1f} recent requests")
+
+    def due(self, now):
+        # most requested first, so hot symbols get the free slots when the scheduler falls behind
+        with self._lock:
+            items = [item for key, item in self.items.items() if item.next_run <= now and key not in self._inflight]
+        return sorted(items, key=lambda item: (-item.requests, item.next_run))
+
+    def run_once(self):
+        self.sync_requests()
+        now = time.monotonic()
+        with self._lock:
+            free = self.max_concurrency - len(self._inflight)
+        items = self.due(now)[:max(0, free)]
+        if not items:
+            return []
+        self._refresh_stock_data(items)
+        if self.feed is not None:
+            # every watched symbol collects its posts, whether it is due now or not
+            self.feed.watch([item.stock_symbol for item in self.items.values()],
+                            {item.stock_symbol: item.aliases for item in self.items.values()})
+            self.feed.refresh(item.stock_type for item in items)
+        futures = []
+        for item in items:
+            item.next_run = self._next_run(item, now)
+            with self._lock:
+                self._inflight.add((item.stock_symbol, item.stock_type))
+            futures.append(self.executor.submit(self._refresh_sentiment, item))
+        return futures
+
+    def _refresh_stock_data(self, items):
+        # one bulk quote request for every due symbol; YfData goes through yahoo's shared token bucket
+        quotes = self.yf_data.get_yf_data_many([item.stock_symbol for item in items])
+        for item in items:
+            stock_data = quotes[item.stock_symbol]
+            if succeeded(stock_data):
+                self.result_store.put(item.stock_symbol, item.stock_type, 'stock_data', stock_data)
+
+    def _refresh_sentiment(self, item):
+        key = (item.stock_symbol, item.stock_type)
+        start = time.monotonic()
+        try:
+            if self.feed is not None:
+                post_df = self.feed.posts(item.stock_symbol, item.stock_type)
+                result = self.predictor.predict_posts(item.stock_symbol, post_df, pooled=self.use_process_pool,
+                                                      stock_type=item.stock_type)
+            else:
+                self.reddit_limiter.acquire()
+                predict = self.predictor.predict_pooled if self.use_process_pool else self.predictor.predict
+                result = predict(item.stock_symbol, item.stock_type)
+            if succeeded(result):
+                self.result_store.put(item.stock_symbol, item.stock_type, 'sentiment', result)
+            logging.info(f"scheduler: refreshed {item.stock_symbol} ({item.stock_type}) "
+                         f"in {time.monotonic() - start:.1f}s, next in {item.next_run - time.monotonic():.0f}s")
+        except Exception as e:
+            STAGE_ERRORS.inc(1, 'scheduled_refresh')
+            logging.error(f"scheduler: refresh of {item.stock_symbol} failed: {e}")
+        finally:
+            STAGE_SECONDS.observe(time.monotonic() - start, 'scheduled_refresh')
+            with self._lock:
+                self._inflight.discard(key)
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.error(f"scheduler tick failed: {e}")
+            self._stop.wait(self.poll_interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run_forever, name="scheduler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.executor.shutdown(wait=True)
+
+
+if __name__=="__main__":
+    # standalone refresher next to the Flask and Streamlit apps, they share the result store
+    from src.predict import Predict
+    from src.get_reddit_data import YfData
+    from src.result_store import ResultStore
+    from src.logger import setup_logging
+
+    setup_logging()
+    predictor = Predict()
+    predictor.warm_nlp_pool()
+    scheduler = RefreshScheduler(predictor, YfData(), ResultStore(), load_watchlist(markets=predictor.sources.markets),
+                                 use_process_pool=True)
+    logging.info(f"scheduler started with {len(scheduler.items)} watched symbols")
+    try:
+        scheduler.run_forever()
+    except KeyboardInterrupt:
+        scheduler.stop()
+        predictor.close()
@@ -1,17 +1,244 @@
+import os
 import sys
-import nltk
+import math
+import time
+import string
+from functools import lru_cache
+import numpy as np
 import pandas as pd
 from src.logger import logging
 from src.exception import CustomException
-from nltk.sentiment import SentimentIntensityAnalyzer
+from src.post_batch import full_text, created_datetimes
+from src.resources import get_sentiment_analyzer
+from src.linear_sentiment import LINEAR_MODEL_PATH
+from src.metrics import stage_timer
+from src.analysis_result import SentimentResult, TopPost, Trend
+
+# 'vader' (rule based, NLTK-exact) or 'linear' (the trained model of src.linear_sentiment)
+SENTIMENT_BACKEND = os.getenv("SENTIMENT_BACKEND", "vader")
+SENTIMENT_BACKENDS = ('vader', 'linear')
+
+
+def available_backends():
+    # the backends this deployment can run: 'linear' once a model has been trained into LINEAR_MODEL_PATH
+    return tuple(backend for backend in SENTIMENT_BACKENDS if backend != 'linear' or os.path.exists(LINEAR_MODEL_PATH))
+
+
+class VaderScorer:
+    # NLTK's VADER rules over a lexicon loaded once, scoring a whole list of texts into one array.
+    # Gives the same neg/neu/pos/compound as SentimentIntensityAnalyzer.polarity_scores, but
+    # lowercases each token once and skips the punctuation product dict nltk builds per text.
+    def __init__(self, lexicon=None):
+        from nltk.sentiment.vader import VaderConstants
+        constants = VaderConstants()
+        self.lexicon = dict(lexicon if lexicon is not None else get_sentiment_analyzer().lexicon)
+        self.negate = frozenset(constants.NEGATE)
+        self.booster = dict(constants.BOOSTER_DICT)
+        self.idioms = dict(constants.SPECIAL_CASE_IDIOMS)
+        self.punc_list = frozenset(constants.PUNC_LIST)
+        self.c_incr = constants.C_INCR
+        self.n_scalar = constants.N_SCALAR
+        self.b_decr = constants.B_DECR
+        self.punctuation = string.punctuation
+        self.remove_punctuation = constants.REGEX_REMOVE_PUNCTUATION
+
+    def tokenize(self, text):
+        # nltk maps "word!" / "!word" back to "word" only when the word survives punctuation removal
+        punctuation = self.punctuation
+        words_only = None
+        tokens = []
+        for token in text.split():
+            if len(token) <= 1:
+                continue
+            if token[0] in punctuation or token[-1] in punctuation:
+                if words_only is None:
+                    words_only = {word for word in self.remove_punctuation.sub("", text).split() if len(word) > 1}
+                core = token.lstrip(punctuation)
+                if len(core) < len(token):
+                    if token[:len(token) - len(core)] in self.punc_list and core in words_only:
+                        token = core
+                else:
+                    core = token.rstrip(punctuation)
+                    if token[len(core):] in self.punc_list and core in words_only:
+                        token = core
+            tokens.append(token)
+        return tokens
+
+    def is_negated(self, word):
+        word = word.lower()
+        return word in self.negate or "n't" in word
+
+    def scalar_inc_dec(self, word, valence, is_cap_diff):
+        scalar = 0.0
+        word_lower = word.lower()
+        if word_lower in self.booster:
+            scalar = self.booster[word_lower]
+            if valence < 0:
+                scalar *= -1
+            if word.isupper() and is_cap_diff:
+                if valence > 0:
+                    scalar += self.c_incr
+                else:
+                    scalar -= self.c_incr
+        return scalar
+
+    def never_check(self, valence, tokens, start_i, i):
+        if start_i == 0:
+            if self.is_negated(tokens[i - 1]):
+                valence = valence * self.n_scalar
+        elif start_i == 1:
+            if tokens[i - 2] == "never" and (tokens[i - 1] == "so" or tokens[i - 1] == "this"):
+                valence = valence * 1.5
+            elif self.is_negated(tokens[i - 2]):
+                valence = valence * self.n_scalar
+        else:
+            if (tokens[i - 3] == "never" and (tokens[i - 2] == "so" or tokens[i - 2] == "this")
+                    or (tokens[i - 1] == "so" or tokens[i - 1] == "this")):
+                valence = valence * 1.25
+            elif self.is_negated(tokens[i - 3]):
+                valence = valence * self.n_scalar
+        return valence
+
+    def idioms_check(self, valence, tokens, i):
+        idioms = self.idioms
+        onezero = f"{tokens[i - 1]} {tokens[i]}"
+        twoonezero = f"{tokens[i - 2]} {tokens[i - 1]} {tokens[i]}"
+        twoone = f"{tokens[i - 2]} {tokens[i - 1]}"
+        threetwoone = f"{tokens[i - 3]} {tokens[i - 2]} {tokens[i - 1]}"
+        threetwo = f"{tokens[i - 3]} {tokens[i - 2]}"
+        for sequence in (onezero, twoonezero, twoone, threetwoone, threetwo):
+            if sequence in idioms:
+                valence = idioms[sequence]
+                break
+        if len(tokens) - 1 > i:
+            zeroone = f"{tokens[i]} {tokens[i + 1]}"
+            if zeroone in idioms:
+                valence = idioms[zeroone]
+        if len(tokens) - 1 > i + 1:
+            zeroonetwo = f"{tokens[i]} {tokens[i + 1]} {tokens[i + 2]}"
+            if zeroonetwo in idioms:
+                valence = idioms[zeroonetwo]
+        if threetwo in self.booster or twoone in self.booster:
+            valence = valence + self.b_decr
+        return valence
+
+    def sentiments(self, tokens):
+        lexicon = self.lexicon
+        lowered = [token.lower() for token in tokens]
+        length = len(tokens)
+        allcaps = sum(1 for token in tokens if token.isupper())
+        is_cap_diff = 0 < length - allcaps < length
+        # nltk scores a repeated token at the position of its first occurrence
+        first_index = {}
+        for index, token in enumerate(tokens):
+            first_index.setdefault(token, index)
+        sentiments = []
+        for item in tokens:
+            i = first_index[item]
+            item_lower = lowered[i]
+            if (i < length - 1 and item_lower == "kind" and lowered[i + 1] == "of") or item_lower in self.booster:
+                sentiments.append(0)
+                continue
+            valence = lexicon.get(item_lower)
+            if valence is None:
+                sentiments.append(0)
+                continue
+            if item.isupper() and is_cap_diff:
+                if valence > 0:
+                    valence += self.c_incr
+                else:
+                    valence -= self.c_incr
+            for start_i in range(0, 3):
+                if i > start_i and lowered[i - (start_i + 1)] not in lexicon:
+                    s = self.scalar_inc_dec(tokens[i - (start_i + 1)], valence, is_cap_diff)
+                    if start_i == 1 and s != 0:
+                        s = s * 0.95
+                    if start_i == 2 and s != 0:
+                        s = s * 0.9
+                    valence = valence + s
+                    valence = self.never_check(valence, tokens, start_i, i)
+                    if start_i == 2:
+                        valence = self.idioms_check(valence, tokens, i)
+            # negation through "least"
+            if i > 1 and lowered[i - 1] not in lexicon and lowered[i - 1] == "least":
+                if lowered[i - 2] != "at" and lowered[i - 2] != "very":
+                    valence = valence * self.n_scalar
+            elif i > 0 and lowered[i - 1] not in lexicon and lowered[i - 1] == "least":
+                valence = valence * self.n_scalar
+            sentiments.append(valence)
+        if "but" in lowered:
+            but_index = lowered.index("but")
+            for index, sentiment in enumerate(sentiments):
+                if index < but_index:
+                    sentiments[index] = sentiment * 0.5
+                elif index > but_index:
+                    sentiments[index] = sentiment * 1.5
+        return sentiments
+
+    def score(self, text):
+        # (neg, neu, pos, compound), rounded like nltk
+        if not isinstance(text, str):
+            text = str(text.encode("utf-8"))
+        sentiments = self.sentiments(self.tokenize(text))
+        if not sentiments:
+            return 0.0, 0.0, 0.0, 0.0
+        sum_s = float(sum(sentiments))
+        ep_count = min(text.count("!"), 4)
+        qm_count = text.count("?")
+        qm_amplifier = 0
+        if qm_count > 1:
+            qm_amplifier = qm_count * 0.18 if qm_count <= 3 else 0.96
+        punct_emph_amplifier = ep_count * 0.292 + qm_amplifier
+        if sum_s > 0:
+            sum_s += punct_emph_amplifier
+        elif sum_s < 0:
+            sum_s -= punct_emph_amplifier
+        compound = sum_s / math.sqrt((sum_s * sum_s) + 15)
+
+        pos_sum = 0.0
+        neg_sum = 0.0
+        neu_count = 0
+        for sentiment in sentiments:
+            if sentiment > 0:
+                pos_sum += float(sentiment) + 1
+            elif sentiment < 0:
+                neg_sum += float(sentiment) - 1
+            else:
+                neu_count += 1
+        if pos_sum > math.fabs(neg_sum):
+            pos_sum += punct_emph_amplifier
+        elif pos_sum < math.fabs(neg_sum):
+            neg_sum -= punct_emph_amplifier
+        total = pos_sum + math.fabs(neg_sum) + neu_count
+        return (round(math.fabs(neg_sum / total), 3), round(math.fabs(neu_count / total), 3),
+                round(math.fabs(pos_sum / total), 3), round(compound, 4))
+
+    def polarity_scores(self, text):
+        neg, neu, pos, compound = self.score(text)
+        return {'neg': neg, 'neu': neu, 'pos': pos, 'compound': compound}
+
+    def score_batch(self, texts):
+        # one row of (neg, neu, pos, compound) per text
+        scores = np.empty((len(texts), 4), dtype=np.float64)
+        score = self.score
+        for row, text in enumerate(texts):
+            scores[row] = score(text)
+        return scores
+
+
+@lru_cache(maxsize=None)
+def get_vader_scorer():
+    return VaderScorer()
 
 
-# Download required NLTK data
-nltk.download('vader_lexicon')
 class SentimentAnalysis:
     def __init__(self):
-        self.sia = SentimentIntensityAnalyzer()
-        self.quality_threshold = 0.5  
+        self.quality_threshold = 0.5
+
+    @property
+    def sia(self):
+        # the VADER lexicon is loaded once per process, on first use
+        return get_sentiment_analyzer()
 
     def quality_of_post(self, df):
         try:
@@ -29,12 +256,60 @@ class SentimentAnalysis:
         except Exception as e:
             raise CustomException(e,sys)
     
+    def polarity_scores_batch(self, texts, backend=None):
+        # score every text once, one row per text with neg/neu/pos/compound columns
+        try:
+            texts = pd.Series(texts)
+            backend = backend or SENTIMENT_BACKEND
+            if backend == 'linear':
+                from src.linear_sentiment import get_linear_model
+                scores = get_linear_model().score_batch(texts.tolist())
+            elif backend == 'vader':
+                scores = get_vader_scorer().score_batch(texts.tolist())
+            else:
+                raise ValueError(f"unknown sentiment backend {backend}, expected one of {SENTIMENT_BACKENDS}")
+            return pd.DataFrame(scores, index=texts.index, columns=['neg', 'neu', 'pos', 'compound'])
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def score_posts(self, posts_df):
+        try:
+            if 'compound' not in posts_df.columns:
+                scores = self.polarity_scores_batch(full_text(posts_df))
+                posts_df = posts_df.assign(**{col: scores[col] for col in scores.columns})
+            return posts_df
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def quality_scores(self, posts_df):
+        # same terms, in the same order, as quality_of_post
+        long_text = (posts_df['text'].str.len() > 100).to_numpy()
+        high_score = (posts_df['score'] > 10).to_numpy()
+        score = np.where(long_text, 0.3, 0.0)
+        score = np.where(high_score, score + 0.3, score)
+        return pd.Series(score + np.abs(posts_df['compound'].to_numpy()) * 0.4, index=posts_df.index)
+
     def filter_low_quality_posts(self, posts_df):
         try:
-            posts_df['quality_score'] = posts_df.apply(self.quality_of_post, axis=1)
+            posts_df = self.score_posts(posts_df)
+            posts_df = posts_df.assign(quality_score=self.quality_scores(posts_df))
             return posts_df[posts_df['quality_score'] > self.quality_threshold]
         except Exception as e:
             raise CustomException(e,sys)
+
+    def sentiment_scores(self, posts_df):
+        # vectorized analyze_sentiment, reusing the compound score of the quality filter
+        text = full_text(posts_df)
+        text_length = text.str.len().clip(upper=500).to_numpy()
+        has_question = text.str.contains('?', regex=False).astype(int).to_numpy()
+        has_exclamation = text.str.contains('!', regex=False).astype(int).to_numpy()
+        sentiment_score = (
+            posts_df['compound'].to_numpy() * 0.8 +
+            (text_length / 1000) * 0.1 +
+            (has_question * -0.05) +
+            (has_exclamation * 0.05)
+        )
+        return pd.Series(sentiment_score, index=posts_df.index)
     def analyze_sentiment(self, text):
         try:
             vader_sentiment = self.sia.polarity_scores(text)
@@ -65,7 +340,7 @@ class SentimentAnalysis:
                 'current_sentiment': 0
             }
         df_copy = df.copy()  
-        df_copy['date'] = pd.to_datetime(df_copy['created_utc'])
+        df_copy['date'] = created_datetimes(df_copy['created_utc'])
         df_copy.set_index('date', inplace=True)
         
 
@@ -98,9 +373,26 @@ class SentimentAnalysis:
           return "negetive"
         else:
           return "neutral"
-          
 
-    def get_result(self,df, stock_symbol):
+    def categorize_sentiments(self, sentiment_scores):
+        conditions = [
+            sentiment_scores > 0.5,
+            sentiment_scores > 0,
+            sentiment_scores <= -0.5,
+            sentiment_scores > -0.5,
+        ]
+        choices = ["very positive", "poistive", "Very negetive", "negetive"]
+        return pd.Series(np.select(conditions, choices, default="neutral"), index=sentiment_scores.index)
+
+
+    def add_sentiment(self, posts_df):
+        # sentiment score and category of quality filtered posts
+        posts_df = posts_df.copy()
+        posts_df['sentiment'] = self.sentiment_scores(posts_df)
+        posts_df['sentiment_category'] = self.categorize_sentiments(posts_df['sentiment'])
+        return posts_df
+
+    def get_result(self,df, stock_symbol, history=None, stock_type=None):
         try:
 
             if len(df) == 0:
@@ -109,36 +401,67 @@ class SentimentAnalysis:
                     'error': f'No Reddit posts found for {stock_symbol}'
                 }
             # get high quality post
-            df_cleaned = self.filter_low_quality_posts(df)
+            with stage_timer('quality_filter') as stage:
+                df_cleaned = self.filter_low_quality_posts(df)
+                stage.rows = len(df)
             if len(df_cleaned)== 0:
                 return{
                     'success': False,
                     'error': f'No High quality Reddit posts found for {stock_symbol}'
                 }
-            # get sentiment score
-            df_cleaned['sentiment']=df_cleaned['full_text'].apply(self.analyze_sentiment)
-
-            # Categorize sentiment
-            df_cleaned['sentiment_category'] = df_cleaned['sentiment'].apply(self.categorize_sentiment)
+            with stage_timer('sentiment') as stage:
+                # get sentiment score and category
+                df_cleaned = self.add_sentiment(df_cleaned)
+                stage.rows = len(df_cleaned)
 
             # Calculate metrics
             avg_sentiment = df_cleaned['sentiment'].mean()
-            sentiment_count = df_cleaned['sentiment_category'].value_counts().to_dict()
+            sentiment_count = {category: int(count) for category, count in df_cleaned['sentiment_category'].value_counts().items()}
 
             
             # Get top posts
-            top_posts = df_cleaned.nlargest(5, 'score')[['title', 'score', 'sentiment', 'subreddit','url']].to_dict('records')
+            top = df_cleaned.nlargest(5, 'score')[['title', 'score', 'sentiment', 'subreddit', 'url']]
+            top_posts = [TopPost(str(title), int(score), float(sentiment), str(subreddit), str(url))
+                         for title, score, sentiment, subreddit, url in top.itertuples(index=False, name=None)]
 
-            # Analyze trend
-            sentiment_analyze = self.analyze_trend(df_cleaned)
-            return {
-                'Success': True,
-                'stock_symbol': stock_symbol,
-                'Sentiment':avg_sentiment,
-                'Tendency': sentiment_count,
-                'post count': len(df),
-                'Top Post': top_posts,
-                'Trend': sentiment_analyze,
-            }
+            # Analyze trend, over every post seen so far when a SentimentHistory is given; it only
+            # reads the history, Predict.prepare_posts added these posts to it
+            with stage_timer('trend') as stage:
+                if history is not None:
+                    sentiment_analyze = history.trend(stock_symbol, stock_type)
+                else:
+                    sentiment_analyze = self.analyze_trend(df_cleaned)
+                stage.rows = len(df_cleaned)
+            return SentimentResult(stock_symbol, float(avg_sentiment), sentiment_count, len(df), top_posts,
+                                   Trend.from_analysis(sentiment_analyze))
         except Exception as e:
             raise CustomException(e,sys)
+
+
+if __name__=="__main__":
+    # compare VaderScorer with nltk's polarity_scores on a synthetic corpus and time both
+    import random
+
+    random.seed(0)
+    sia = get_sentiment_analyzer()
+    scorer = get_vader_scorer()
+    lexicon_words = random.sample(sorted(sia.lexicon), 400)
+    special = ["not", "never", "so", "this", "very", "VERY", "extremely", "kind", "of", "sort", "but", "BUT",
+               "least", "at", "isn't", "the", "shit", "bomb", "yeah", "right", "cut", "mustard", "kiss", "death",
+               "stock", "calls", "moon", "AAPL", "GREAT", ":)", ":(", "!", "?", "!!", "good!", "!bad", "?great",
+               "(awesome)", "don't", "a", "I"]
+    corpus = [" ".join(random.choices(lexicon_words + special * 4, k=random.randint(0, 60))) for _ in range(5000)]
+
+    start = time.perf_counter()
+    expected = [sia.polarity_scores(text) for text in corpus]
+    nltk_time = time.perf_counter() - start
+    start = time.perf_counter()
+    scores = scorer.score_batch(corpus)
+    scorer_time = time.perf_counter() - start
+
+    reference = np.array([[s['neg'], s['neu'], s['pos'], s['compound']] for s in expected])
+    max_error = np.abs(reference - scores).max()
+    assert max_error <= 1e-9, max_error
+    print(f"max abs difference {max_error:.1e} over {len(corpus)} texts")
+    print(f"nltk: {len(corpus) / nltk_time:,.0f} posts/s, VaderScorer: {len(corpus) / scorer_time:,.0f} posts/s, "
+          f"speedup {nltk_time / scorer_time:.1f}x")
@@ -0,0 +1,307 @@
+import os
+import sys
+import sqlite3
+import threading
+from datetime import date
+import numpy as np
+import pandas as pd
+from src.logger import logging
+from src.exception import CustomException
+from src.post_cache import CACHE_DIR
+
+SENTIMENT_HISTORY = os.getenv("SENTIMENT_HISTORY", "1") == "1"
+# days of moving average returned as the Trend of an analysis
+TREND_HISTORY_DAYS = int(os.getenv("TREND_HISTORY_DAYS", 90))
+# categorize_sentiments labels, in column order
+CATEGORIES = ["very positive", "poistive", "neutral", "negetive", "Very negetive"]
+CATEGORY_COLUMNS = ['very_positive', 'positive', 'neutral', 'negative', 'very_negative']
+# tables written before they were keyed by market hold US symbols, the markets other than US came later
+LEGACY_STOCK_TYPE = 'US'
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def trend_label(value):
+    # the labels of SentimentAnalysis.analyze_trend
+    if value > 0.2:
+        return 'Bullish'
+    if value < -0.2:
+        return 'Bearish'
+    return 'Neutral'
+
+
+def utc_days(created_utc):
+    # epoch seconds to date ordinals, days in UTC like analyze_trend
+    return np.asarray(created_utc, dtype='int64') // 86400 + EPOCH_ORDINAL
+
+
+class DailySeries:
+    # one symbol's days from first_day to last_day as dense arrays with prefix sums, so the
+    # average of any window is two subtractions
+    __slots__ = ('first_day', 'last_day', 'sums', 'counts', 'categories',
+                 'prefix_sums', 'prefix_counts', 'prefix_means', 'prefix_days', 'prefix_categories')
+
+    def __init__(self, rows):
+        days = np.array([row[0] for row in rows], dtype='int64')
+        self.first_day = int(days[0])
+        self.last_day = int(days[-1])
+        positions = days - self.first_day
+        length = self.last_day - self.first_day + 1
+        self.sums = np.zeros(length)
+        self.counts = np.zeros(length, dtype='int64')
+        self.categories = np.zeros((length, len(CATEGORIES)), dtype='int64')
+        self.sums[positions] = [row[1] for row in rows]
+        self.counts[positions] = [row[2] for row in rows]
+        self.categories[positions] = [row[3:] for row in rows]
+        has_posts = self.counts > 0
+        means = np.divide(self.sums, self.counts, out=np.zeros(length), where=has_posts)
+        # prefix arrays start with a 0 so window (s, e] is prefix[e] - prefix[s]
+        self.prefix_sums = np.concatenate(([0.0], np.cumsum(self.sums)))
+        self.prefix_counts = np.concatenate(([0], np.cumsum(self.counts)))
+        self.prefix_means = np.concatenate(([0.0], np.cumsum(means)))
+        self.prefix_days = np.concatenate(([0], np.cumsum(has_posts)))
+        self.prefix_categories = np.vstack((np.zeros((1, len(CATEGORIES)), dtype='int64'),
+                                            np.cumsum(self.categories, axis=0)))
+
+    def bounds(self, end_days, window):
+        # prefix indices of the windows ending on end_days, clipped to the stored range
+        positions = np.asarray(end_days) - self.first_day + 1
+        return np.clip(positions - window, 0, len(self.sums)), np.clip(positions, 0, len(self.sums))
+
+
+class SentimentHistory:
+    # per-day sentiment sums, post counts and category counts for every symbol and market (the
+    # same ticker can trade in two), accumulated from every analysis; a post id is only ever
+    # counted once per symbol and market
+    def __init__(self, cache_dir=CACHE_DIR):
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.path = os.path.join(cache_dir, "sentiment_history.sqlite3")
+            self._lock = threading.Lock()
+            self._series = {}
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            schemas = {
+                'daily_sentiment': (
+                    "stock_symbol TEXT, stock_type TEXT, day INTEGER, sentiment_sum REAL, post_count INTEGER, "
+                    f"{', '.join(f'{col} INTEGER' for col in CATEGORY_COLUMNS)}, "
+                    "PRIMARY KEY (stock_symbol, stock_type, day)"),
+                'counted_posts': "stock_symbol TEXT, stock_type TEXT, post_id TEXT, PRIMARY KEY (stock_symbol, stock_type, post_id)",
+            }
+            for table, schema in schemas.items():
+                self._migrate(table, schema)
+                self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({schema})")
+            self._conn.commit()
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def _migrate(self, table, schema):
+        # adds stock_type to a table from before it was part of the key
+        columns = [row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")]
+        if not columns or 'stock_type' in columns:
+            return
+        logging.info(f"sentiment history: keying {table} by stock_type, old rows are {LEGACY_STOCK_TYPE}")
+        self._conn.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+        self._conn.execute(f"CREATE TABLE {table} ({schema})")
+        self._conn.execute(f"INSERT INTO {table} (stock_type, {', '.join(columns)}) "
+                           f"SELECT ?, {', '.join(columns)} FROM {table}_old", (LEGACY_STOCK_TYPE,))
+        self._conn.execute(f"DROP TABLE {table}_old")
+
+    def add_posts(self, stock_symbol, stock_type, posts_df):
+        # posts_df has post_id, created_utc, sentiment and sentiment_category; returns the number
+        # of posts that were not counted before
+        if len(posts_df) == 0:
+            return 0
+        try:
+            post_ids = posts_df['post_id'].astype(str).tolist()
+            with self._lock:
+                counted = set()
+                for start in range(0, len(post_ids), 500):
+                    chunk = post_ids[start:start + 500]
+                    counted.update(post_id for (post_id,) in self._conn.execute(
+                        f"SELECT post_id FROM counted_posts WHERE stock_symbol = ? AND stock_type = ? "
+                        f"AND post_id IN ({','.join('?' * len(chunk))})", [stock_symbol, stock_type, *chunk]))
+                new = ~pd.Series(post_ids, index=posts_df.index).isin(counted) & ~pd.Index(post_ids).duplicated()
+                posts_df = posts_df[new.to_numpy()]
+                if len(posts_df) == 0:
+                    return 0
+                daily = pd.DataFrame({
+                    'day': utc_days(posts_df['created_utc']),
+                    'sentiment_sum': posts_df['sentiment'].to_numpy(),
+                    'post_count': 1,
+                    **{col: (posts_df['sentiment_category'] == label).to_numpy().astype('int64')
+                       for label, col in zip(CATEGORIES, CATEGORY_COLUMNS)},
+                }).groupby('day', sort=True).sum()
+                columns = ['sentiment_sum', 'post_count', *CATEGORY_COLUMNS]
+                self._conn.executemany(
+                    f"INSERT INTO daily_sentiment (stock_symbol, stock_type, day, {', '.join(columns)}) "
+                    f"VALUES (?, ?, ?, {','.join('?' * len(columns))}) "
+                    "ON CONFLICT (stock_symbol, stock_type, day) DO UPDATE SET "
+                    + ", ".join(f"{col} = {col} + excluded.{col}" for col in columns),
+                    [(stock_symbol, stock_type, int(day), float(row[0]), *map(int, row[1:]))
+                     for day, row in zip(daily.index, daily[columns].to_numpy(dtype=object))])
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO counted_posts (stock_symbol, stock_type, post_id) VALUES (?, ?, ?)",
+                    [(stock_symbol, stock_type, post_id) for post_id in posts_df['post_id'].astype(str)])
+                self._conn.commit()
+                self._series.pop((stock_symbol, stock_type), None)
+            logging.info(f"sentiment history: {len(posts_df)} new posts for {stock_symbol} ({stock_type}) over {len(daily)} days")
+            return len(posts_df)
+        except Exception as e:
+            raise CustomException(e,sys)
+
+    def series(self, stock_symbol, stock_type):
+        # dense prefix sums of one symbol, built from sqlite on first use after each write
+        key = (stock_symbol, stock_type)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None and key not in self._series:
+                rows = self._conn.execute(
+                    f"SELECT day, sentiment_sum, post_count, {', '.join(CATEGORY_COLUMNS)} FROM daily_sentiment "
+                    "WHERE stock_symbol = ? AND stock_type = ? ORDER BY day", key).fetchall()
+                series = self._series[key] = DailySeries(rows) if rows else None
+            return series
+
+    def symbols(self):
+        # (stock_symbol, stock_type) pairs with history
+        with self._lock:
+            return self._conn.execute("SELECT DISTINCT stock_symbol, stock_type FROM daily_sentiment").fetchall()
+
+    def daily(self, stock_symbol, stock_type):
+        # one row per day with posts
+        series = self.series(stock_symbol, stock_type)
+        if series is None:
+            return pd.DataFrame(columns=['sentiment', 'post_count', *CATEGORY_COLUMNS])
+        has_posts = series.counts > 0
+        index = pd.to_datetime(np.flatnonzero(has_posts) + series.first_day - EPOCH_ORDINAL, unit='D')
+        frame = pd.DataFrame(series.categories[has_posts], index=index, columns=CATEGORY_COLUMNS)
+        frame.insert(0, 'post_count', series.counts[has_posts])
+        frame.insert(0, 'sentiment', series.sums[has_posts] / series.counts[has_posts])
+        frame.index.name = 'date'
+        return frame
+
+    def moving_average(self, stock_symbol, stock_type, window=7, start=None, end=None, min_days=None, weighted=False):
+        # moving average for every day from start to end (date ordinals, default the stored range).
+        # By default it is the mean of the daily means, like analyze_trend, and a window needs
+        # min_days days with posts (default: all of them); weighted=True averages over posts instead
+        series = self.series(stock_symbol, stock_type)
+        if series is None:
+            return pd.Series(dtype='float64', name='sentiment')
+        start = series.first_day if start is None else start
+        end = series.last_day if end is None else end
+        min_days = window if min_days is None else min_days
+        days = np.arange(start, end + 1)
+        starts, ends = series.bounds(days, window)
+        covered = series.prefix_days[ends] - series.prefix_days[starts]
+        if weighted:
+            totals = series.prefix_sums[ends] - series.prefix_sums[starts]
+            counts = series.prefix_counts[ends] - series.prefix_counts[starts]
+        else:
+            totals = series.prefix_means[ends] - series.prefix_means[starts]
+            counts = covered
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = np.where((covered >= max(min_days, 1)) & (counts > 0), totals / counts, np.nan)
+        index = pd.to_datetime(days - EPOCH_ORDINAL, unit='D')
+        index.name = 'date'
+        return pd.Series(values, index=index, name='sentiment')
+
+    def window_average(self, stock_symbol, stock_type, window=7, end=None, min_days=1, weighted=False):
+        # a single window in constant time, nan when it has fewer than min_days days with posts
+        series = self.series(stock_symbol, stock_type)
+        if series is None:
+            return float('nan')
+        starts, ends = series.bounds([series.last_day if end is None else end], window)
+        covered = series.prefix_days[ends[0]] - series.prefix_days[starts[0]]
+        if weighted:
+            total = series.prefix_sums[ends[0]] - series.prefix_sums[starts[0]]
+            count = series.prefix_counts[ends[0]] - series.prefix_counts[starts[0]]
+        else:
+            total = series.prefix_means[ends[0]] - series.prefix_means[starts[0]]
+            count = covered
+        if covered < max(min_days, 1) or count == 0:
+            return float('nan')
+        return float(total / count)
+
+    def category_counts(self, stock_symbol, stock_type, window=7, end=None):
+        series = self.series(stock_symbol, stock_type)
+        if series is None:
+            return {}
+        starts, ends = series.bounds([series.last_day if end is None else end], window)
+        counts = series.prefix_categories[ends[0]] - series.prefix_categories[starts[0]]
+        return {label: int(count) for label, count in zip(CATEGORIES, counts) if count}
+
+    def trend(self, stock_symbol, stock_type, window_size=7, days=TREND_HISTORY_DAYS):
+        # same shape as SentimentAnalysis.analyze_trend, over the accumulated history
+        series = self.series(stock_symbol, stock_type)
+        if series is None:
+            return {'trend': 'Neutral', 'moving_avg': pd.Series(), 'current_sentiment': 0}
+        moving_avg = self.moving_average(stock_symbol, stock_type, window_size,
+                                         start=max(series.first_day, series.last_day - days + 1))
+        current = moving_avg.iloc[-1]
+        return {'trend': trend_label(current), 'moving_avg': moving_avg, 'current_sentiment': current}
+
+    def backfill(self, predictor, post_store):
+        # counts every post the incremental fetcher has stored, scored through the post cache; the
+        # market of stored posts is that of the source reading their subreddits
+        markets = {getattr(source, 'stream', None): source.markets for source in predictor.sources.sources}
+        added = 0
+        for stock_symbol, subreddits in post_store.keys():
+            stock_type = (markets.get(subreddits) or predictor.sources.markets)[0]
+            posts_df = post_store.load_posts(stock_symbol, subreddits, limit=None)
+            # without a stock_type prepare_posts leaves the predictor's own history alone
+            posts_df = predictor.prepare_posts(posts_df, stock_symbol)
+            scored = predictor.sentiment_analysis.filter_low_quality_posts(posts_df)
+            added += self.add_posts(stock_symbol, stock_type, predictor.sentiment_analysis.add_sentiment(scored))
+        logging.info(f"sentiment history backfilled with {added} posts")
+        return added
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+if __name__=="__main__" and sys.argv[1:] == ['backfill']:
+    # python -m src.sentiment_history backfill: count every post in the PostStore
+    from src.predict import Predict
+    from src.post_store import PostStore
+    predictor = Predict()
+    predictor.history.backfill(predictor, PostStore())
+
+elif __name__=="__main__":
+    # moving averages over a year of synthetic history, and their agreement with analyze_trend
+    import time
+    import random
+    import tempfile
+    from src.sentiment_analysis import SentimentAnalysis
+
+    random.seed(0)
+    now = int(time.time())
+    posts = pd.DataFrame({
+        'post_id': [f'p{i}' for i in range(20000)],
+        'created_utc': sorted(now - random.randrange(365 * 86400) for _ in range(20000)),
+        'sentiment': [random.uniform(-1, 1) + 0.1 for _ in range(20000)],
+    })
+    posts['sentiment_category'] = SentimentAnalysis().categorize_sentiments(posts['sentiment'])
+    with tempfile.TemporaryDirectory() as cache_dir:
+        history = SentimentHistory(cache_dir)
+        history.add_posts('BENCH', 'US', posts.iloc[:12000])
+        # overlapping runs only count each post once
+        history.add_posts('BENCH', 'US', posts.iloc[10000:])
+        expected = SentimentAnalysis().analyze_trend(posts)['moving_avg']
+        actual = history.moving_average('BENCH', 'US', 7)
+        assert np.allclose(actual.to_numpy(), expected.to_numpy(), equal_nan=True)
+        assert history.daily('BENCH', 'US')['post_count'].sum() == len(posts)
+        # the same ticker in another market is a separate series
+        assert history.series('BENCH', 'India') is None
+
+        history.series('BENCH', 'US')
+        for window in (7, 30, 90):
+            start = time.perf_counter()
+            for _ in range(1000):
+                history.window_average('BENCH', 'US', window)
+            single = (time.perf_counter() - start) / 1000
+            start = time.perf_counter()
+            for _ in range(100):
+                history.moving_average('BENCH', 'US', window)
+            year = (time.perf_counter() - start) / 100
+            print(f"window {window:>2}: one window {single * 1e6:.1f} us, 365 days {year * 1e3:.3f} ms")
+        history.close()
@@ -0,0 +1,228 @@
+import os
+import re
+import sys
+import time
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import TimeoutError
+from src.logger import logging
+from src.exception import CustomException
+from src.post_store import PostStore, LISTING
+from src.post_sources import merge_posts
+from src.post_batch import frame_from_records
+from src.metrics import stage_timer, STAGE_ERRORS
+
+# posts read per new-post listing on the first refresh, later ones stop at the previous newest post
+ROUTER_SCAN_LIMIT = int(os.getenv("ROUTER_SCAN_LIMIT", 500))
+# shorter symbols (A, ON, IT, ...) are only matched as $CASHTAGS, bare they are ordinary words
+ROUTER_MIN_BARE_LENGTH = int(os.getenv("ROUTER_MIN_BARE_LENGTH", 3))
+# words, cashtags and dotted or ampersand symbols such as BRK.B and M&M
+TOKEN_PATTERN = re.compile(r"\$?\w+(?:[.&]\w+)*")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text)
+
+
+class SymbolRouter:
+    # Aho-Corasick automaton over lowercased tokens: every symbol as a $cashtag (any case) and as
+    # a bare word (only as written, TSLA but not tsla), and every alias ('Tesla', 'Reliance
+    # Industries') in any case. route() walks the tokens once, so its cost is linear in the text
+    # length whether the router knows ten symbols or ten thousand.
+    def __init__(self, symbols=(), aliases=None, min_bare_length=ROUTER_MIN_BARE_LENGTH):
+        self.symbols = frozenset(symbols)
+        self.aliases = {symbol: tuple(names) for symbol, names in (aliases or {}).items()}
+        # per state: token -> next state, failure state, [(symbol, exact token or None)]
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for symbol in self.symbols:
+            self._add(('$' + symbol.lower(),), symbol)
+            if len(symbol) >= min_bare_length:
+                self._add((symbol.lower(),), symbol, exact=symbol)
+        for symbol, names in self.aliases.items():
+            for name in names:
+                tokens = tuple(token.lower() for token in tokenize(name))
+                if tokens:
+                    self._add(tokens, symbol)
+        self._link()
+
+    def _add(self, tokens, symbol, exact=None):
+        state = 0
+        for token in tokens:
+            following = self._goto[state].get(token)
+            if following is None:
+                following = self._goto[state][token] = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = following
+        self._out[state].append((symbol, exact))
+
+    def _link(self):
+        # breadth first, so a state's failure state is linked before the state itself
+        # the root's children fail to the root
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, following in self._goto[state].items():
+                queue.append(following)
+                fail = self._fail[state]
+                while fail and token not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[following] = self._goto[fail].get(token, 0)
+                self._out[following] = self._out[following] + self._out[self._fail[following]]
+
+    def route(self, text):
+        # the symbols a text mentions
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        found = set()
+        for token in tokenize(text):
+            key = token.lower()
+            while state and key not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(key, 0)
+            for symbol, exact in out[state]:
+                # exact patterns are single tokens, so the match is the current token
+                if exact is None or token == exact:
+                    found.add(symbol)
+        return found
+
+
+class RoutedFeed:
+    # one new-post listing per reddit source instead of one search per symbol: every post is
+    # routed to the watched symbols it mentions and stored per symbol, so refreshing N symbols
+    # costs O(subreddit sets) API calls instead of O(N). posts() reads them back for Predict.
+    def __init__(self, sources, post_store=None, scan_limit=ROUTER_SCAN_LIMIT):
+        self.sources = sources
+        self.post_store = post_store if post_store is not None else PostStore()
+        self.scan_limit = scan_limit
+        self.router = SymbolRouter()
+        # newest (created_utc, post_id) seen per listing, persisted in the post store so a restart
+        # reads on from there instead of rescanning scan_limit posts
+        self._watermarks = {}
+        # listings being read right now; a concurrent refresh leaves them to the one reading them
+        self._reading = set()
+        # guards the two above, never held across a network call
+        self._lock = threading.Lock()
+
+    def watch(self, symbols, aliases=None):
+        # the automaton is rebuilt only when the watched symbols change
+        aliases = {symbol: tuple(names) for symbol, names in (aliases or {}).items() if names}
+        if frozenset(symbols) != self.router.symbols or aliases != self.router.aliases:
+            self.router = SymbolRouter(symbols, aliases)
+            logging.info(f"routed feed: watching {len(self.router.symbols)} symbols")
+
+    def streams(self, stock_type):
+        return [source for source in self.sources.sources if source.stream and source.serves(stock_type)]
+
+    def _key(self, source):
+        return f"routed:{source.stream}"
+
+    def _watermark(self, source):
+        if source.stream not in self._watermarks:
+            self._watermarks[source.stream] = self.post_store.get_watermark(LISTING, self._key(source))
+        return self._watermarks[source.stream]
+
+    def _read_stream(self, source, watermark):
+        if source.rate_limiter is not None:
+            source.rate_limiter.acquire()
+        with stage_timer('routed_listing') as stage:
+            posts = source.clients.get().get_new_posts(source.stream, self.scan_limit, watermark)
+            stage.rows = len(posts)
+        return posts
+
+    def refresh(self, stock_types):
+        # reads every listing of the given markets once, concurrently, and stores the new posts
+        # under each symbol they mention; returns {symbol: new posts}. The watermarks are taken
+        # under the lock, the listings read without it and the new watermarks merged under it
+        start = time.monotonic()
+        router = self.router
+        with self._lock:
+            sources = [source for source in {source.stream: source for stock_type in set(stock_types)
+                                             for source in self.streams(stock_type)}.values()
+                       if source.stream not in self._reading]
+            watermarks = {source.stream: self._watermark(source) for source in sources}
+            self._reading.update(watermarks)
+        try:
+            futures = [(source, self.sources.executor.submit(self._read_stream, source, watermarks[source.stream]))
+                       for source in sources]
+            routed = defaultdict(int)
+            for source, future in futures:
+                try:
+                    posts = future.result(timeout=max(0.0, start + source.timeout - time.monotonic()))
+                except TimeoutError:
+                    STAGE_ERRORS.inc(1, 'routed_listing')
+                    logging.warning(f"routed feed: r/{source.stream} timed out after {source.timeout}s")
+                    continue
+                except Exception as e:
+                    STAGE_ERRORS.inc(1, 'routed_listing')
+                    logging.error(f"routed feed: r/{source.stream} failed: {e}")
+                    continue
+                if not posts:
+                    continue
+                with stage_timer('route') as stage:
+                    by_symbol = defaultdict(list)
+                    for post in posts:
+                        for symbol in router.route(f"{post[1]} {post[2]}"):
+                            by_symbol[symbol].append(post)
+                    stage.rows = len(posts)
+                for symbol, symbol_posts in by_symbol.items():
+                    self.post_store.add_posts(symbol, self._key(source), symbol_posts)
+                    routed[symbol] += len(symbol_posts)
+                # moved only once the posts are stored, a crash in between reads them again
+                newest = (posts[0][4], posts[0][0])
+                with self._lock:
+                    current = self._watermarks.get(source.stream)
+                    if current is None or newest[0] >= current[0]:
+                        self._watermarks[source.stream] = newest
+                self.post_store.set_watermark(LISTING, self._key(source), *newest)
+                logging.info(f"routed feed: {len(posts)} new posts in r/{source.stream} "
+                             f"mention {len(by_symbol)} watched symbols")
+            return dict(routed)
+        finally:
+            with self._lock:
+                self._reading.difference_update(watermarks)
+
+    def posts(self, stock_symbol, stock_type, limit=100):
+        # the newest routed posts of a symbol over its market's listings, as a post frame
+        try:
+            frames = []
+            for source in self.streams(stock_type):
+                stored = self.post_store.load_posts(stock_symbol, self._key(source), limit)
+                frames.append(frame_from_records(stock_symbol, stored.itertuples(index=False, name=None)))
+            return merge_posts(frames).head(limit)
+        except Exception as e:
+            raise CustomException(e,sys)
+
+
+if __name__=="__main__":
+    # routing cost per post against the watchlist size, and against one regex scan per symbol
+    import random
+    from src.post_sources import mentions_symbol
+
+    random.seed(0)
+    words = "the stock is going to moon after earnings calls puts and i am holding my shares".split()
+    symbols = [''.join(random.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZ', k=random.randint(3, 5))) for _ in range(10000)]
+    texts = []
+    for _ in range(2000):
+        tokens = random.choices(words, k=random.randint(20, 200))
+        for _ in range(random.randint(0, 3)):
+            symbol = random.choice(symbols[:10])
+            tokens.insert(random.randrange(len(tokens)), random.choice([symbol, f'${symbol.lower()}']))
+        texts.append(' '.join(tokens))
+    for size in (10, 100, 1000, 10000):
+        router = SymbolRouter(symbols[:size], {symbols[0]: ['Acme Rockets', 'Acme']})
+        start = time.perf_counter()
+        routed = [router.route(text) for text in texts]
+        elapsed = time.perf_counter() - start
+        line = f"{size:>6} symbols: automaton {len(texts) / elapsed:>9,.0f} posts/s"
+        if size <= 1000:
+            scanners = {symbol: mentions_symbol(symbol) for symbol in symbols[:size]}
+            start = time.perf_counter()
+            for text in texts:
+                [symbol for symbol, mentions in scanners.items() if mentions(text)]
+            line += f", regex per symbol {len(texts) / (time.perf_counter() - start):>9,.0f} posts/s"
+        print(line)
+    print(f"{sum(map(len, routed))} mentions routed")
@@ -1,31 +1,56 @@
 import sys
 import re
+import time
+import random
+from functools import lru_cache
 import pandas as pd
 from src.logger import logging
 from src.exception import CustomException
-import nltk
-from nltk.tokenize import word_tokenize
-from nltk.stem import WordNetLemmatizer
-from nltk.corpus import stopwords
-
-nltk.download('punkt_tab')
-nltk.download('stopwords')
-nltk.download('wordnet')
+from src.resources import get_lemmatizer, get_stop_words, get_tokenizer
+
+URL_PATTERN = re.compile(r'http\S+|www\S+|https\S+', flags=re.MULTILINE)
+REDDIT_LINK_PATTERN = re.compile(r'\[([^\]]+)\]\([^\)]+\)')
+SPECIAL_CHAR_PATTERN = re.compile(r'[^\w\s]')
+
+
 class TextCleaner:
-    def __init__(self):
-        logging.info("data cleaning")
-        self.stop_words = set(stopwords.words('english'))
-        self.wl = WordNetLemmatizer()
+    def __init__(self, lemma_cache_size=50000):
+        logging.debug("data cleaning")
+        # nltk corpora load on first use, not when the cleaner is built
+        self._stop_words = None
+        self._tokenize = None
+        # reddit vocabulary repeats a lot, so memoize the lemma of each token
+        self.lemmatize = lru_cache(maxsize=lemma_cache_size)(self._lemmatize)
+
+    @property
+    def stop_words(self):
+        if self._stop_words is None:
+            self._stop_words = get_stop_words()
+        return self._stop_words
+
+    @property
+    def wl(self):
+        return get_lemmatizer()
+
+    @property
+    def tokenize(self):
+        if self._tokenize is None:
+            self._tokenize = get_tokenizer()
+        return self._tokenize
+
+    def _lemmatize(self, word):
+        return self.wl.lemmatize(word)
+
     def clean_text(self, text):
         try:
             if not isinstance(text, str):
                 return ""
             # Remove URLs
-            text = re.sub(r'http\S+|www\S+|https\S+', '', text, flags=re.MULTILINE)
+            text = URL_PATTERN.sub('', text)
             # Remove Reddit-style links
-            text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
+            text = REDDIT_LINK_PATTERN.sub(r'\1', text)
             # Remove special characters and digits
-            text = re.sub(r'[^\w\s]', '', text)
+            text = SPECIAL_CHAR_PATTERN.sub('', text)
             # lowecase
             text = text.lower()
 
@@ -34,10 +59,53 @@ class TextCleaner:
             raise CustomException(e,sys)
     def text_processing(self,text):
         try:
-            tokens = word_tokenize(text)
+            tokens = self.tokenize(text)
             tokens= [word for word in tokens if word not in self.stop_words]
-            tokens= [self.wl.lemmatize(word) for word in tokens] 
+            tokens= [self.lemmatize(word) for word in tokens]
 
             return ' '.join(tokens)
         except Exception as e:
-            raise CustomException(e,sys)
\ No newline at end of file
+            raise CustomException(e,sys)
+
+    def clean_and_process(self, text):
+        # clean_text followed by text_processing in a single call
+        if not isinstance(text, str):
+            return ""
+        text = URL_PATTERN.sub('', text)
+        text = REDDIT_LINK_PATTERN.sub(r'\1', text)
+        text = SPECIAL_CHAR_PATTERN.sub('', text).lower().strip()
+        stop_words = self.stop_words
+        lemmatize = self.lemmatize
+        return ' '.join([lemmatize(word) for word in self.tokenize(text) if word not in stop_words])
+
+    def clean_batch(self, texts):
+        try:
+            texts = pd.Series(texts)
+            return pd.Series([self.clean_and_process(text) for text in texts], index=texts.index)
+        except Exception as e:
+            raise CustomException(e,sys)
+
+
+if __name__=="__main__":
+    # benchmark clean_batch against the two-pass clean_text/text_processing path with the
+    # uncached WordNetLemmatizer, the code path before clean_batch
+    random.seed(0)
+    vocab = ["stock", "buying", "calls", "puts", "earnings", "moon", "crashed", "holding",
+             "shares", "the", "is", "are", "was", "bullish", "bearish", "dividends", "$AAPL",
+             "[link](https://reddit.com/r/stocks)", "https://example.com/x?y=1", "running", "99%"]
+    posts = pd.Series([" ".join(random.choices(vocab, k=random.randint(5, 120))) for _ in range(10000)])
+    baseline = TextCleaner()
+    baseline.lemmatize = baseline.wl.lemmatize
+
+    start = time.perf_counter()
+    two_pass = posts.apply(baseline.clean_text).apply(baseline.text_processing)
+    two_pass_time = time.perf_counter() - start
+
+    cleaner = TextCleaner()
+    start = time.perf_counter()
+    batch = cleaner.clean_batch(posts)
+    batch_time = time.perf_counter() - start
+
+    assert two_pass.tolist() == batch.tolist()
+    print(f"two pass: {two_pass_time:.2f}s, clean_batch: {batch_time:.2f}s, "
+          f"speedup: {two_pass_time / batch_time:.1f}x, lemma cache: {cleaner.lemmatize.cache_info()}")
\ No newline at end of file
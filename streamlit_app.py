@@ -4,20 +4,110 @@ import pandas as pd
 import streamlit as st
 from src.predict import Predict
 from src.get_reddit_data import YfData
-from src.logger import logging
+from src.result_cache import ResultCache
+from src.orchestrator import AnalysisOrchestrator
+from src.result_store import ResultStore
+from src.analysis_result import SentimentResult
+from src.sentiment_analysis import available_backends
+from src.logger import logging, setup_logging
 from src.exception import CustomException
 
+setup_logging()
 
-# Initialize analyzers
-sentiment_result = Predict()
-stock_data = YfData()
+# Initialize analyzers once per process, streamlit re-runs this script on every interaction
+@st.cache_resource
+def get_orchestrator():
+    # the result store is shared with the Flask app and filled ahead of time by the scheduler
+    return AnalysisOrchestrator(Predict(), YfData(), ResultCache(name='sentiment'), ResultCache(name='stock_data'),
+                                result_store=ResultStore())
+
+orchestrator = get_orchestrator()
+
+
+def show_sentiment(result):
+    # Main results section
+    st.markdown(f"## 📊 Sentiment Analysis Summary for `{result.stock_symbol}`")
+    
+    # Create metrics columns
+    col1, col2, col3 = st.columns(3)
+    
+    with col1:
+        st.metric("Overall Sentiment Score", f"{result.sentiment:.4f}")
+    
+    with col2:
+        if result.tendency:
+            main_tendency, tendency_count = next(iter(result.tendency.items()))
+            st.metric("General Tendency", f"{main_tendency.title()} ({tendency_count} posts)")
+        else:
+            st.metric("General Tendency", "N/A")
+    
+    with col3:
+        st.metric("Total Posts Analyzed", result.post_count)
+    
+    # Trend analysis section
+    trend = result.trend
+    st.subheader("📈 Trend Analysis")
+    
+    trend_col1, trend_col2 = st.columns(2)
+    
+    with trend_col1:
+        st.metric("Current Sentiment", f"{trend.current_sentiment:.4f}")
+    
+    with trend_col2:
+        st.metric("Trend Direction", trend.trend)
+    
+    if len(trend.moving_avg) > 0:
+        st.subheader("📊 Sentiment Trend Chart")
+        st.line_chart(pd.DataFrame({'Moving Average': trend.moving_avg_series()}))
+    
+    # Top posts section, one DataFrame per render
+    if not result.top_posts:
+        st.info("No top posts available to display.")
+        return
+    st.subheader("🔥 Top Reddit Posts")
+    posts_df = result.top_posts_frame()
+    
+    # Display as interactive table
+    st.dataframe(
+        posts_df[['title', 'score', 'sentiment', 'subreddit']].rename(columns={
+            'title': 'Title', 'score': 'Score', 'sentiment': 'Sentiment', 'subreddit': 'Subreddit'}),
+        use_container_width=True,
+        hide_index=True,
+        column_config={
+            "Title": st.column_config.TextColumn(
+                "Title",
+                width="large",
+            ),
+            "Score": st.column_config.NumberColumn(
+                "Score",
+                help="Reddit post score",
+                format="%d",
+            ),
+            "Sentiment": st.column_config.NumberColumn(
+                "Sentiment",
+                help="Sentiment score",
+                format="%.4f",
+            ),
+            "Subreddit": st.column_config.TextColumn(
+                "Subreddit",
+                width="medium",
+            ),
+        }
+    )
+    
+    with st.expander("🔗 View Post URLs"):
+        for post in result.top_posts:
+            st.markdown(f"**{post.title[:50]}...** - [{post.url}]({post.url})")
 
 # Streamlit page title
 st.title("Reddit Stock Sentiment Analyzer")
 
 # User Inputs
 stock_symbol = st.text_input("Enter Stock Symbol (e.g., AAPL, TCS):").upper()
-stock_type = st.selectbox("Select Stock Type:", ["US", "India"])
+# markets are the ones configured in sources.json
+stock_type = st.selectbox("Select Stock Type:", list(orchestrator.markets))
+# the linear model is offered once one is trained with `python -m src.linear_sentiment train`
+backend = st.selectbox("Sentiment Model:", list(available_backends()))
 
 # Submit button
 if st.button("🔍 Analyze", type="primary"):
@@ -25,136 +115,19 @@ if st.button("🔍 Analyze", type="primary"):
         try:
             # Show progress
             with st.spinner("Analyzing sentiment... This may take a moment."):
-                # Get sentiment analysis result
-                result = sentiment_result.predict(stock_symbol, stock_type)
-                
-                # Get stock data
-                stock_info = stock_data.get_yf_data(stock_symbol)
+                # watched symbols come from the result store, anything else is fetched now,
+                # sentiment and stock data concurrently
+                analysis = (orchestrator.lookup(stock_symbol, stock_type, backend)
+                            or orchestrator.analyze(stock_symbol, stock_type, backend))
+                result = analysis['sentiment']
+                stock_info = analysis['stock_data']
 
-            # Display results
-            st.success("✅ Sentiment analysis completed successfully!")
-            
-            # Extract data safely
-            sentiment_data = result.get('Sentiment', {})
-            symbol = result.get('stock_symbol', stock_symbol)
-            
-            # Main results section
-            st.markdown(f"## 📊 Sentiment Analysis Summary for `{symbol}`")
-            
-            # Create metrics columns
-            col1, col2, col3 = st.columns(3)
-            
-            with col1:
-                sentiment_score = sentiment_data.get('Sentiment', 0) if isinstance(sentiment_data, dict) else result.get('Sentiment', 0)
-                st.metric("Overall Sentiment Score", f"{sentiment_score:.4f}")
-            
-            with col2:
-                tendency = result.get('Tendency', {})
-                if tendency:
-                    main_tendency = list(tendency.keys())[0].title()
-                    tendency_count = list(tendency.values())[0]
-                    st.metric("General Tendency", f"{main_tendency} ({tendency_count} posts)")
-                else:
-                    st.metric("General Tendency", "N/A")
-            
-            with col3:
-                post_count = result.get('post count', 0)
-                st.metric("Total Posts Analyzed", post_count)
-            
-            # Trend analysis section
-            trend_data = result.get('Trend', {})
-            if trend_data:
-                st.subheader("📈 Trend Analysis")
-                
-                trend_col1, trend_col2 = st.columns(2)
-                
-                with trend_col1:
-                    current_sentiment = trend_data.get('current_sentiment', 0)
-                    st.metric("Current Sentiment", f"{current_sentiment:.4f}")
-                
-                with trend_col2:
-                    trend_direction = trend_data.get('trend', 'N/A')
-                    st.metric("Trend Direction", trend_direction)
-                
-                # Moving average data (if available)
-                moving_avg = trend_data.get('moving_avg')
-                if moving_avg is not None and len(moving_avg) > 0:
-                    st.subheader("📊 Sentiment Trend Chart")
-                    try:
-                        # Create a simple line chart
-                        chart_data = pd.DataFrame({
-                            'Moving Average': moving_avg
-                        })
-                        st.line_chart(chart_data)
-                    except Exception as chart_error:
-                        st.warning(f"Could not display trend chart: {chart_error}")
-            
-            # Top posts section
-            top_posts = result.get('Top Post', [])
-            if top_posts:
-                st.subheader("🔥 Top Reddit Posts")
-                
-                try:
-                    # Convert to DataFrame
-                    posts_df = pd.DataFrame(top_posts)
-                    
-                    # Ensure required columns exist
-                    required_columns = ['title', 'score', 'sentiment', 'subreddit']
-                    for col in required_columns:
-                        if col not in posts_df.columns:
-                            posts_df[col] = 'N/A'
-                    
-                    # Select and reorder columns
-                    display_columns = ['title', 'score', 'sentiment', 'subreddit']
-                    posts_df = posts_df[display_columns]
-                    
-                    # Format columns
-                    posts_df['score'] = posts_df['score'].astype(str)
-                    posts_df['sentiment'] = pd.to_numeric(posts_df['sentiment'], errors='coerce').round(4)
-                    
-                    # Rename columns for better display
-                    posts_df.columns = ['Title', 'Score', 'Sentiment', 'Subreddit']
-                    
-                    # Display as interactive table
-                    st.dataframe(
-                        posts_df,
-                        use_container_width=True,
-                        hide_index=True,
-                        column_config={
-                            "Title": st.column_config.TextColumn(
-                                "Title",
-                                width="large",
-                            ),
-                            "Score": st.column_config.NumberColumn(
-                                "Score",
-                                help="Reddit post score",
-                                format="%d",
-                            ),
-                            "Sentiment": st.column_config.NumberColumn(
-                                "Sentiment",
-                                help="Sentiment score",
-                                format="%.4f",
-                            ),
-                            "Subreddit": st.column_config.TextColumn(
-                                "Subreddit",
-                                width="medium",
-                            ),
-                        }
-                    )
-                    
-                    # If URLs are available, show them as expandable section
-                    if 'url' in pd.DataFrame(top_posts).columns:
-                        with st.expander("🔗 View Post URLs"):
-                            url_df = pd.DataFrame(top_posts)[['title', 'url']]
-                            for idx, row in url_df.iterrows():
-                                st.markdown(f"**{row['title'][:50]}...** - [{row['url']}]({row['url']})")
-                
-                except Exception as posts_error:
-                    st.error(f"Error displaying top posts: {posts_error}")
-                    # Fallback display
-                    st.json(top_posts)
+            # Display results; a failed analysis is a {'success': False, 'error': ...} dict
+            if isinstance(result, SentimentResult):
+                st.success("✅ Sentiment analysis completed successfully!")
+                show_sentiment(result)
             else:
-                st.info("No top posts available to display.")
+                st.warning(f"⚠️ {result.get('error', 'Sentiment analysis failed')}")
             
             # Stock data section
             if stock_info:
@@ -213,6 +186,6 @@ with st.sidebar:
     st.markdown("## 🔧 Tips")
     st.markdown("""
     - Use standard stock symbols (AAPL, TSLA, etc.)
-    - Analysis may take 30-60 seconds
+    - Watchlist and popular symbols answer instantly, others may take 30-60 seconds
     - Results based on recent Reddit posts
     """)
\ No newline at end of file